@@ -0,0 +1,350 @@
+"""Exports and usage analytics over the stored medical records.
+
+Exports stream records from the record store (or a legacy JSON array file)
+to JSONL, CSV or Parquet, holding one batch of rows in memory at a time.
+Rollups are small aggregate tables in analytics.db: analyses per report type
+per day, age/gender distribution and chat questions per day. The app updates
+them on every save, so the admin dashboard never scans the records.
+
+Usage:
+    python analytics.py export records.parquet [--since 2025-01-01] [--until 2025-02-01] [--fields ...]
+    python analytics.py export - --format jsonl --source user_medical_data.json
+    python analytics.py rollup [--rebuild]
+    python analytics.py report [--days 30]
+"""
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import threading
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+from dotenv import load_dotenv
+
+from storage import iter_json_array, open_store
+
+ANALYTICS_FILE = os.getenv('MEDASSIST_ANALYTICS_FILE', 'analytics.db')
+EXPORT_FIELDS = ('record_id', 'user_id', 'name', 'age', 'gender', 'report_type', 'timestamp', 'language',
+                 'analysis')
+EXPORT_FORMATS = ('jsonl', 'csv', 'parquet')
+# Rows per Parquet row group (and per rollup transaction)
+EXPORT_BATCH = 10000
+# Upper bounds of the age bands; older users fall in the last open band
+AGE_BANDS = ((18, '0-17'), (30, '18-29'), (45, '30-44'), (60, '45-59'), (75, '60-74'))
+
+
+def age_band(age):
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        return 'unknown'
+    for upper, label in AGE_BANDS:
+        if age < upper:
+            return label
+    return '75+'
+
+
+def record_day(record):
+    return (record.get('timestamp') or '')[:10] or 'unknown'
+
+
+class Rollups:
+    """Aggregate counts of the stored records in SQLite.
+
+    add_many() counts each record_id once, so records may be fed again (e.g.
+    by sync() after a batch run wrote to the store directly). A user is
+    counted in the demographics with the age and gender of their first
+    counted record. Chat questions are not stored as records and are only
+    counted from the time the rollups exist.
+    """
+
+    def __init__(self, path=ANALYTICS_FILE):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS counted_records (record_id TEXT PRIMARY KEY) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS counted_users (user_id TEXT PRIMARY KEY) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS daily_analyses (
+                day TEXT NOT NULL,
+                report_type TEXT NOT NULL,
+                analyses INTEGER NOT NULL,
+                PRIMARY KEY (day, report_type)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS demographics (
+                age_band TEXT NOT NULL,
+                gender TEXT NOT NULL,
+                analyses INTEGER NOT NULL DEFAULT 0,
+                users INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (age_band, gender)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS daily_chat (
+                day TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                questions INTEGER NOT NULL,
+                PRIMARY KEY (day, kind)
+            ) WITHOUT ROWID;
+        """)
+
+    def add(self, record):
+        return self.add_many([record])
+
+    def add_many(self, records):
+        """Count records not counted yet; returns how many were new"""
+        records = list({r['record_id']: r for r in records if r.get('record_id')}.values())
+        if not records:
+            return 0
+        with self._lock:
+            # The write lock is taken up front so two processes never both count a record
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                new = self._unseen('counted_records', 'record_id', [r['record_id'] for r in records])
+                records = [r for r in records if r['record_id'] in new]
+                self._conn.executemany('INSERT INTO counted_records VALUES (?)', [(i,) for i in new])
+                new_users = self._unseen('counted_users', 'user_id', [r.get('user_id') or '' for r in records])
+                self._conn.executemany('INSERT INTO counted_users VALUES (?)', [(u,) for u in new_users])
+
+                daily = Counter((record_day(r), r.get('report_type') or 'unknown') for r in records)
+                analyses = Counter()
+                users = Counter()
+                for r in records:
+                    group = (age_band(r.get('age')), r.get('gender') or 'unknown')
+                    analyses[group] += 1
+                    if (r.get('user_id') or '') in new_users:
+                        users[group] += 1
+                        new_users.discard(r.get('user_id') or '')
+                self._conn.executemany(
+                    'INSERT INTO daily_analyses VALUES (?, ?, ?) '
+                    'ON CONFLICT (day, report_type) DO UPDATE SET analyses = analyses + excluded.analyses',
+                    [(day, report_type, n) for (day, report_type), n in daily.items()]
+                )
+                self._conn.executemany(
+                    'INSERT INTO demographics VALUES (?, ?, ?, ?) ON CONFLICT (age_band, gender) '
+                    'DO UPDATE SET analyses = analyses + excluded.analyses, users = users + excluded.users',
+                    [(band, gender, n, users[(band, gender)]) for (band, gender), n in analyses.items()]
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return len(records)
+
+    def add_chat(self, kind, timestamp=None):
+        """Count one chat question of `kind` ('report' or 'skin')"""
+        day = (timestamp or datetime.now().isoformat())[:10]
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO daily_chat VALUES (?, ?, 1) '
+                'ON CONFLICT (day, kind) DO UPDATE SET questions = questions + 1',
+                (day, kind)
+            )
+
+    def sync(self, store, batch_size=EXPORT_BATCH):
+        """Count the stored records missing from the rollups; returns how many"""
+        added = 0
+        batch = []
+        for record in store.iter_records():
+            batch.append(record)
+            if len(batch) >= batch_size:
+                added += self.add_many(batch)
+                batch = []
+        return added + self.add_many(batch)
+
+    def reset(self):
+        """Forget the record counts. Chat question counts are kept: they can't
+        be recounted from the store."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            for table in ('counted_records', 'counted_users', 'daily_analyses', 'demographics'):
+                self._conn.execute(f'DELETE FROM {table}')
+            self._conn.execute('COMMIT')
+
+    def analyses_per_day(self, since=None):
+        """[(day, report_type, analyses)] from `since` (ISO date) on"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT day, report_type, analyses FROM daily_analyses WHERE day >= ? ORDER BY day, report_type',
+                (since or '',)
+            ).fetchall()
+
+    def demographics(self):
+        """[(age_band, gender, analyses, users)]"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT age_band, gender, analyses, users FROM demographics ORDER BY age_band, gender'
+            ).fetchall()
+
+    def chat_per_day(self, since=None):
+        """[(day, kind, questions)] from `since` (ISO date) on"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT day, kind, questions FROM daily_chat WHERE day >= ? ORDER BY day, kind', (since or '',)
+            ).fetchall()
+
+    def totals(self):
+        """Analyses, users and chat questions counted overall"""
+        with self._lock:
+            analyses, users = self._conn.execute(
+                'SELECT COALESCE(SUM(analyses), 0), COALESCE(SUM(users), 0) FROM demographics'
+            ).fetchone()
+            questions = self._conn.execute('SELECT COALESCE(SUM(questions), 0) FROM daily_chat').fetchone()[0]
+        return {'analyses': analyses, 'users': users, 'chat_questions': questions}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _unseen(self, table, column, keys):
+        keys = set(keys)
+        seen = set()
+        key_list = list(keys)
+        # Stay under SQLite's bound parameter limit
+        for i in range(0, len(key_list), 500):
+            chunk = key_list[i:i + 500]
+            seen.update(k for (k,) in self._conn.execute(
+                f"SELECT {column} FROM {table} WHERE {column} IN ({','.join('?' * len(chunk))})", chunk
+            ))
+        return keys - seen
+
+
+def iter_source(source=None):
+    """Records of the record store, or of a legacy JSON array file at `source`"""
+    if source:
+        yield from iter_json_array(source)
+        return
+    store = open_store()
+    try:
+        yield from store.iter_records()
+    finally:
+        store.close()
+
+
+def select_records(records, since=None, until=None):
+    """Records with since <= timestamp < until (ISO strings)"""
+    for record in records:
+        timestamp = record.get('timestamp') or ''
+        if since and timestamp < since:
+            continue
+        if until and timestamp >= until:
+            continue
+        yield record
+
+
+def export_records(records, out, fmt=None, fields=EXPORT_FIELDS, batch_size=EXPORT_BATCH):
+    """Stream `records` to the file `out` ('-' for stdout; not for Parquet).
+
+    The format is taken from the file extension unless given. Only `fields`
+    are written. Returns the number of records exported.
+    """
+    fmt = fmt or os.path.splitext(out)[1].lstrip('.').lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt!r} (use one of {', '.join(EXPORT_FORMATS)})")
+    rows = ({field: record.get(field) for field in fields} for record in records)
+    if fmt == 'parquet':
+        if out == '-':
+            raise ValueError("Parquet can't be written to stdout")
+        return _export_parquet(rows, out, fields, batch_size)
+
+    f = sys.stdout if out == '-' else open(out, 'w', encoding='utf-8', newline='')
+    try:
+        count = 0
+        if fmt == 'jsonl':
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+                count += 1
+        else:
+            writer = csv.DictWriter(f, fieldnames=list(fields))
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        return count
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+def _export_parquet(rows, out, fields, batch_size):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(field, pa.int64() if field == 'age' else pa.string()) for field in fields])
+
+    def column_value(field, value):
+        if field == 'age':
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return None
+        return value if value is None or isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+    count = 0
+    with pq.ParquetWriter(out, schema, compression='zstd') as writer:
+        batch = []
+        for row in rows:
+            batch.append({field: column_value(field, row[field]) for field in fields})
+            if len(batch) >= batch_size:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                count += len(batch)
+                batch = []
+        if batch or not count:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            count += len(batch)
+    return count
+
+
+def _print_report(rollups, days):
+    since = (date.today() - timedelta(days=days)).isoformat()
+    totals = rollups.totals()
+    print(f"{totals['analyses']} analyses by {totals['users']} users, {totals['chat_questions']} chat questions")
+    print(f"\nAnalyses per day since {since}:")
+    for day, report_type, analyses in rollups.analyses_per_day(since):
+        print(f"  {day}  {report_type:<16} {analyses:>7}")
+    print("\nAge / gender (analyses, users):")
+    for band, gender, analyses, users in rollups.demographics():
+        print(f"  {band:<8} {gender:<8} {analyses:>7} {users:>7}")
+    print(f"\nChat questions per day since {since}:")
+    for day, kind, questions in rollups.chat_per_day(since):
+        print(f"  {day}  {kind:<8} {questions:>7}")
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('export', help='stream records to JSONL, CSV or Parquet')
+    p.add_argument('out', help="output file, or '-' for stdout")
+    p.add_argument('--format', choices=EXPORT_FORMATS, help='default: from the file extension')
+    p.add_argument('--source', help='legacy JSON array file to read instead of the record store')
+    p.add_argument('--since', help='first timestamp included (ISO date or time)')
+    p.add_argument('--until', help='first timestamp excluded (ISO date or time)')
+    p.add_argument('--fields', default=','.join(EXPORT_FIELDS), help='comma-separated record fields')
+    p = sub.add_parser('rollup', help='count stored records missing from the rollups')
+    p.add_argument('--rebuild', action='store_true', help='recount all stored records from scratch')
+    p = sub.add_parser('report', help='print the rollups')
+    p.add_argument('--days', type=int, default=30)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        records = select_records(iter_source(args.source), args.since, args.until)
+        try:
+            count = export_records(records, args.out, args.format, args.fields.split(','))
+        except ValueError as e:
+            sys.exit(str(e))
+        print(f"Exported {count} records to {args.out}", file=sys.stderr)
+        sys.exit()
+
+    rollups = Rollups()
+    if args.command == 'rollup':
+        if args.rebuild:
+            rollups.reset()
+        store = open_store()
+        print(f"Counted {rollups.sync(store)} records")
+        store.close()
+    else:
+        _print_report(rollups, args.days)
+    rollups.close()
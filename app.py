@@ -1,48 +1,41 @@
 import streamlit as st
-import google.generativeai as genai
-from PIL import Image
-import os
-from dotenv import load_dotenv
+from datetime import datetime, timedelta
+import hashlib
+import hmac
 import json
-from datetime import datetime
+import os
+import threading
+import time
 import uuid
+from concurrent.futures.process import BrokenProcessPool
 
-# Load environment variables
-load_dotenv()
+from dotenv import load_dotenv
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-
-# Initialize the model
-model = genai.GenerativeModel('gemini-2.0-flash-exp')
-
-# Supported Indian languages
-LANGUAGES = {
-    'English': 'en',
-    'Hindi': 'hi',
-    'Telugu': 'te',
-    'Tamil': 'ta',
-    'Bengali': 'bn',
-    'Marathi': 'mr',
-    'Gujarati': 'gu',
-    'Kannada': 'kn',
-    'Malayalam': 'ml',
-    'Punjabi': 'pa'
-}
+import prompts
+from analytics import Rollups
+from cache import ResponseCache
+from chat import Conversation, estimate_image_tokens, estimate_tokens
+from dedup import ImageIndex
+from documents import (PAGES_PER_REQUEST, create_page_pool, format_page_notes, label_pages, notes_part,
+                       pack_pages, prepare_document, read_pages, unpack_pages)
+from executor import EMBED_MAX_WORKERS, EMBED_REQUESTS_PER_MINUTE, LLMExecutor, TokenBucket, describe_error
+from imaging import preprocess_image
+from jobs import JOB_POLL_SECONDS, JobQueue
+from knowledge import KnowledgeCache, format_context
+from labs import LabStore, parse_extraction, request_lab_values, result_timestamp
+from llm import create_model
+from prompts import LANGUAGES
+from quality import check as check_quality
+from sessions import SessionMemory, trim_chat_history
+from storage import open_store
+from telemetry import METRICS_PORT, Telemetry
+from translation import PIVOT_LANGUAGE, analysis_sha, translate_all, translation_prompt
+from vectors import HISTORY_VECTORS_PREFIX, VectorIndex, history_groups, record_text, sync_index
+
+# Load environment variables (archive key, admin password, ...) from .env
+load_dotenv()
 
 # Initialize session state
-if 'report_chat_history' not in st.session_state:
-    st.session_state.report_chat_history = []
-if 'skin_chat_history' not in st.session_state:
-    st.session_state.skin_chat_history = []
-if 'report_analysis' not in st.session_state:
-    st.session_state.report_analysis = None
-if 'skin_analysis' not in st.session_state:
-    st.session_state.skin_analysis = None
-if 'uploaded_report_image' not in st.session_state:
-    st.session_state.uploaded_report_image = None
-if 'uploaded_skin_image' not in st.session_state:
-    st.session_state.uploaded_skin_image = None
 if 'user_id' not in st.session_state:
     st.session_state.user_id = str(uuid.uuid4())
 
@@ -93,21 +86,30 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Helper Functions
+@st.cache_resource
+def get_model():
+    """Gemini model shared by all sessions, configured on first use"""
+    return create_model()
+
+@st.cache_resource
+def get_store():
+    """Shared append-only record store (see storage.py); old records are
+    compacted into the archive tier in the background when one is configured"""
+    store = open_store()
+    if hasattr(store, 'start_compaction'):
+        store.start_compaction()
+    return store
+
+@st.cache_resource
+def get_telemetry():
+    """Latency/token metrics shared by all sessions (see telemetry.py)"""
+    telemetry = Telemetry()
+    if METRICS_PORT:
+        telemetry.serve(METRICS_PORT)
+    return telemetry
+
 def save_user_data(user_id, name, age, gender, report_type, analysis, timestamp):
-    """Save user data to JSON file"""
-    data_file = 'user_medical_data.json'
-    
-    # Load existing data
-    if os.path.exists(data_file):
-        with open(data_file, 'r', encoding='utf-8') as f:
-            try:
-                all_data = json.load(f)
-            except json.JSONDecodeError:
-                all_data = []
-    else:
-        all_data = []
-    
-    # Create new entry
+    """Append one user record to the record store"""
     user_entry = {
         'user_id': user_id,
         'name': name,
@@ -117,20 +119,663 @@ def save_user_data(user_id, name, age, gender, report_type, analysis, timestamp)
         'analysis': analysis,
         'timestamp': timestamp
     }
-    
-    all_data.append(user_entry)
-    
-    # Save to file
-    with open(data_file, 'w', encoding='utf-8') as f:
-        json.dump(all_data, f, indent=4, ensure_ascii=False)
+    with get_telemetry().track('save'):
+        record_id = get_store().append(user_entry)
+    get_rollups().add(dict(user_entry, record_id=record_id))
+    index_history_record(dict(user_entry, record_id=record_id))
+    return record_id
+
+@st.cache_resource
+def get_rollups():
+    """Usage rollups for the admin dashboard (see analytics.py). Records
+    saved while the app wasn't counting are added in the background."""
+    rollups = Rollups()
+    threading.Thread(target=rollups.sync, args=(get_store(),), daemon=True).start()
+    return rollups
+
+@st.cache_resource
+def get_session_memory():
+    """Heavy per-session state of all sessions, spilled to disk when idle (see sessions.py)"""
+    memory = SessionMemory()
+    get_telemetry().register_gauges('sessions', memory.gauges)
+    return memory
+
+@st.cache_resource
+def get_lab_store():
+    """Structured lab results of all users (see labs.py)"""
+    return LabStore()
+
+@st.cache_resource
+def get_image_index():
+    """Perceptual hashes of analyzed uploads (see dedup.py)"""
+    return ImageIndex()
+
+@st.cache_resource
+def get_response_cache():
+    """Response cache shared by all sessions in this server process"""
+    return ResponseCache()
+
+@st.cache_resource
+def get_executor():
+    """Rate-limited worker pool shared by all sessions for model calls"""
+    return LLMExecutor()
+
+@st.cache_resource
+def get_embed_executor():
+    """Rate-limited pool for embedding calls, kept apart from get_executor()
+    so history indexing and lookups never queue up generation calls"""
+    return LLMExecutor(max_workers=EMBED_MAX_WORKERS, requests_per_minute=EMBED_REQUESTS_PER_MINUTE)
+
+@st.cache_resource
+def get_page_pool():
+    """Worker processes preparing the pages of report uploads (see documents.py)"""
+    return create_page_pool()
+
+@st.cache_resource
+def get_history_index():
+    """Embeddings of saved analyses for history search (see vectors.py).
+    Records saved before the index existed are embedded in the background."""
+    model = get_model()
+    executor = get_embed_executor()
+    # One index per embedding model: vectors of different models don't compare
+    index = VectorIndex(f'{HISTORY_VECTORS_PREFIX}.{model.embedding_model}')
+    # The backfill takes at most half the embedding rate, leaving the rest to searches and saves
+    backfill = TokenBucket(executor.bucket.rate / 2, capacity=1)
+
+    def embed(texts):
+        backfill.acquire()
+        return executor.submit(model.embed, texts, 'retrieval_document').result()
+
+    threading.Thread(target=sync_index, args=(index, get_store(), embed, history_groups), daemon=True).start()
+    return index
+
+def index_history_record(record):
+    """Embed a saved record for history search, off the script thread"""
+    index = get_history_index()
+    model = get_model()
+    get_embed_executor().submit(lambda: index.add_many(
+        [(record['record_id'], model.embed([record_text(record)])[0], history_groups(record))]
+    ))
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def embed_query(text, embedding_model):
+    """Embedding of a search query (keyed by model so a backend switch re-embeds)"""
+    return get_embed_executor().submit(get_model().embed, [text], 'retrieval_query').result()[0]
+
+@st.cache_resource
+def get_knowledge_cache():
+    """Answered medical queries of all users, matched by meaning (see knowledge.py)"""
+    return KnowledgeCache(get_model().embedding_model)
+
+def retrieve_knowledge(query, language):
+    """(earlier answer or None, related earlier answers, query embedding) from
+    the knowledge cache. Retrieval is skipped when disabled and fails open."""
+    if not st.session_state.get('use_knowledge_cache', True):
+        return None, [], None
+    try:
+        with get_telemetry().track('knowledge-lookup') as span:
+            vector = embed_query(query, get_model().embedding_model)
+            known, related = get_knowledge_cache().retrieve(vector, language)
+            span['cache_hit'] = known is not None
+    except Exception as e:
+        st.caption(f"Knowledge cache unavailable: {describe_error(e)}")
+        return None, [], None
+    return known, related, vector
+
+def search_history(query, k=5):
+    """[(similarity, record)] of the user's saved analyses closest to `query`"""
+    user_id = st.session_state.user_id
+    vector = embed_query(query, get_model().embedding_model)
+    matches = get_history_index().search(vector, f'user:{user_id}', k)
+    records = [(score, get_store().get_record(user_id, record_id)) for score, record_id in matches]
+    return [(score, record) for score, record in records if record is not None]
+
+def stream_text(template_id, prompt_parts, language, query='', image_sha=None, context='', timings=None,
+                request=None, on_wait=None, use_cache=None):
+    """Yield the model response chunk by chunk, serving repeated requests
+    from the response cache. Fills `timings` with time-to-first-token,
+    total latency in seconds and token usage when the API reports it.
+
+    `request` overrides how the streamed response is started (e.g. a chat
+    session); by default `prompt_parts` go to model.generate_content. The
+    request runs on the shared executor; `on_wait(position)` is called
+    while it is queued. `use_cache` defaults to the session's setting."""
+    timings = {} if timings is None else timings
+    cache = get_response_cache()
+    key = cache.make_key(template_id, language, query, image_sha, context)
+    start = time.perf_counter()
+    if use_cache is None:
+        use_cache = st.session_state.get('use_response_cache', True)
+    if use_cache:
+        cached = cache.get(key)
+        if cached is not None:
+            timings.update(ttft=time.perf_counter() - start, total=time.perf_counter() - start, cached=True)
+            yield cached
+            return
+    else:
+        cache.record_bypass()
+
+    if request is None:
+        request = lambda: get_model().generate_content(prompt_parts, stream=True)
+    chunks = []
+    for chunk in get_executor().stream(request).iter_chunks(on_wait=on_wait):
+        usage = getattr(chunk, 'usage_metadata', None)
+        if usage and usage.prompt_token_count:
+            timings.update(prompt_tokens=usage.prompt_token_count, response_tokens=usage.candidates_token_count)
+        if not chunk.parts:
+            continue
+        if not chunks:
+            timings['ttft'] = time.perf_counter() - start
+        chunks.append(chunk.text)
+        yield chunk.text
+    timings.update(total=time.perf_counter() - start, cached=False)
+    cache.set(key, ''.join(chunks))
+
+def run_model(template_id, prompt_parts, language, spinner_text, query='', image_sha=None, context='',
+              request=None, feature='model', image_bytes=0, stream=None):
+    """Run one model call, rendering the response incrementally when
+    streaming is enabled (or `stream` is True), and record it in telemetry
+    under `feature`. Returns (full text, timings)."""
+    timings = {}
+    status = st.empty()
+    on_wait = lambda position: status.info(f"⏳ Waiting in queue… position {position + 1}")
+    with get_telemetry().track(feature, template=template_id, image_bytes=image_bytes) as span:
+        chunks = stream_text(template_id, prompt_parts, language, query, image_sha, context, timings, request, on_wait)
+        if stream is None:
+            stream = st.session_state.get('stream_responses', True)
+        if stream:
+            text = st.write_stream(chunks)
+        else:
+            with st.spinner(spinner_text):
+                text = ''.join(chunks)
+        record_timings(span, timings)
+    status.empty()
+    return text, timings
+
+def record_timings(span, timings):
+    """Copy a model call's timings and token usage into its telemetry span"""
+    span.update(
+        cache_hit=timings.get('cached', False),
+        prompt_tokens=timings.get('prompt_tokens'),
+        response_tokens=timings.get('response_tokens'),
+        ttft_ms=timings['ttft'] * 1000 if 'ttft' in timings else None
+    )
+    if span['cache_hit']:
+        span['image_bytes'] = 0
 
-def display_chat_history(chat_history):
+def run_model_in_job(template_id, prompt_parts, language, progress, image_sha=None, context='',
+                     feature='model', image_bytes=0, use_cache=True):
+    """run_model for background jobs: no UI, the text so far goes to
+    `progress` as it streams in. Returns (full text, timings)."""
+    timings = {}
+    chunks = []
+    with get_telemetry().track(feature, template=template_id, image_bytes=image_bytes) as span:
+        for chunk in stream_text(template_id, prompt_parts, language, '', image_sha, context, timings,
+                                 use_cache=use_cache):
+            chunks.append(chunk)
+            progress(''.join(chunks))
+        record_timings(span, timings)
+    return ''.join(chunks), timings
+
+def get_conversation(kind, analysis, image):
+    """Follow-up chat for the current analysis, restarted when it changes"""
+    state_key = f'{kind}_conversation'
+    conversation = session_data.get(state_key)
+    if conversation is None or not conversation.matches(analysis, image):
+        conversation = Conversation(kind, analysis, image, session_data.get(f'{kind}_page_notes'))
+        session_data[state_key] = conversation
+    return conversation
+
+def format_accounting(entry):
+    """One-line input token accounting for a chat turn"""
+    line = (f"🔁 {entry['input_tokens']:,} input tokens vs ≈{entry['legacy_input_tokens']:,} "
+            f"re-sending analysis + image ({entry['tokens_saved']:+,} saved)")
+    if entry['upload_bytes_saved']:
+        line += f" · image not re-uploaded ({entry['upload_bytes_saved'] / 1024:,.0f} KB saved)"
+    return line
+
+def format_timings(timings):
+    """One-line latency summary for a model call"""
+    if not timings:
+        return ""
+    if timings.get('cached'):
+        return f"⚡ Served from cache in {timings['total'] * 1000:.0f} ms"
+    return f"⏱️ First token {timings.get('ttft', timings['total']):.1f} s · total {timings['total']:.1f} s"
+
+def request_report_labs(image, notes=None, use_cache=True):
+    """JSON lab values of a report from a JSON-schema call (cached unless
+    `use_cache` is off). A long report is read from its page notes rather
+    than its images."""
+    cache = get_response_cache()
+    pages = getattr(image, 'pages', [image])
+    if notes:
+        parts, image_bytes = [notes_part(notes)], 0
+    else:
+        parts = label_pages([page.as_part() for page in pages])
+        image_bytes = sum(len(page.data) for page in pages)
+    key = cache.make_key(prompts.LAB_EXTRACTION, '', image_sha=image.sha256)
+    with get_telemetry().track('lab-extraction', image_bytes=image_bytes) as span:
+        text = cache.get(key) if use_cache else None
+        if not use_cache:
+            cache.record_bypass()
+        span['cache_hit'] = text is not None
+        if text is None:
+            text = get_executor().submit(request_lab_values, get_model(), parts).result()
+            cache.set(key, text)
+        else:
+            span['image_bytes'] = 0
+    return text
+
+def store_report_labs(text, record_id, timestamp):
+    """Parse extracted lab values, storing them for trend charts when the
+    analysis was saved"""
+    rows, report_date = parse_extraction(text)
+    if record_id and rows:
+        get_lab_store().add(st.session_state.user_id, record_id, result_timestamp(report_date, timestamp), rows)
+    return rows
+
+def prepare_upload(uploaded_file, kind):
+    """Preprocess an uploaded image once; reruns reuse the stored result
+    (only the compressed payload and thumbnail are kept per session)"""
+    state_key = f'uploaded_{kind}_image'
+    upload_id = getattr(uploaded_file, 'file_id', None) or f"{uploaded_file.name}:{uploaded_file.size}"
+    if session_data.get(state_key) is None or session_data.get(f'{state_key}_id') != upload_id:
+        data = uploaded_file.getvalue()
+        with get_telemetry().track('image-preprocess', image_bytes=len(data)) as span:
+            session_data[state_key] = preprocess_image(data)
+            span['payload_bytes'] = len(session_data[state_key].data)
+        session_data[f'{state_key}_id'] = upload_id
+        record_image_quality(session_data[state_key], kind)
+    return session_data[state_key]
+
+def prepare_report_upload(uploaded_files):
+    """prepare_upload for the report uploader: image files and PDFs prepared
+    as one document, pages in the page pool. Raises ValueError for a file
+    that can't be read."""
+    state_key = 'uploaded_report_image'
+    upload_id = tuple(getattr(f, 'file_id', None) or f"{f.name}:{f.size}" for f in uploaded_files)
+    if session_data.get(state_key) is None or session_data.get(f'{state_key}_id') != upload_id:
+        files = [(f.name, f.getvalue()) for f in uploaded_files]
+        with get_telemetry().track('image-preprocess', image_bytes=sum(len(data) for _, data in files)) as span:
+            try:
+                document = prepare_document(files, get_page_pool())
+            except BrokenProcessPool:
+                # A worker died (e.g. out of memory); start a fresh pool for the next upload
+                get_page_pool.clear()
+                raise
+            span.update(payload_bytes=document.payload_bytes, pages=len(document.pages))
+        session_data[state_key] = document
+        session_data[f'{state_key}_id'] = upload_id
+        for page in document.pages:
+            record_image_quality(page, 'report')
+    return session_data[state_key]
+
+def record_image_quality(image, kind):
+    """Record the quality scores and verdict of an uploaded image or page"""
+    problems = check_quality(image.quality, kind)
+    get_telemetry().record('image-quality', dict(
+        image.quality, kind=kind, wall_ms=image.quality_ms,
+        verdict='block' if any(s == 'block' for s, _ in problems) else 'warn' if problems else 'ok'
+    ))
+
+def quality_gate(kind, image):
+    """Show quality problems of an upload; returns False while a blocking
+    problem stops the analysis (the user can still override it). Problems
+    of a multi-page report name the pages they were found on."""
+    pages = getattr(image, 'pages', [image])
+    labels = getattr(image, 'labels', [None])
+    problems = {}
+    for page, label in zip(pages, labels):
+        for problem in check_quality(page.quality, kind):
+            problems.setdefault(problem, []).append(label)
+    for (severity, message), found_on in problems.items():
+        if len(pages) > 1:
+            message = f"{message} ({', '.join(found_on)})"
+        if severity == 'block':
+            st.error(f"🚫 {message}")
+        else:
+            st.warning(f"⚠️ {message}")
+    if not any(severity == 'block' for severity, _ in problems):
+        return True
+    return st.checkbox("Analyze anyway", key=f"{kind}_quality_override",
+                       help="The result is likely to be unreliable for this image")
+
+def find_previous_analysis(kind, image):
+    """Stored analysis of an earlier, near-identical upload by this user, or None"""
+    if image.phash is None:
+        # Multi-page reports have no perceptual hash
+        return None
+    with get_telemetry().track('duplicate-lookup') as span:
+        match = get_image_index().find(st.session_state.user_id, kind, image.phash)
+        record = match and get_store().get_record(st.session_state.user_id, match['record_id'])
+        span['cache_hit'] = bool(record)
+    if not record or record['analysis'] == session_data[f'{kind}_analysis']:
+        return None
+    return dict(record, distance=match['distance'])
+
+def offer_previous_analysis(kind, image):
+    """Let the user reuse the analysis of a near-duplicate earlier upload"""
+    previous = find_previous_analysis(kind, image)
+    if previous is None:
+        return
+    st.info(
+        f"🔁 This looks like an image you analyzed on {previous['timestamp'][:16].replace('T', ' ')} "
+        f"({previous['distance']}/64 bits differ)."
+    )
+    if st.button("♻️ Use previous analysis", key=f"reuse_{kind}_analysis", use_container_width=True):
+        session_data[f'{kind}_analysis'] = previous['analysis']
+        session_data[f'{kind}_chat_history'] = []
+        session_data[f'{kind}_chat_dropped'] = 0
+        session_data[f'{kind}_conversation'] = None
+        session_data[f'{kind}_pivot'] = None
+        session_data[f'{kind}_translations'] = None
+        if kind == 'report':
+            session_data.report_lab_values = None
+            session_data.report_page_notes = None
+            session_data.report_page_calls = None
+        st.rerun()
+
+def admin_password():
+    """MEDASSIST_ADMIN_PASSWORD; without it there is no Admin tab"""
+    return os.getenv('MEDASSIST_ADMIN_PASSWORD')
+
+def admin_unlocked():
+    """Ask for the admin password once per session; True once it was entered"""
+    if st.session_state.get('admin_unlocked'):
+        return True
+    password = st.text_input("Admin password", type="password", key="admin_password_input")
+    if password and hmac.compare_digest(password.encode('utf-8'), admin_password().encode('utf-8')):
+        st.session_state.admin_unlocked = True
+        return True
+    if password:
+        st.error("Wrong password")
+    return False
+
+def add_chat_message(kind, message):
+    """Append a chat message, keeping the history within the per-session caps"""
+    history = session_data[f'{kind}_chat_history']
+    history.append(message)
+    if message['role'] == 'user':
+        get_rollups().add_chat(kind)
+    session_data[f'{kind}_chat_dropped'] += trim_chat_history(history)
+
+@st.cache_resource
+def get_job_queue():
+    """Persistent queue of image analyses shared by all sessions (see jobs.py)"""
+    queue = JobQueue()
+    queue.register('analysis', analysis_job)
+    queue.start()
+    return queue
+
+def read_report_pages(pages, progress, use_cache=True):
+    """Map step of a long report: notes of every page, read concurrently
+    (see documents.read_pages). Returns (notes, calls)."""
+    on_page = lambda done, total: progress(f"📄 Reading the report page by page… {done} of {total} pages")
+    notes, calls = read_pages(get_model(), get_response_cache(), get_executor(), pages, on_page, use_cache)
+    for page, call in zip(pages, calls):
+        get_telemetry().record('report-page', {
+            'wall_ms': call['seconds'] * 1000,
+            'cache_hit': call['cached'],
+            'prompt_tokens': call['input_tokens'],
+            'image_bytes': 0 if call['cached'] else len(page.data),
+        })
+    return notes, calls
+
+def analysis_job(params, payload, progress):
+    """Job handler: analyze an uploaded image or report (see submit_analysis).
+
+    With translate-once enabled, the image is analyzed in PIVOT_LANGUAGE
+    (cached like any analysis) and only a text translation runs for the
+    requested language. A report of several pages is analyzed in one
+    request; one of more than PAGES_PER_REQUEST pages is first read page by
+    page and the notes are analyzed together.
+    """
+    kind, language = params['kind'], params['language']
+    image = unpack_pages(params['pages'], payload)
+    pages = getattr(image, 'pages', [image])
+    analysis_language = PIVOT_LANGUAGE if params['translate_once'] else language
+    notes, calls = None, None
+    context = ''
+    if len(pages) > PAGES_PER_REQUEST:
+        notes, calls = read_report_pages(pages, progress, params['use_cache'])
+        template_id = prompts.REPORT_NOTES
+        notes_text = format_page_notes(notes)
+        prompt = prompts.build_prompt(template_id, language=analysis_language, pages=len(pages), notes=notes_text)
+        prompt_parts = [prompt]
+        # The notes are the whole input; the key follows them (and the pages they came from)
+        context = analysis_sha(notes_text)
+    elif len(pages) > 1:
+        template_id = prompts.REPORT_PAGES
+        prompt = prompts.build_prompt(template_id, language=analysis_language, pages=len(pages))
+        prompt_parts = [prompt] + label_pages([page.as_part() for page in pages])
+    else:
+        template_id = params['template_id']
+        prompt = prompts.build_prompt(template_id, language=analysis_language)
+        prompt_parts = [prompt, pages[0].as_part()]
+    text, timings = run_model_in_job(
+        template_id,
+        prompt_parts,
+        analysis_language,
+        progress,
+        image_sha=image.sha256,
+        context=context,
+        feature=kind,
+        image_bytes=0 if notes else sum(len(page.data) for page in pages),
+        use_cache=params['use_cache']
+    )
+    image_tokens = 0 if notes else sum(estimate_image_tokens(page.width, page.height) for page in pages)
+    result = {
+        'text': text,
+        'timings': timings,
+        'savings': None,
+        'pivot': {
+            'text': text,
+            'language': analysis_language,
+            'seconds': None if timings.get('cached') else timings['total'],
+            'input_tokens': timings.get('prompt_tokens') or estimate_tokens(prompt) + image_tokens,
+        },
+        'labs': None,
+        'page_count': len(pages),
+        'notes': notes,
+        'pages': calls,
+    }
+    if analysis_language != language:
+        result['text'], result['timings'] = run_model_in_job(
+            prompts.TRANSLATION,
+            translation_prompt(text, language),
+            language,
+            progress,
+            context=analysis_sha(text),
+            feature='translation',
+            use_cache=params['use_cache']
+        )
+        result['savings'] = format_translation_savings(result['pivot'], result['timings'],
+                                                       translation_prompt(text, language))
+    if params.get('extract_labs'):
+        progress(result['text'] + "\n\n🧪 Extracting lab values...")
+        result['labs'] = request_report_labs(image, notes, params['use_cache'])
+    return result
+
+def submit_analysis(kind, template_id, language, extract_labs=False):
+    """Queue the analysis of the session's uploaded image for `kind`.
+
+    The job belongs to this user and its id is kept in the session, so the
+    result is picked up after reruns. The page URL gets a token signed for
+    this session (JobQueue.token), which lets the session of a reloaded page
+    take the job over. Identical pending requests of the user (same image,
+    language and options) share one job.
+    """
+    image = session_data[f'uploaded_{kind}_image']
+    params = {
+        'kind': kind,
+        'template_id': template_id,
+        'language': language,
+        'translate_once': bool(st.session_state.get('translate_once')),
+        'extract_labs': extract_labs,
+        'use_cache': st.session_state.get('use_response_cache', True),
+    }
+    key = hashlib.sha256(json.dumps(dict(params, image=image.sha256), sort_keys=True).encode('utf-8')).hexdigest()
+    # The pages go to the queue as raw bytes plus JSON metadata, never pickled
+    params['pages'], payload = pack_pages(image)
+    job_id, _ = get_job_queue().submit('analysis', key, params, payload, owner=st.session_state.user_id)
+    session_data[f'{kind}_job'] = job_id
+    st.query_params[f'{kind}_job'] = get_job_queue().token(job_id, st.session_state.user_id)
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress(job_id):
+    """Progress of a pending job, refreshed on its own without rerunning the
+    rest of the page; reruns the app once the job finishes"""
+    job = get_job_queue().get(job_id, owner=st.session_state.user_id)
+    if job is None or job['status'] not in ('queued', 'running'):
+        st.rerun()
+    if job['progress']:
+        st.markdown(job['progress'])
+    elif job['status'] == 'queued':
+        st.info(f"⏳ Waiting in queue… position {job['position'] + 1}")
+    else:
+        st.info("🔬 Analyzing… you can keep using the app, the result will appear here")
+
+def follow_analysis(kind):
+    """This session's analysis of `kind` once it has finished, or None.
+
+    While the job is pending its progress is shown by show_job_progress and
+    None is returned, so the rest of the page renders right away. A rerun
+    (any widget interaction) doesn't stop the job. After a page reload the
+    job is taken over with the signed token in the URL; the upload itself
+    is not restored.
+    """
+    queue = get_job_queue()
+    job_id = session_data.get(f'{kind}_job')
+    if not job_id and f'{kind}_job' in st.query_params:
+        job_id = queue.resume(st.query_params[f'{kind}_job'], st.session_state.user_id)
+        if job_id:
+            session_data[f'{kind}_job'] = job_id
+            st.query_params[f'{kind}_job'] = queue.token(job_id, st.session_state.user_id)
+    if not job_id:
+        if f'{kind}_job' in st.query_params:
+            del st.query_params[f'{kind}_job']
+        return None
+    job = queue.get(job_id, owner=st.session_state.user_id)
+    if job is not None and job['status'] in ('queued', 'running'):
+        show_job_progress(job_id)
+        return None
+    session_data[f'{kind}_job'] = None
+    if f'{kind}_job' in st.query_params:
+        del st.query_params[f'{kind}_job']
+    return job
+
+def apply_analysis(kind, job, report_type, success_message):
+    """Show a finished analysis job in this session and save it for the user.
+    Returns (record_id, timestamp); record_id is None when nothing was saved."""
+    if job['status'] == 'failed':
+        st.error(f"❌ Error analyzing {report_type.lower()}: {job['error']}")
+        return None, None
+    result = job['result']
+    session_data[f'{kind}_analysis'] = result['text']
+    session_data[f'{kind}_pivot'] = result['pivot']
+    session_data[f'{kind}_translations'] = None
+    if kind == 'report':
+        session_data.report_page_notes = result.get('notes')
+        session_data.report_page_calls = result.get('pages')
+
+    record_id = None
+    timestamp = datetime.now().isoformat()
+    if user_name:
+        record_id = save_user_data(
+            user_id=st.session_state.user_id,
+            name=user_name,
+            age=user_age,
+            gender=user_gender,
+            report_type=report_type,
+            analysis=result['text'],
+            timestamp=timestamp
+        )
+        image = session_data.get(f'uploaded_{kind}_image')
+        if image is not None and image.phash is not None:
+            get_image_index().add(st.session_state.user_id, kind, image.phash, record_id, timestamp)
+
+    st.success(success_message)
+    st.caption(format_timings(result['timings']))
+    if result.get('notes'):
+        cached = sum(call['cached'] for call in result['pages'])
+        st.caption(f"📄 {result['page_count']} pages read one by one ({cached} from cache), then analyzed together")
+    elif result.get('page_count', 1) > 1:
+        st.caption(f"📄 {result['page_count']} pages analyzed in one request")
+    if result['savings']:
+        st.caption(result['savings'])
+    return record_id, timestamp
+
+def format_translation_savings(pivot, timings, prompt):
+    """Cost of a translation compared with re-analyzing the image in the target language"""
+    input_tokens = 0 if timings.get('cached') else timings.get('prompt_tokens') or estimate_tokens(prompt)
+    line = (f"🌐 Analyzed in {pivot['language']}, then translated: {timings['total']:.1f} s, "
+            f"≈{input_tokens:,} input tokens vs ≈{pivot['input_tokens']:,} to re-analyze the image")
+    if pivot['seconds'] is not None:
+        line += f" (≈{pivot['seconds']:.1f} s)"
+    else:
+        line += f" ({pivot['language']} analysis reused from cache)"
+    return line
+
+def show_all_languages(kind):
+    """Translate the last analysis into every language concurrently and show them in tabs"""
+    pivot = session_data[f'{kind}_pivot']
+    if not pivot:
+        return
+    if st.button("🌐 Show in all languages", key=f"{kind}_all_languages", use_container_width=True):
+        languages = [language for language in LANGUAGES if language != pivot['language']]
+        try:
+            with st.spinner(f"🌐 Translating into {len(languages)} languages..."):
+                with get_telemetry().track('translation-fanout', languages=len(languages)) as span:
+                    results, wall = translate_all(
+                        get_model(), get_response_cache(), get_executor(), pivot['text'], languages,
+                        use_cache=st.session_state.get('use_response_cache', True)
+                    )
+                    span['prompt_tokens'] = sum(r['input_tokens'] for r in results.values())
+            session_data[f'{kind}_translations'] = {'results': results, 'wall': wall}
+        except Exception as e:
+            st.error(f"❌ Error translating: {describe_error(e)}")
+    translations = session_data[f'{kind}_translations']
+    if translations:
+        results = translations['results']
+        tabs = st.tabs([pivot['language']] + list(results))
+        tabs[0].markdown(pivot['text'])
+        for tab, result in zip(tabs[1:], results.values()):
+            tab.markdown(result['text'])
+        regenerate = f"≈{len(results) * pivot['input_tokens']:,} input tokens"
+        if pivot['seconds'] is not None:
+            regenerate += f", ≈{len(results) * pivot['seconds']:.0f} s one after another"
+        st.caption(
+            f"🌐 {len(results)} translations in {translations['wall']:.1f} s "
+            f"({sum(r['cached'] for r in results.values())} from cache), "
+            f"≈{sum(r['input_tokens'] for r in results.values()):,} input tokens · "
+            f"{len(results)} full image analyses: {regenerate}"
+        )
+
+def display_chat_history(chat_history, dropped=0):
     """Display chat messages"""
+    if dropped:
+        st.caption(f"🗃️ {dropped} earlier messages are no longer shown.")
     for message in chat_history:
         if message['role'] == 'user':
             st.markdown(f'<div class="chat-message user-message">👤 <strong>You:</strong><br>{message["content"]}</div>', unsafe_allow_html=True)
         else:
             st.markdown(f'<div class="chat-message assistant-message">🤖 <strong>Assistant:</strong><br>{message["content"]}</div>', unsafe_allow_html=True)
+            if message.get('timings'):
+                st.caption(format_timings(message['timings']))
+            if message.get('accounting'):
+                st.caption(format_accounting(message['accounting']))
+
+# Images, analyses and chats live in the session memory manager rather than
+# st.session_state, so idle sessions can be spilled to disk
+session_data = get_session_memory().session(st.session_state.user_id)
+for key in ('report_analysis', 'skin_analysis', 'uploaded_report_image', 'uploaded_skin_image',
+            'report_lab_values', 'report_conversation', 'skin_conversation',
+            'report_pivot', 'skin_pivot', 'report_translations', 'skin_translations',
+            'report_job', 'skin_job', 'report_page_notes', 'report_page_calls'):
+    session_data.setdefault(key, None)
+for kind in ('report', 'skin'):
+    session_data.setdefault(f'{kind}_chat_history', [])
+    session_data.setdefault(f'{kind}_chat_dropped', 0)
 
 # Header
 st.markdown('<h1 class="main-header">🏥 Medical Assistant Bot</h1>', unsafe_allow_html=True)
@@ -144,13 +789,82 @@ with st.sidebar:
         options=list(LANGUAGES.keys()),
         index=0
     )
+    st.checkbox(
+        "Read from the response cache",
+        value=True,
+        key="use_response_cache",
+        help="Serve repeated questions and re-analyzed images from the response cache instead of calling the model "
+             "again. Unticked, the model is always called; new responses are still stored in the cache."
+    )
+    st.checkbox(
+        "Answer repeated questions from earlier answers",
+        value=True,
+        key="use_knowledge_cache",
+        help="Match medical queries by meaning against earlier answers in the same language: "
+             "return a near-identical question's answer directly, or give related answers to the model as context"
+    )
+    st.checkbox(
+        f"Analyze images in {PIVOT_LANGUAGE}, then translate",
+        value=False,
+        key="translate_once",
+        help="Run the image analysis once and produce other languages with a cheaper text-only translation"
+    )
+    st.checkbox(
+        "Stream responses",
+        value=True,
+        key="stream_responses",
+        help="Show answers as they are generated instead of waiting for the full response"
+    )
+    cache_stats = get_response_cache().stats
+    running, waiting = get_executor().load()
+    st.caption(
+        f"Cache: {cache_stats['memory_hits'] + cache_stats['disk_hits']} hits · "
+        f"{cache_stats['misses']} misses · {cache_stats['bypassed']} bypassed  \n"
+        f"Model requests: {running} running · {waiting} queued"
+    )
     
     st.markdown("---")
     st.header("👤 User Information")
     user_name = st.text_input("Name / नाम", placeholder="Enter your name")
     user_age = st.number_input("Age / उम्र", min_value=1, max_value=120, value=25)
     user_gender = st.selectbox("Gender / लिंग", ["Male", "Female", "Other"])
-    
+
+    st.markdown("---")
+    st.header("🗂️ My History")
+    history_query = st.text_input(
+        "🔎 Search my history",
+        placeholder="e.g. thyroid results, rash on arm",
+        key="history_query"
+    )
+    if history_query:
+        try:
+            with get_telemetry().track('history_search'):
+                matches = search_history(history_query)
+        except Exception as e:
+            st.error(f"❌ Search failed: {describe_error(e)}")
+            matches = []
+        for score, entry in matches:
+            with st.expander(f"{score:.0%} · {entry['report_type']} · {entry['timestamp'][:16].replace('T', ' ')}"):
+                st.markdown(entry['analysis'])
+        if not matches:
+            st.caption("No matching analyses.")
+    history_type = st.selectbox(
+        "Filter by type",
+        ["All", "Medical Query", "Medical Report", "Skin Condition"],
+        key="history_type"
+    )
+    history = get_store().get_history(
+        st.session_state.user_id,
+        report_type=None if history_type == "All" else history_type,
+        limit=20
+    )
+    if history:
+        for entry in history:
+            with st.expander(f"{entry['report_type']} · {entry['timestamp'][:16].replace('T', ' ')}"):
+                st.markdown(entry['analysis'])
+    else:
+        st.caption("No saved analyses yet. Enter your name to save your results.")
+
     st.markdown("---")
     st.markdown("### 📋 Features")
     st.markdown("""
@@ -164,8 +878,11 @@ with st.sidebar:
     st.markdown("---")
     st.warning("⚠️ **Disclaimer**: This is an AI assistant and not a replacement for professional medical advice.")
 
-# Main content tabs
-tab1, tab2, tab3 = st.tabs(["💬 Medical Queries", "📄 Report Analysis", "🔍 Skin Disease Detection"])
+# Main content tabs; the Admin tab (population-wide usage and metrics) only exists with an admin password
+tab_names = ["💬 Medical Queries", "📄 Report Analysis", "🔍 Skin Disease Detection"]
+if admin_password():
+    tab_names.append("📈 Admin")
+tab1, tab2, tab3, *admin_tab = st.tabs(tab_names)
 
 # Tab 1: Medical Query Summarization
 with tab1:
@@ -183,46 +900,60 @@ with tab1:
         summarize_btn = st.button("🔍 Summarize Query", key="summarize")
     
     if summarize_btn and query:
-        with st.spinner("Analyzing your query..."):
-            try:
-                prompt = f"""You are an expert medical assistant. Analyze and summarize the following medical query 
-                and provide a comprehensive, accurate, and easy-to-understand response in {selected_language} language.
-                
-                Structure your response as follows:
-                1. **Understanding the Query**: Brief clarification of what's being asked
-                2. **Key Information**: Main facts and important points (3-5 bullet points)
-                3. **Detailed Explanation**: Comprehensive explanation in simple terms
-                4. **Important Considerations**: Things to keep in mind
-                5. **When to Seek Medical Help**: Red flags or situations requiring immediate attention
-                6. **Recommendation**: Always advise consulting healthcare professionals
-                
-                Query: {query}
-                
-                Provide the complete response in {selected_language} language with clear formatting."""
-                
-                response = model.generate_content(prompt)
-                # Save user data for medical query
-                if user_name:
-                    save_user_data(
-                        user_id=st.session_state.user_id,
-                        name=user_name,
-                        age=user_age,
-                        gender=user_gender,
-                        report_type="Medical Query",
-                        analysis=f"Query: {query}\n\nResponse: {response.text}",
-                        timestamp=datetime.now().isoformat()
+        try:
+            st.markdown('<div class="analysis-box">', unsafe_allow_html=True)
+            st.markdown("### 📋 Medical Query Response:")
+            known, related, query_vector = retrieve_knowledge(query, selected_language)
+            if known is not None:
+                response_text = known['answer']
+                st.markdown(response_text)
+                st.success("✅ Answered from an earlier question")
+                st.caption(f"💡 Matched an earlier question ({known['similarity']:.0%} similar) · no model call")
+            else:
+                if related:
+                    # Ground the answer on related earlier answers
+                    template_id = prompts.QUERY_GROUNDED
+                    prompt = prompts.build_prompt(
+                        template_id, language=selected_language, query=query, context=format_context(related)
                     )
-                
-                
-                st.markdown('<div class="analysis-box">', unsafe_allow_html=True)
+                    context = ','.join(e['entry_id'] for e in related)
+                else:
+                    template_id = prompts.QUERY_SUMMARY
+                    prompt = prompts.build_prompt(template_id, language=selected_language, query=query)
+                    context = ''
+                response_text, timings = run_model(
+                    template_id,
+                    prompt,
+                    selected_language,
+                    "Analyzing your query...",
+                    query=query,
+                    context=context,
+                    feature='query'
+                )
                 st.success("✅ Summary Generated Successfully")
-                st.markdown("### 📋 Medical Query Response:")
-                st.markdown(response.text)
-                st.markdown('</div>', unsafe_allow_html=True)
-                
-            except Exception as e:
-                st.error(f"❌ Error: {str(e)}")
-                st.info("💡 Please check your GEMINI_API_KEY in the .env file")
+                caption = format_timings(timings)
+                if related:
+                    caption += f" · grounded on {len(related)} earlier answer{'s' if len(related) > 1 else ''}"
+                st.caption(caption)
+                if query_vector is not None:
+                    get_knowledge_cache().add(query, selected_language, response_text, query_vector)
+            st.markdown('</div>', unsafe_allow_html=True)
+
+            # Save user data for medical query
+            if user_name:
+                save_user_data(
+                    user_id=st.session_state.user_id,
+                    name=user_name,
+                    age=user_age,
+                    gender=user_gender,
+                    report_type="Medical Query",
+                    analysis=f"Query: {query}\n\nResponse: {response_text}",
+                    timestamp=datetime.now().isoformat()
+                )
+            
+        except Exception as e:
+            st.error(f"❌ Error: {describe_error(e)}")
+            st.info("💡 Please check your GEMINI_API_KEY in the .env file")
 
 # Tab 2: Medical Report Analysis with Chat
 with tab2:
@@ -233,115 +964,132 @@ with tab2:
     
     with col1:
         st.info("📸 **Tip**: Upload clear, high-resolution images for best results")
-        uploaded_file = st.file_uploader(
-            "Upload Medical Report Image",
-            type=['png', 'jpg', 'jpeg'],
-            help="Upload lab results, X-rays, CT scans, MRI reports, or any medical document",
+        uploaded_files = st.file_uploader(
+            "Upload Medical Report Images or PDF",
+            type=['png', 'jpg', 'jpeg', 'pdf'],
+            accept_multiple_files=True,
+            help="Upload lab results, X-rays, CT scans, MRI reports, or any medical document. "
+                 "Several images or a PDF are analyzed together as one report",
             key="report_uploader"
         )
         
-        if uploaded_file:
-            image = Image.open(uploaded_file)
-            max_display_size = (400, 400)
-            image.thumbnail(max_display_size, Image.Resampling.LANCZOS)
-            st.image(image, caption="Uploaded Medical Report", use_column_width=True)
-            
-            # Store the uploaded image in session state
-            st.session_state.uploaded_report_image = Image.open(uploaded_file)
+        report_document = None
+        if uploaded_files:
+            # Decode once per upload; session state keeps only the compact payloads and thumbnails
+            try:
+                report_document = prepare_report_upload(uploaded_files)
+            except Exception as e:
+                st.error(f"❌ {e}")
+        if report_document:
+            pages = report_document.pages
+            if len(pages) == 1:
+                st.image(pages[0].thumbnail, caption="Uploaded Medical Report", use_column_width=True)
+            else:
+                shown = pages[:12]
+                grid = st.columns(4)
+                for i, page in enumerate(shown):
+                    grid[i % 4].image(page.thumbnail, caption=report_document.labels[i], use_column_width=True)
+                if len(pages) > len(shown):
+                    st.caption(f"+{len(pages) - len(shown)} more pages")
+            st.caption(f"📦 {report_document.summary()}")
+            if len(pages) > 1 or report_document.duplicates:
+                with st.expander("⏱️ Per-page timings"):
+                    st.dataframe(
+                        [{'page': t['page'], 'render ms': round(t['render_ms'], 1), 'decode ms': round(t['decode_ms'], 1),
+                          'quality ms': round(t['quality_ms'], 1), 'encode ms': round(t['encode_ms'], 1),
+                          'total ms': round(t['total_ms'], 1)} for t in report_document.timings],
+                        use_container_width=True
+                    )
+                    for duplicate, kept in report_document.duplicates:
+                        st.caption(f"♻️ {duplicate} is identical to {kept} and was skipped")
     
     with col2:
-        if uploaded_file:
-            analyze_btn = st.button("📊 Analyze Medical Report", key="analyze_report", use_container_width=True)
+        if report_document:
+            offer_previous_analysis('report', session_data.uploaded_report_image)
+            quality_ok = quality_gate('report', session_data.uploaded_report_image)
+            analyze_btn = st.button("📊 Analyze Medical Report", key="analyze_report", use_container_width=True,
+                                    disabled=not quality_ok)
+            extract_labs = st.checkbox(
+                "🧪 Extract lab values for trend tracking",
+                value=True,
+                key="extract_lab_values",
+                help="Also pull test results out as structured data so they can be charted over time"
+            )
             
             if analyze_btn:
-                with st.spinner("🔬 Analyzing medical report... Please wait..."):
+                try:
+                    submit_analysis('report', prompts.REPORT_ANALYSIS, selected_language, extract_labs)
+                except Exception as e:
+                    st.error(f"❌ Error analyzing report: {describe_error(e)}")
+
+        # Runs in the background; survives reruns and page reloads
+        report_job = follow_analysis('report')
+        if report_job:
+            record_id, timestamp = apply_analysis(
+                'report', report_job, "Medical Report", "✅ Medical Report Analysis Complete"
+            )
+            if report_job['status'] == 'done':
+                session_data.report_lab_values = None
+                if report_job['result']['labs']:
                     try:
-                        prompt = f"""You are an expert medical report analyzer. Carefully examine this medical report image 
-                        and provide a comprehensive, detailed analysis in {selected_language} language.
-                        
-                        Provide your analysis in the following structured format:
-                        
-                        ## 📋 Report Type Identification
-                        - Identify what type of medical report this is (Lab test, X-ray, CT scan, MRI, Prescription, etc.)
-                        - Date of report (if visible)
-                        - Issuing hospital/lab (if visible)
-                        
-                        ## 🔍 Detailed Findings
-                        Extract and list ALL visible information:
-                        - Test names with their values
-                        - Normal reference ranges
-                        - Units of measurement
-                        - Any flags (High/Low/Critical)
-                        
-                        ## 📊 Parameter Analysis
-                        For each test result, provide:
-                        - What the test measures
-                        - Normal range explanation
-                        - Current value interpretation (Normal/Abnormal)
-                        - Clinical significance
-                        
-                        ## 💡 Medical Interpretation
-                        - What do these results indicate overall?
-                        - Patterns or correlations between parameters
-                        - Possible health implications
-                        - Body systems affected
-                        
-                        ## ⚠️ Areas of Concern
-                        - Any abnormal values requiring attention
-                        - Severity of abnormalities (Mild/Moderate/Severe)
-                        - Potential health risks
-                        
-                        ## 🏥 Recommendations
-                        - Follow-up tests needed
-                        - Lifestyle modifications
-                        - Dietary suggestions
-                        - When to consult doctor
-                        
-                        ## ⚡ Summary
-                        Brief overall summary with key takeaways
-                        
-                        IMPORTANT: Be thorough and extract ALL visible information. Explain medical terms in simple language.
-                        
-                        Provide the complete analysis in {selected_language} language."""
-                        
-                        response = model.generate_content([prompt, st.session_state.uploaded_report_image])
-                        
-                        st.session_state.report_analysis = response.text
-                        
-                        # Save user data
-                        if user_name:
-                            save_user_data(
-                                user_id=st.session_state.user_id,
-                                name=user_name,
-                                age=user_age,
-                                gender=user_gender,
-                                report_type="Medical Report",
-                                analysis=response.text,
-                                timestamp=datetime.now().isoformat()
-                            )
-                        
-                        st.success("✅ Medical Report Analysis Complete")
-                        
-                    except Exception as e:
-                        st.error(f"❌ Error analyzing report: {str(e)}")
+                        session_data.report_lab_values = store_report_labs(
+                            report_job['result']['labs'], record_id, timestamp
+                        )
+                    except ValueError as e:
+                        st.warning(f"🧪 Could not read the extracted lab values: {e}")
     
     # Display analysis
-    if st.session_state.report_analysis:
+    if session_data.report_analysis:
         st.markdown('<div class="analysis-box">', unsafe_allow_html=True)
         st.markdown("### 📊 Detailed Analysis Report:")
-        st.markdown(st.session_state.report_analysis)
+        st.markdown(session_data.report_analysis)
         st.markdown('</div>', unsafe_allow_html=True)
+        if session_data.report_page_calls:
+            with st.expander("📄 Page by page reading"):
+                st.dataframe(
+                    [{'page': i, 'from cache': call['cached'], 'seconds': round(call['seconds'], 2),
+                      'input tokens': call['input_tokens']}
+                     for i, call in enumerate(session_data.report_page_calls, 1)],
+                    use_container_width=True
+                )
+        show_all_languages('report')
+        
+        if session_data.report_lab_values:
+            st.markdown("### 🧪 Extracted Lab Values")
+            st.dataframe(session_data.report_lab_values, use_container_width=True)
         
         st.warning("⚠️ **Medical Disclaimer**: This AI analysis is for informational purposes only.")
+
+    # Lab value trends across saved reports
+    lab_tests = get_lab_store().tests_for_user(st.session_state.user_id)
+    if lab_tests:
+        with st.expander("📈 My Lab Trends"):
+            trend_test = st.selectbox(
+                "Test",
+                options=list(lab_tests.keys()),
+                format_func=lab_tests.get,
+                key="trend_test"
+            )
+            import pandas as pd
+
+            trend = get_lab_store().trend(st.session_state.user_id, trend_test)
+            st.line_chart(pd.DataFrame(
+                {'value': trend['value'], 'ref_low': trend['ref_low'], 'ref_high': trend['ref_high']},
+                index=trend['timestamp']
+            ))
+            st.caption(
+                f"{len(trend['value'])} results · unit: {trend['unit'] or 'n/a'} · "
+                f"{int(trend['out_of_range'].sum())} outside the reference range"
+            )
     
     # Chat section for medical report
-    if st.session_state.uploaded_report_image and st.session_state.report_analysis:
+    if session_data.uploaded_report_image and session_data.report_analysis:
         st.markdown("---")
         st.markdown("### 💬 Chat About Your Report")
         st.write("Ask follow-up questions about your medical report")
         
         # Display chat history
-        display_chat_history(st.session_state.report_chat_history)
+        display_chat_history(session_data.report_chat_history, session_data.report_chat_dropped)
         
         # Chat input
         chat_col1, chat_col2 = st.columns([5, 1])
@@ -356,37 +1104,49 @@ with tab2:
         
         if send_btn and report_question:
             # Add user message to history
-            st.session_state.report_chat_history.append({
+            add_chat_message('report', {
                 'role': 'user',
                 'content': report_question
             })
             
-            with st.spinner("Thinking..."):
-                try:
-                    chat_prompt = f"""You are a medical assistant helping explain a medical report. 
-                    Previous analysis: {st.session_state.report_analysis}
-                    
-                    User question: {report_question}
-                    
-                    Provide a clear, detailed answer in {selected_language} language. 
-                    Reference specific values from the report when relevant.
-                    Be helpful and educational, but always remind users to consult healthcare professionals."""
-                    
-                    chat_response = model.generate_content([chat_prompt, st.session_state.uploaded_report_image])
-                    
-                    # Add assistant message to history
-                    st.session_state.report_chat_history.append({
-                        'role': 'assistant',
-                        'content': chat_response.text
-                    })
-                    
-                    st.rerun()
-                    
-                except Exception as e:
-                    st.error(f"❌ Error: {str(e)}")
+            try:
+                conversation = get_conversation(
+                    'report', session_data.report_analysis, session_data.uploaded_report_image
+                )
+                chat_response_text, timings = run_model(
+                    prompts.REPORT_CHAT_SESSION,
+                    None,
+                    selected_language,
+                    "Thinking...",
+                    query=report_question,
+                    image_sha=session_data.uploaded_report_image.sha256,
+                    context=conversation.context_key(),
+                    request=lambda: conversation.send(get_model(), report_question, selected_language),
+                    feature='report-chat',
+                    image_bytes=conversation.pending_image_bytes()
+                )
+                accounting = conversation.record_turn(
+                    report_question, chat_response_text, selected_language,
+                    0 if timings.get('cached') else timings.get('prompt_tokens')
+                )
+                
+                # Add assistant message to history
+                add_chat_message('report', {
+                    'role': 'assistant',
+                    'content': chat_response_text,
+                    'timings': timings,
+                    'accounting': accounting
+                })
+                
+                st.rerun()
+                
+            except Exception as e:
+                st.error(f"❌ Error: {describe_error(e)}")
         
         if st.button("Clear Chat History", key="clear_report_chat"):
-            st.session_state.report_chat_history = []
+            session_data.report_chat_history = []
+            session_data.report_chat_dropped = 0
+            session_data.report_conversation = None
             st.rerun()
 
 # Tab 3: Skin Disease Detection with Chat
@@ -406,103 +1166,47 @@ with tab3:
         )
         
         if skin_image:
-            image = Image.open(skin_image)
-            max_display_size = (400, 400)
-            image.thumbnail(max_display_size, Image.Resampling.LANCZOS)
-            st.image(image, caption="Uploaded Skin Condition", use_column_width=True)
-            
-            # Store the uploaded image in session state
-            st.session_state.uploaded_skin_image = Image.open(skin_image)
+            # Decode once per upload; session state keeps only the compact payload and thumbnail
+            prepared = prepare_upload(skin_image, 'skin')
+            st.image(prepared.thumbnail, caption="Uploaded Skin Condition", use_column_width=True)
+            st.caption(f"📦 {prepared.summary()}")
     
     with col2:
         if skin_image:
-            detect_btn = st.button("🔬 Analyze Skin Condition", key="detect", use_container_width=True)
+            offer_previous_analysis('skin', session_data.uploaded_skin_image)
+            quality_ok = quality_gate('skin', session_data.uploaded_skin_image)
+            detect_btn = st.button("🔬 Analyze Skin Condition", key="detect", use_container_width=True,
+                                   disabled=not quality_ok)
             
             if detect_btn:
-                with st.spinner("🔬 Analyzing skin condition... Please wait..."):
-                    try:
-                        prompt = f"""You are an expert dermatology assistant. Carefully analyze this skin condition image 
-                        and provide a comprehensive, detailed assessment in {selected_language} language.
-                        
-                        Provide your analysis in the following structured format:
-                        
-                        ## 👁️ Visual Characteristics
-                        - Color (redness, darkening, discoloration)
-                        - Texture (smooth, rough, scaly, bumpy)
-                        - Pattern (circular, linear, clustered, widespread)
-                        - Size and shape
-                        - Location on body (if identifiable)
-                        - Any lesions, bumps, blisters, or rashes
-                        
-                        ## 🔍 Possible Conditions (Differential Diagnosis)
-                        List 3-5 possible conditions with detailed explanations:
-                        1. Most likely condition - explain why
-                        2. Second possibility - reasoning
-                        3. Other potential conditions
-                        
-                        ## 📊 Severity Assessment
-                        - Mild / Moderate / Severe (with justification)
-                        - Progression indicators
-                        - Complications to watch for
-                        
-                        ## 💊 General Care Recommendations
-                        - Immediate care steps
-                        - Things to avoid
-                        - Over-the-counter options
-                        - Home remedies
-                        
-                        ## 🚨 When to Seek Immediate Medical Attention
-                        - Red flags requiring urgent care
-                        - Signs of infection
-                        - Severe symptoms
-                        
-                        ## 🏥 Medical Consultation Recommendations
-                        - Why professional diagnosis is essential
-                        - What type of specialist to see
-                        - What tests might be needed
-                        
-                        CRITICAL: Always emphasize this is NOT a definitive diagnosis.
-                        
-                        Provide the complete analysis in {selected_language} language."""
-                        
-                        response = model.generate_content([prompt, st.session_state.uploaded_skin_image])
-                        
-                        st.session_state.skin_analysis = response.text
-                        
-                        # Save user data
-                        if user_name:
-                            save_user_data(
-                                user_id=st.session_state.user_id,
-                                name=user_name,
-                                age=user_age,
-                                gender=user_gender,
-                                report_type="Skin Condition",
-                                analysis=response.text,
-                                timestamp=datetime.now().isoformat()
-                            )
-                        
-                        st.success("✅ Skin Condition Analysis Complete")
-                        
-                    except Exception as e:
-                        st.error(f"❌ Error analyzing skin condition: {str(e)}")
+                try:
+                    submit_analysis('skin', prompts.SKIN_ANALYSIS, selected_language)
+                except Exception as e:
+                    st.error(f"❌ Error analyzing skin condition: {describe_error(e)}")
+
+        # Runs in the background; survives reruns and page reloads
+        skin_job = follow_analysis('skin')
+        if skin_job:
+            apply_analysis('skin', skin_job, "Skin Condition", "✅ Skin Condition Analysis Complete")
     
     # Display analysis
-    if st.session_state.skin_analysis:
+    if session_data.skin_analysis:
         st.markdown('<div class="analysis-box">', unsafe_allow_html=True)
         st.markdown("### 🔬 Detailed Dermatological Assessment:")
-        st.markdown(st.session_state.skin_analysis)
+        st.markdown(session_data.skin_analysis)
         st.markdown('</div>', unsafe_allow_html=True)
+        show_all_languages('skin')
         
         st.error("🚨 **IMPORTANT**: This AI analysis is NOT a medical diagnosis. Consult a dermatologist.")
     
     # Chat section for skin condition
-    if st.session_state.uploaded_skin_image and st.session_state.skin_analysis:
+    if session_data.uploaded_skin_image and session_data.skin_analysis:
         st.markdown("---")
         st.markdown("### 💬 Chat About Your Skin Condition")
         st.write("Ask follow-up questions about the analysis")
         
         # Display chat history
-        display_chat_history(st.session_state.skin_chat_history)
+        display_chat_history(session_data.skin_chat_history, session_data.skin_chat_dropped)
         
         # Chat input
         chat_col1, chat_col2 = st.columns([5, 1])
@@ -517,46 +1221,145 @@ with tab3:
         
         if send_btn2 and skin_question:
             # Add user message to history
-            st.session_state.skin_chat_history.append({
+            add_chat_message('skin', {
                 'role': 'user',
                 'content': skin_question
             })
             
-            with st.spinner("Thinking..."):
-                try:
-                    chat_prompt = f"""You are a dermatology assistant helping explain a skin condition analysis. 
-                    Previous analysis: {st.session_state.skin_analysis}
-                    
-                    User question: {skin_question}
-                    
-                    Provide a clear, detailed answer in {selected_language} language. 
-                    Reference specific observations from the analysis when relevant.
-                    Be helpful and educational, but always remind users to consult a dermatologist."""
-                    
-                    chat_response = model.generate_content([chat_prompt, st.session_state.uploaded_skin_image])
-                    
-                    # Add assistant message to history
-                    st.session_state.skin_chat_history.append({
-                        'role': 'assistant',
-                        'content': chat_response.text
-                    })
-                    
-                    st.rerun()
-                    
-                except Exception as e:
-                    st.error(f"❌ Error: {str(e)}")
+            try:
+                conversation = get_conversation(
+                    'skin', session_data.skin_analysis, session_data.uploaded_skin_image
+                )
+                chat_response_text, timings = run_model(
+                    prompts.SKIN_CHAT_SESSION,
+                    None,
+                    selected_language,
+                    "Thinking...",
+                    query=skin_question,
+                    image_sha=session_data.uploaded_skin_image.sha256,
+                    context=conversation.context_key(),
+                    request=lambda: conversation.send(get_model(), skin_question, selected_language),
+                    feature='skin-chat',
+                    image_bytes=conversation.pending_image_bytes()
+                )
+                accounting = conversation.record_turn(
+                    skin_question, chat_response_text, selected_language,
+                    0 if timings.get('cached') else timings.get('prompt_tokens')
+                )
+                
+                # Add assistant message to history
+                add_chat_message('skin', {
+                    'role': 'assistant',
+                    'content': chat_response_text,
+                    'timings': timings,
+                    'accounting': accounting
+                })
+                
+                st.rerun()
+                
+            except Exception as e:
+                st.error(f"❌ Error: {describe_error(e)}")
         
         if st.button("Clear Chat History", key="clear_skin_chat"):
-            st.session_state.skin_chat_history = []
+            session_data.skin_chat_history = []
+            session_data.skin_chat_dropped = 0
+            session_data.skin_conversation = None
             st.rerun()
 
+# Tab 4: Performance metrics for operators
+def show_admin():
+    """Admin tab: telemetry, executor, session and usage figures of all users"""
+    st.header("📈 Performance Metrics")
+    st.write("Latency, token, payload and error statistics per feature for this server process.")
+    
+    metrics = get_telemetry().summary()
+    if metrics:
+        import pandas as pd
+
+        st.dataframe(pd.DataFrame.from_dict(metrics, orient='index').fillna(0), use_container_width=True)
+    else:
+        st.info("No calls recorded yet.")
+    
+    executor_stats = get_executor().stats
+    st.caption(
+        f"Executor: {executor_stats['completed']} completed · {executor_stats['failed']} failed · "
+        f"{executor_stats['retries']} retries · {executor_stats['rejected']} rejected · "
+        f"response cache hit rate {get_response_cache().hit_rate():.0%}"
+    )
+    embed_stats = get_embed_executor().stats
+    st.caption(
+        f"Embeddings: {embed_stats['completed']} completed · {embed_stats['failed']} failed · "
+        f"{embed_stats['retries']} retries · {embed_stats['rejected']} rejected"
+    )
+    job_counts = get_job_queue().counts()
+    st.caption(
+        f"Analysis jobs: {job_counts.get('queued', 0)} queued · {job_counts.get('running', 0)} running · "
+        f"{job_counts.get('done', 0)} done · {job_counts.get('failed', 0)} failed"
+    )
+    session_gauges = get_session_memory().gauges(st.session_state.user_id)
+    st.caption(
+        f"Sessions: {session_gauges['in_memory']} in memory "
+        f"({session_gauges['memory_bytes'] / 1024 / 1024:,.1f} MB) · {session_gauges['on_disk']} spilled to disk "
+        f"({session_gauges['disk_bytes'] / 1024 / 1024:,.1f} MB) · "
+        f"this session {session_gauges.get('session_bytes', 0) / 1024:,.0f} KB"
+    )
+    st.subheader("📊 Usage")
+    usage_days = st.selectbox("Period", [7, 30, 90, 365], index=1, format_func=lambda d: f"Last {d} days",
+                              key="usage_days")
+    usage_since = (datetime.now().date() - timedelta(days=usage_days - 1)).isoformat()
+    rollups = get_rollups()
+    query_start = time.perf_counter()
+    totals = rollups.totals()
+    daily = rollups.analyses_per_day(usage_since)
+    demographics = rollups.demographics()
+    chat = rollups.chat_per_day(usage_since)
+    query_ms = (time.perf_counter() - query_start) * 1000
+    usage_cols = st.columns(3)
+    usage_cols[0].metric("Analyses", f"{totals['analyses']:,}")
+    usage_cols[1].metric("Users", f"{totals['users']:,}")
+    usage_cols[2].metric("Chat questions", f"{totals['chat_questions']:,}")
+    if daily:
+        import pandas as pd
+
+        st.markdown("**Analyses per day**")
+        st.bar_chart(pd.DataFrame(daily, columns=['day', 'report_type', 'analyses'])
+                     .pivot(index='day', columns='report_type', values='analyses').fillna(0))
+        st.markdown("**Users by age and gender**")
+        st.bar_chart(pd.DataFrame(demographics, columns=['age_band', 'gender', 'analyses', 'users'])
+                     .pivot(index='age_band', columns='gender', values='users').fillna(0))
+        if chat:
+            st.markdown("**Chat questions per day**")
+            st.bar_chart(pd.DataFrame(chat, columns=['day', 'kind', 'questions'])
+                         .pivot(index='day', columns='kind', values='questions').fillna(0))
+    else:
+        st.info("No analyses saved in this period.")
+    st.caption(
+        f"Read from the rollups in {query_ms:.1f} ms · "
+        f"export the records with `python analytics.py export records.parquet`"
+    )
+    with st.expander("Prometheus metrics"):
+        st.code(get_telemetry().render_prometheus(), language='text')
+        if METRICS_PORT:
+            st.caption(f"Also served at http://<host>:{METRICS_PORT}/metrics")
+    st.caption(f"Per-call trace: {get_telemetry().trace_file}")
+
+if admin_tab:
+    with admin_tab[0]:
+        if admin_unlocked():
+            show_admin()
+
 # Footer
+store = get_store()
+data_file = os.path.basename(getattr(store, 'hot', store).path)
 st.markdown("---")
-st.markdown("""
+st.markdown(f"""
     <div style='text-align: center; color: gray; padding: 2rem 0;'>
     <p style='font-size: 1.1rem;'><strong>🏥 Medical Assistant Bot | Powered by Google Gemini 2.0 Flash</strong></p>
     <p style='font-size: 0.9rem;'>Supports: English, Hindi, Telugu, Tamil, Bengali, Marathi, Gujarati, Kannada, Malayalam, Punjabi</p>
     <p style='font-size: 0.85rem; color: #d32f2f; font-weight: bold;'>⚠️ This tool is for informational purposes only.</p>
-    <p style='font-size: 0.85rem;'>User data is stored locally in user_medical_data.json</p>
+    <p style='font-size: 0.85rem;'>User data is stored locally in {data_file}</p>
     </div>
-""", unsafe_allow_html=True)
\ No newline at end of file
+""", unsafe_allow_html=True)
+
+# This run is done with the session's state: it can be measured, and spilled once idle
+get_session_memory().release(st.session_state.user_id)
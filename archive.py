@@ -0,0 +1,369 @@
+"""Compressed, encrypted archive tier for old records.
+
+Records older than MEDASSIST_ARCHIVE_AFTER_DAYS are moved from the hot
+SQLite store into append-only segment files under MEDASSIST_ARCHIVE_DIR.
+Every record is its own zstd frame, compressed with a dictionary trained on
+the records themselves (the analyses repeat the same prompt sections and
+phrasing), then encrypted with AES-256-GCM under a per-segment key derived
+from MEDASSIST_ARCHIVE_KEY. An SQLite index maps record ids to (segment,
+offset, length), so reading a record by id decrypts and decompresses one
+frame.
+
+Usage:
+    python archive.py keygen
+    python archive.py compact [--older-than-days 90]
+    python archive.py stats
+"""
+import base64
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import zstandard
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from storage import CompactableStore, RecordStore, _pread, _since_key
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv('MEDASSIST_ARCHIVE_DIR', 'archive')
+ARCHIVE_AFTER_DAYS = float(os.getenv('MEDASSIST_ARCHIVE_AFTER_DAYS', '90'))
+# Seconds between background compaction runs
+COMPACT_INTERVAL = float(os.getenv('MEDASSIST_ARCHIVE_INTERVAL_S', '3600'))
+SEGMENT_RECORDS = 10000
+COMPRESSION_LEVEL = 19
+DICT_SIZE = 64 * 1024
+# Records needed to train a dictionary; smaller batches are stored without one
+DICT_MIN_SAMPLES = 100
+NONCE_SIZE = 12
+
+
+def generate_key():
+    return base64.urlsafe_b64encode(AESGCM.generate_key(bit_length=256)).decode('ascii')
+
+
+def load_key(value=None):
+    """The 32-byte master key from `value` or MEDASSIST_ARCHIVE_KEY"""
+    value = value or os.getenv('MEDASSIST_ARCHIVE_KEY')
+    if not value:
+        raise ValueError("MEDASSIST_ARCHIVE_KEY is not set (create one with: python archive.py keygen)")
+    key = base64.urlsafe_b64decode(value)
+    if len(key) != 32:
+        raise ValueError("MEDASSIST_ARCHIVE_KEY must be 32 bytes, base64-encoded")
+    return key
+
+
+def _derive(master, salt, info):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(master)
+
+
+class Archive:
+    """Read-by-id archive of records in compressed, encrypted segments"""
+
+    def __init__(self, key, directory=ARCHIVE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._master = key
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, 'archive.db'), timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS dictionaries (
+                dict_id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS segments (
+                segment_id INTEGER PRIMARY KEY,
+                file TEXT NOT NULL,
+                salt BLOB NOT NULL,
+                dict_id INTEGER,
+                records INTEGER NOT NULL,
+                raw_bytes INTEGER NOT NULL,
+                stored_bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS archived (
+                record_id TEXT PRIMARY KEY,
+                user_id TEXT,
+                report_type TEXT,
+                timestamp TEXT,
+                segment_id INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            )
+        """)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_archived_user_time ON archived (user_id, timestamp)')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_archived_user_type_time ON archived (user_id, report_type, timestamp)'
+        )
+        self._conn.commit()
+        # Dictionaries are sealed with their own key: they contain record text
+        self._dict_cipher = AESGCM(_derive(key, b'', b'medassist-archive-dictionary'))
+        self._dicts = {}
+        # segment_id -> (fd, AESGCM, ZstdDecompressor)
+        self._segments = {}
+
+    def write_segment(self, records):
+        """Archive `records` as one new segment; returns the number stored"""
+        if not records:
+            return 0
+        blobs = [json.dumps(r, ensure_ascii=False, separators=(',', ':')).encode('utf-8') for r in records]
+        with self._lock:
+            dict_id, dictionary = self._current_dictionary(blobs)
+            compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, dict_data=dictionary)
+            salt = os.urandom(16)
+            cipher = AESGCM(_derive(self._master, salt, b'medassist-archive-segment'))
+            name = f"segment-{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}.seg"
+            path = os.path.join(self.directory, name)
+            rows, offset = [], 0
+            with open(path + '.tmp', 'wb') as f:
+                for record, blob in zip(records, blobs):
+                    nonce = os.urandom(NONCE_SIZE)
+                    # The record id is authenticated, so frames can't be swapped between records
+                    frame = nonce + cipher.encrypt(nonce, compressor.compress(blob), record['record_id'].encode('utf-8'))
+                    f.write(frame)
+                    rows.append((record['record_id'], record.get('user_id'), record.get('report_type'),
+                                 record.get('timestamp'), offset, len(frame)))
+                    offset += len(frame)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            with self._conn:
+                segment_id = self._conn.execute(
+                    'INSERT INTO segments (file, salt, dict_id, records, raw_bytes, stored_bytes, created_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (name, salt, dict_id, len(records), sum(len(b) for b in blobs), offset, time.time())
+                ).lastrowid
+                # A record archived twice (e.g. by two processes) keeps its first copy
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO archived VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(r[0], r[1], r[2], r[3], segment_id, r[4], r[5]) for r in rows]
+                )
+        return len(records)
+
+    def get(self, record_id):
+        """The archived record `record_id`, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT segment_id, offset, length FROM archived WHERE record_id = ?', (record_id,)
+            ).fetchone()
+            return self._read(record_id, *row) if row else None
+
+    def get_history(self, user_id, report_type=None, since=None, limit=20):
+        sql = 'SELECT record_id, segment_id, offset, length FROM archived WHERE user_id = ?'
+        params = [user_id]
+        if report_type is not None:
+            sql += ' AND report_type = ?'
+            params.append(report_type)
+        if since is not None:
+            sql += ' AND timestamp >= ?'
+            params.append(_since_key(since))
+        sql += ' ORDER BY timestamp DESC'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            return [self._read(*row) for row in rows]
+
+    def iter_records(self):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT record_id, segment_id, offset, length FROM archived ORDER BY segment_id, offset'
+            ).fetchall()
+        for row in rows:
+            with self._lock:
+                record = self._read(*row)
+            yield record
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM archived').fetchone()[0]
+
+    def stats(self):
+        """Segments, records and raw (compact JSON) vs stored bytes"""
+        with self._lock:
+            segments, records, raw, stored = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(records), 0), COALESCE(SUM(raw_bytes), 0), '
+                'COALESCE(SUM(stored_bytes), 0) FROM segments'
+            ).fetchone()
+            dictionaries = self._conn.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM dictionaries').fetchone()[0]
+        return {'segments': segments, 'records': records, 'raw_bytes': raw, 'stored_bytes': stored,
+                'dictionary_bytes': dictionaries}
+
+    def close(self):
+        with self._lock:
+            for fd, _, _ in self._segments.values():
+                os.close(fd)
+            self._segments.clear()
+            self._conn.close()
+
+    def _current_dictionary(self, blobs):
+        row = self._conn.execute('SELECT dict_id FROM dictionaries ORDER BY dict_id DESC LIMIT 1').fetchone()
+        if row:
+            return row[0], self._dictionary(row[0])
+        if len(blobs) < DICT_MIN_SAMPLES:
+            return None, None
+        try:
+            dictionary = zstandard.train_dictionary(DICT_SIZE, blobs)
+        except zstandard.ZstdError:
+            return None, None
+        nonce = os.urandom(NONCE_SIZE)
+        with self._conn:
+            dict_id = self._conn.execute(
+                'INSERT INTO dictionaries (data, created_at) VALUES (?, ?)',
+                (nonce + self._dict_cipher.encrypt(nonce, dictionary.as_bytes(), None), time.time())
+            ).lastrowid
+        self._dicts[dict_id] = dictionary
+        return dict_id, dictionary
+
+    def _dictionary(self, dict_id):
+        if dict_id not in self._dicts:
+            sealed = self._conn.execute('SELECT data FROM dictionaries WHERE dict_id = ?', (dict_id,)).fetchone()[0]
+            data = self._dict_cipher.decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], None)
+            self._dicts[dict_id] = zstandard.ZstdCompressionDict(data)
+        return self._dicts[dict_id]
+
+    def _segment(self, segment_id):
+        if segment_id not in self._segments:
+            name, salt, dict_id = self._conn.execute(
+                'SELECT file, salt, dict_id FROM segments WHERE segment_id = ?', (segment_id,)
+            ).fetchone()
+            fd = os.open(os.path.join(self.directory, name), os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            cipher = AESGCM(_derive(self._master, salt, b'medassist-archive-segment'))
+            dictionary = self._dictionary(dict_id) if dict_id is not None else None
+            self._segments[segment_id] = (fd, cipher, zstandard.ZstdDecompressor(dict_data=dictionary))
+        return self._segments[segment_id]
+
+    def _read(self, record_id, segment_id, offset, length):
+        fd, cipher, decompressor = self._segment(segment_id)
+        frame = _pread(fd, length, offset)
+        blob = decompressor.decompress(cipher.decrypt(frame[:NONCE_SIZE], frame[NONCE_SIZE:], record_id.encode('utf-8')))
+        return json.loads(blob)
+
+
+def compact(hot, archive, older_than_days=ARCHIVE_AFTER_DAYS, segment_records=SEGMENT_RECORDS):
+    """Move records older than `older_than_days` from `hot` into `archive`.
+
+    A batch is deleted from the hot store only after its segment is durable,
+    so a crash in between leaves the records in both tiers (reads prefer the
+    hot copy) and the next run finishes the move. Returns the number moved.
+    """
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+    moved = 0
+    while True:
+        records = hot.records_before(cutoff, limit=segment_records)
+        if not records:
+            return moved
+        archive.write_segment(records)
+        hot.delete([r['record_id'] for r in records])
+        moved += len(records)
+
+
+class TieredStore(RecordStore):
+    """Hot store for new records in front of the archive tier"""
+
+    def __init__(self, hot, archive):
+        if not isinstance(hot, CompactableStore):
+            raise TypeError(f"{type(hot).__name__} can't be compacted into the archive tier")
+        self.hot = hot
+        self.archive = archive
+        self._compactor = None
+
+    def append_many(self, records):
+        return self.hot.append_many(records)
+
+    def iter_records(self):
+        yield from self.archive.iter_records()
+        yield from self.hot.iter_records()
+
+    def get_history(self, user_id, report_type=None, since=None, limit=20):
+        records = self.hot.get_history(user_id, report_type, since, limit)
+        if not limit or len(records) < limit:
+            seen = {r['record_id'] for r in records}
+            older = self.archive.get_history(user_id, report_type, since, limit)
+            records += [r for r in older if r['record_id'] not in seen]
+            records.sort(key=lambda r: r.get('timestamp') or '', reverse=True)
+        return records[:limit] if limit else records
+
+    def get_record(self, user_id, record_id):
+        record = self.hot.get_record(user_id, record_id)
+        if record is None:
+            record = self.archive.get(record_id)
+            if record is not None and record.get('user_id') != user_id:
+                return None
+        return record
+
+    def count(self):
+        return self.hot.count() + self.archive.count()
+
+    def compact(self, older_than_days=ARCHIVE_AFTER_DAYS):
+        return compact(self.hot, self.archive, older_than_days)
+
+    def start_compaction(self, interval=COMPACT_INTERVAL, older_than_days=ARCHIVE_AFTER_DAYS):
+        """Compact in a daemon thread every `interval` seconds"""
+        if self._compactor is not None:
+            return
+
+        def run():
+            while True:
+                try:
+                    self.compact(older_than_days)
+                except Exception:
+                    logger.exception('Archive compaction failed')
+                time.sleep(interval)
+
+        self._compactor = threading.Thread(target=run, name='archive-compaction', daemon=True)
+        self._compactor.start()
+
+    def flush(self):
+        self.hot.flush()
+
+    def close(self):
+        self.hot.close()
+        self.archive.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from dotenv import load_dotenv
+
+    from storage import open_store
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('keygen', help='print a new MEDASSIST_ARCHIVE_KEY')
+    p = sub.add_parser('compact', help='move old records into the archive now')
+    p.add_argument('--older-than-days', type=float, default=ARCHIVE_AFTER_DAYS)
+    sub.add_parser('stats', help='archive size and compression')
+    args = parser.parse_args()
+
+    if args.command == 'keygen':
+        print(generate_key())
+        sys.exit()
+    store = open_store()
+    if not isinstance(store, TieredStore):
+        sys.exit("The archive tier needs MEDASSIST_ARCHIVE_KEY and the sqlite backend")
+    if args.command == 'compact':
+        print(f"Archived {store.compact(args.older_than_days)} records")
+    stats = store.archive.stats()
+    ratio = stats['raw_bytes'] / stats['stored_bytes'] if stats['stored_bytes'] else 0
+    print(f"{stats['records']} records in {stats['segments']} segments: {stats['raw_bytes']:,} bytes of JSON "
+          f"stored in {stats['stored_bytes']:,} ({ratio:.1f}x, dictionary {stats['dictionary_bytes']:,} bytes)")
+    store.close()
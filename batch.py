@@ -0,0 +1,193 @@
+"""Headless batch analysis of medical report images.
+
+Analyzes every PNG/JPEG in a folder or .zip archive with the same report
+prompt the app uses. Images are read straight from the archive (nothing is
+extracted to disk) and analyzed concurrently. Results are saved through the
+record store, and a JSONL summary line with per-item latency is written for
+each image. The summary doubles as the resume ledger: re-running with the
+same --output skips image hashes that already succeeded.
+
+Usage:
+    python batch.py --lang Hindi reports.zip
+    python batch.py --lang English --concurrency 8 --output summary.jsonl scans/
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+import prompts
+from analytics import Rollups
+from cache import ResponseCache, sha256_bytes
+from dedup import ImageIndex
+from executor import REQUESTS_PER_MINUTE, LLMExecutor
+from imaging import preprocess_image
+from llm import create_model
+from prompts import LANGUAGES
+from storage import open_store
+from vectors import HISTORY_VECTORS_PREFIX, VectorIndex, history_groups, sync_index
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def iter_images(source):
+    """Yield (name, raw bytes) for each image in a folder or zip archive, one at a time"""
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    with archive.open(info) as f:
+                        yield info.filename, f.read()
+    else:
+        for root, _, files in os.walk(source):
+            for filename in sorted(files):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(root, filename)
+                    with open(path, 'rb') as f:
+                        yield os.path.relpath(path, source), f.read()
+
+
+def load_done_hashes(summary_path):
+    """Image hashes that a previous run of this summary file completed"""
+    done = set()
+    if os.path.exists(summary_path):
+        with open(summary_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if item.get('status') == 'ok':
+                    done.add(item['sha256'])
+    return done
+
+
+def analyze_image(model, cache, language, prepared):
+    """Run the report prompt on one preprocessed image; returns (text, cached)"""
+    key = cache.make_key(prompts.REPORT_ANALYSIS, language, image_sha=prepared.sha256)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached, True
+    prompt = prompts.build_prompt(prompts.REPORT_ANALYSIS, language=language)
+    response = model.generate_content([prompt, prepared.as_part()])
+    cache.set(key, response.text)
+    return response.text, False
+
+
+def run_batch(source, language, output, concurrency=4, user_id='batch', name=None,
+              requests_per_minute=REQUESTS_PER_MINUTE):
+    """Analyze all images under `source`; returns counts per status"""
+    model = create_model()
+    cache = ResponseCache()
+    store = open_store()
+    image_index = ImageIndex()
+    executor = LLMExecutor(max_workers=concurrency, requests_per_minute=requests_per_minute,
+                           max_pending=concurrency * 2)
+    # Prepare and save images in parallel; only their model calls go through the executor
+    workers = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch')
+    done = load_done_hashes(output)
+    # Bound the number of images held in memory while they wait for a worker
+    in_flight = threading.BoundedSemaphore(concurrency * 2)
+    write_lock = threading.Lock()
+    counts = {'ok': 0, 'error': 0, 'skipped': 0}
+
+    with open(output, 'a', encoding='utf-8') as summary:
+        def write_summary(item):
+            with write_lock:
+                counts[item['status']] += 1
+                summary.write(json.dumps(item, ensure_ascii=False) + '\n')
+                summary.flush()
+                print(f"[{item['status']:>7}] {item['file']} ({item['latency_s']:.2f} s)", file=sys.stderr)
+
+        def process(filename, data):
+            prepared = preprocess_image(data)
+            # Only the model call is retried (429/5xx); the record is written once it succeeded
+            text, cached = executor.submit(analyze_image, model, cache, language, prepared).result()
+            timestamp = datetime.now().isoformat()
+            record_id = store.append({
+                'user_id': user_id,
+                'name': name,
+                'age': None,
+                'gender': None,
+                'report_type': "Medical Report",
+                'analysis': text,
+                'timestamp': timestamp,
+                'language': language,
+                'source': filename,
+                'image_sha256': prepared.sha256
+            })
+            image_index.add(user_id, 'report', prepared.phash, record_id, timestamp)
+            return {'bytes_out': len(prepared.data), 'cached': cached, 'record_id': record_id}
+
+        def finish(future, filename, sha, size, submitted):
+            in_flight.release()
+            item = {'file': filename, 'sha256': sha, 'bytes_in': size}
+            if future.exception() is None:
+                item.update(future.result(), status='ok')
+            else:
+                item.update(status='error', error=str(future.exception()))
+            item['latency_s'] = round(time.perf_counter() - submitted, 3)
+            write_summary(item)
+
+        futures = []
+        for filename, data in iter_images(source):
+            sha = sha256_bytes(data)
+            if sha in done:
+                write_summary({'file': filename, 'sha256': sha, 'status': 'skipped', 'latency_s': 0.0})
+                continue
+            done.add(sha)
+            in_flight.acquire()
+            future = workers.submit(process, filename, data)
+            future.add_done_callback(
+                lambda f, args=(filename, sha, len(data), time.perf_counter()): finish(f, *args)
+            )
+            futures.append(future)
+        for future in futures:
+            future.exception()
+    workers.shutdown()
+
+    # Embed the new analyses for history search (only records not indexed yet)
+    history_index = VectorIndex(f'{HISTORY_VECTORS_PREFIX}.{model.embedding_model}')
+    sync_index(history_index, store, lambda texts: executor.submit(model.embed, texts).result(), history_groups)
+    history_index.close()
+    # Count the new records in the usage rollups
+    rollups = Rollups()
+    rollups.sync(store)
+    rollups.close()
+    executor.shutdown()
+    image_index.close()
+    store.close()
+    return counts
+
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='folder or .zip archive of report images')
+    parser.add_argument('--lang', default='English', choices=list(LANGUAGES.keys()))
+    parser.add_argument('--output', default='batch_summary.jsonl', help='JSONL summary / resume ledger')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rpm', type=float, default=REQUESTS_PER_MINUTE, help='model requests per minute')
+    parser.add_argument('--user-id', default='batch')
+    parser.add_argument('--name', default=None, help='name stored with each record (default: source name)')
+    args = parser.parse_args(argv)
+
+    counts = run_batch(
+        args.source, args.lang, args.output, args.concurrency,
+        args.user_id, args.name or os.path.basename(os.path.normpath(args.source)),
+        args.rpm
+    )
+    print(f"Done: {counts['ok']} analyzed, {counts['skipped']} skipped, {counts['error']} failed "
+          f"(summary in {args.output})")
+    return 1 if counts['error'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,814 @@
+"""Micro-benchmarks for the Medical Assistant Bot.
+
+Usage:
+    python bench.py storage [--backend sqlite|jsonl] [--sizes 1000,10000,100000,1000000]
+    python bench.py history [--backend sqlite|jsonl] [--sizes 1000,100000,1000000]
+    python bench.py images [photo.jpg ...]
+    python bench.py executor [--requests 40] [--rpm 600] [--error-rate 0.2]
+    python bench.py labs [--rows 1000000]
+    python bench.py dedup [--images 100000]
+    python bench.py vectors [--rows 1000000] [--users 5000]
+    python bench.py archive [--scale 1000]
+    python bench.py quality [photo.jpg ...]
+    python bench.py analytics [--records 200000]
+    python bench.py documents [--pages 20] [--workers 4]
+    python bench.py startup [--reruns 20]
+    python bench.py flows [--users 4] [--iterations 3] [--latency lognormal:800,0.5] [--baseline flows.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import storage
+
+
+def _sample_record(i):
+    return {
+        'user_id': f'user-{i % 5000}',
+        'name': 'Bench',
+        'age': 30,
+        'gender': 'Other',
+        'report_type': ('Medical Query', 'Medical Report', 'Skin Condition')[i % 3],
+        'analysis': '## 📋 Report Type Identification\n- Lab test\n' * 20,
+        'timestamp': f'2025-01-01T00:00:{i % 60:02d}.{i:06d}'
+    }
+
+
+def bench_storage(args):
+    """Median/p99 latency of a single save as the store grows"""
+    sizes = [int(s) for s in args.sizes.split(',')]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.' + ('db' if args.backend == 'sqlite' else 'jsonl'))
+        store = storage.open_store(args.backend, path, legacy_path=None)
+        filled = 0
+        print(f"{'records':>10} {'p50 ms':>8} {'p99 ms':>8}")
+        for size in sizes:
+            # Bulk-fill up to the target size
+            while filled < size:
+                batch = [_sample_record(filled + i) for i in range(min(10000, size - filled))]
+                store.append_many(batch)
+                filled += len(batch)
+            store.flush()
+
+            latencies = []
+            for i in range(args.samples):
+                start = time.perf_counter()
+                store.append(_sample_record(filled + i))
+                latencies.append((time.perf_counter() - start) * 1000)
+            filled += args.samples
+            latencies.sort()
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(f"{size:>10} {statistics.median(latencies):>8.3f} {p99:>8.3f}")
+        store.close()
+
+
+def bench_history(args):
+    """Latency of get_history(user_id, ...) as the store grows"""
+    sizes = [int(s) for s in args.sizes.split(',')]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.' + ('db' if args.backend == 'sqlite' else 'jsonl'))
+        store = storage.open_store(args.backend, path, legacy_path=None)
+        filled = 0
+        print(f"{'records':>10} {'all ms':>8} {'type ms':>8} {'since ms':>9}")
+        for size in sizes:
+            while filled < size:
+                batch = [_sample_record(filled + i) for i in range(min(10000, size - filled))]
+                store.append_many(batch)
+                filled += len(batch)
+            store.flush()
+
+            timings = {'all': [], 'type': [], 'since': []}
+            for i in range(args.samples):
+                user_id = f'user-{i % 5000}'
+                for name, kwargs in (('all', {}),
+                                     ('type', {'report_type': 'Medical Report'}),
+                                     ('since', {'since': '2025-01-01T00:00:30'})):
+                    start = time.perf_counter()
+                    store.get_history(user_id, limit=10, **kwargs)
+                    timings[name].append((time.perf_counter() - start) * 1000)
+            print(f"{size:>10} {statistics.median(timings['all']):>8.3f} "
+                  f"{statistics.median(timings['type']):>8.3f} {statistics.median(timings['since']):>9.3f}")
+        store.close()
+
+
+def _synthetic_photo(width=4000, height=3000):
+    """12 MP JPEG with enough texture to compress like a phone photo"""
+    import io
+    import random
+    from PIL import Image, ImageDraw
+
+    image = Image.effect_noise((width, height), 40).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(0)
+    for _ in range(400):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.text((x, y), 'Hemoglobin 13.5 g/dL', fill=(0, 0, 0))
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=92)
+    return buf.getvalue()
+
+
+def bench_images(args):
+    """Upload bytes vs. model payload bytes and preprocessing time"""
+    from imaging import preprocess_image
+
+    if args.files:
+        samples = []
+        for path in args.files:
+            with open(path, 'rb') as f:
+                samples.append((os.path.basename(path), f.read()))
+    else:
+        samples = [('synthetic 12MP', _synthetic_photo())]
+
+    print(f"{'image':<24} {'before KB':>10} {'after KB':>9} {'decode ms':>10} {'encode ms':>10}")
+    for name, data in samples:
+        prepared = preprocess_image(data)
+        print(f"{name[:24]:<24} {len(data) / 1024:>10,.0f} {len(prepared.data) / 1024:>9,.0f} "
+              f"{prepared.decode_ms:>10.1f} {prepared.encode_ms:>10.1f}")
+
+
+class _FakeApiError(Exception):
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class _FakeStreamingModel:
+    """Local stand-in for GenerativeModel: streams a few chunks after a delay
+    and fails with 429/503 at the given rate"""
+
+    def __init__(self, latency=0.2, error_rate=0.0, seed=0):
+        import random
+        import threading
+
+        self.latency = latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def generate_content(self, prompt, stream=False):
+        with self._lock:
+            self.calls += 1
+            fail = self._rng.random() < self.error_rate
+            code = self._rng.choice((429, 503))
+        time.sleep(self.latency)
+        if fail:
+            raise _FakeApiError(code)
+        if not stream:
+            return _FakeResponse('chunk ' * 5)
+        return iter(['chunk '] * 5)
+
+
+def bench_executor(args):
+    """Throughput, latency and retries of the shared executor under load"""
+    import threading
+    from executor import LLMExecutor
+
+    model = _FakeStreamingModel(latency=args.latency, error_rate=args.error_rate)
+    executor = LLMExecutor(max_workers=args.workers, requests_per_minute=args.rpm,
+                           max_pending=args.requests, base_delay=0.05, max_delay=0.5)
+    latencies = []
+    errors = []
+
+    def client(i):
+        start = time.perf_counter()
+        try:
+            ''.join(executor.stream(lambda: model.generate_content(f'q{i}', stream=True)))
+        except Exception as e:
+            errors.append(e)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.requests)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+
+    latencies.sort()
+    print(f"requests {args.requests} in {elapsed:.2f} s ({args.requests / elapsed:.1f} req/s, "
+          f"limit {args.rpm / 60:.1f} req/s)")
+    print(f"latency p50 {statistics.median(latencies):.2f} s · p95 "
+          f"{latencies[int(len(latencies) * 0.95) - 1]:.2f} s")
+    print(f"model calls {model.calls} · retries {executor.stats['retries']} · failed {len(errors)}")
+
+
+def bench_labs(args):
+    """Trend query latency over a large lab-value table"""
+    from labs import LabStore
+
+    tests = ['HbA1c', 'Hemoglobin', 'LDL Cholesterol', 'TSH', 'Creatinine']
+    users = max(1, args.rows // 100)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = LabStore(os.path.join(tmp, 'labs.db'))
+        for r in range(args.rows // len(tests)):
+            store.add(f'user-{r % users}', f'rec-{r}', f'2025-{1 + r % 12:02d}-01T00:00:{r % 60:02d}',
+                      [{'test': t, 'value': 5.0 + (r % 7), 'ref_low': 4.0, 'ref_high': 5.6} for t in tests])
+
+        latencies = []
+        for i in range(args.samples):
+            start = time.perf_counter()
+            trend = store.trend(f'user-{i % users}', 'hba1c')
+            trend['value'].mean()
+            latencies.append((time.perf_counter() - start) * 1000)
+        print(f"{args.rows} rows, {users} users: trend p50 {statistics.median(latencies):.3f} ms, "
+              f"{len(trend['value'])} points per series")
+
+
+def bench_dedup(args):
+    """Near-duplicate lookup latency over one user's image hashes"""
+    import random
+
+    from dedup import ImageIndex
+
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(args.images)]
+    with tempfile.TemporaryDirectory() as tmp:
+        index = ImageIndex(os.path.join(tmp, 'hashes.db'))
+        with index._conn:
+            index._conn.executemany(
+                'INSERT INTO image_hashes (user_id, kind, phash, record_id) VALUES (?, ?, ?, ?)',
+                [('bench', 'report', h - (1 << 64) if h >= 1 << 63 else h, f'rec-{i}') for i, h in enumerate(hashes)]
+            )
+        start = time.perf_counter()
+        index.find('bench', 'report', 0)
+        print(f"{args.images} hashes: index loaded in {time.perf_counter() - start:.2f} s")
+
+        for label, make_query in (
+            ('near-duplicate', lambda: rng.choice(hashes) ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64))),
+            ('miss', lambda: rng.getrandbits(64)),
+        ):
+            latencies = []
+            for _ in range(args.samples):
+                query = make_query()
+                start = time.perf_counter()
+                index.find('bench', 'report', query)
+                latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+            print(f"{label:>15}: p50 {statistics.median(latencies):.2f} ms, "
+                  f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.2f} ms")
+
+
+def bench_vectors(args):
+    """History search latency over an index of random embeddings"""
+    import numpy as np
+
+    from vectors import EMBEDDING_DIM, VectorIndex
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        index = VectorIndex(os.path.join(tmp, 'vectors'))
+        start = time.perf_counter()
+        with open(index.vectors_path, 'wb') as f:
+            for lo in range(0, args.rows, 100000):
+                block = rng.standard_normal((min(100000, args.rows - lo), EMBEDDING_DIM), dtype=np.float32)
+                (block / np.linalg.norm(block, axis=1, keepdims=True)).tofile(f)
+        # Rows are spread over --users users, except the first --large-group rows
+        # which belong to one heavy user
+        user = lambda row: 'heavy' if row < args.large_group else row % args.users
+        index._conn.execute('BEGIN')
+        index._conn.executemany('INSERT INTO vector_rows VALUES (?, ?)', ((r, f'rec-{r}') for r in range(args.rows)))
+        index._conn.executemany('INSERT INTO vector_groups VALUES (?, ?)',
+                                ((f'user:{user(r)}', r) for r in range(args.rows)))
+        index._conn.execute('COMMIT')
+        print(f"{args.rows} vectors written in {time.perf_counter() - start:.1f} s")
+        start = time.perf_counter()
+        index.count()
+        print(f"index loaded in {time.perf_counter() - start:.2f} s")
+
+        for label, group in (
+            (f'user (~{args.rows // args.users} rows)', 'user:1'),
+            (f'user ({args.large_group} rows)', 'user:heavy'),
+            (f'all ({args.rows} rows)', None),
+        ):
+            latencies = []
+            for _ in range(args.samples):
+                query = rng.standard_normal(EMBEDDING_DIM, dtype=np.float32)
+                start = time.perf_counter()
+                index.search(query, group, k=5)
+                latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+            print(f"{label:>22}: p50 {statistics.median(latencies):.2f} ms, "
+                  f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.2f} ms")
+        index.close()
+
+
+def bench_quality(args):
+    """Time of the image quality checks, on a 12 MP image and on the capped
+    image preprocess_image actually measures"""
+    import io
+
+    import numpy as np
+    from PIL import Image
+
+    from imaging import MAX_IMAGE_EDGE
+    from quality import check, measure
+
+    if args.photos:
+        images = [(path, Image.open(path).convert('RGB')) for path in args.photos]
+    else:
+        rng = np.random.default_rng(0)
+        noise = rng.integers(0, 256, (3000, 4000, 3), dtype=np.uint8)
+        images = [('12 MP noise', Image.fromarray(noise))]
+    for label, image in images:
+        capped = image.copy()
+        capped.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+        for name, candidate in ((f'{image.width}x{image.height}', image),
+                                (f'capped {capped.width}x{capped.height}', capped)):
+            latencies = []
+            for _ in range(args.samples):
+                start = time.perf_counter()
+                scores = measure(candidate)
+                latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+            print(f"{label} ({name}): p50 {statistics.median(latencies):.1f} ms, "
+                  f"max {latencies[-1]:.1f} ms · " + ', '.join(f"{k} {v:.3g}" for k, v in scores.items()))
+        for kind in ('report', 'skin'):
+            print(f"  {kind}: {check(measure(capped), kind) or 'ok'}")
+
+
+def _dir_bytes(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def bench_archive(args):
+    """Space and read latency of the archive tier on the sample data file, scaled up"""
+    import random
+
+    import zstandard
+
+    from archive import Archive, TieredStore, generate_key, load_key
+
+    with open(args.source, 'r', encoding='utf-8') as f:
+        sample = json.load(f)
+    records = []
+    for i in range(args.scale):
+        for j, record in enumerate(sample):
+            records.append(dict(record, record_id=f'{i:06d}-{j}', user_id=f'user-{i % 500}',
+                                timestamp=f'2024-{1 + i % 12:02d}-{1 + j % 28:02d}T00:00:{i % 60:02d}.{i:06d}'))
+    legacy_bytes = len(json.dumps(records, indent=4).encode('utf-8'))
+    plain = zstandard.ZstdCompressor(level=19)
+    no_dict_bytes = sum(len(plain.compress(json.dumps(r, ensure_ascii=False).encode('utf-8'))) for r in records)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        hot = storage.SqliteStore(os.path.join(tmp, 'hot.db'))
+        hot.append_many(records)
+        hot.close()
+        hot_bytes = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp))
+        store = TieredStore(storage.SqliteStore(os.path.join(tmp, 'hot.db')),
+                            Archive(load_key(generate_key()), os.path.join(tmp, 'archive')))
+        start = time.perf_counter()
+        moved = store.compact(older_than_days=0)
+        compact_s = time.perf_counter() - start
+        stats = store.archive.stats()
+        store.archive._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        archive_bytes = _dir_bytes(os.path.join(tmp, 'archive'))
+
+        print(f"{len(records)} records ({len(sample)} sample records x {args.scale})")
+        print(f"  legacy JSON (indent=4): {legacy_bytes / 1e6:8.1f} MB")
+        print(f"  hot SQLite store:       {hot_bytes / 1e6:8.1f} MB")
+        print(f"  zstd per record:        {no_dict_bytes / 1e6:8.1f} MB (no dictionary)")
+        print(f"  archive:                {archive_bytes / 1e6:8.1f} MB "
+              f"(segments {stats['stored_bytes'] / 1e6:.1f} MB + index; "
+              f"{legacy_bytes / archive_bytes:.0f}x smaller than the JSON file)")
+        print(f"  compaction: {moved} records in {compact_s:.1f} s")
+
+        rng = random.Random(0)
+        for label, read in (
+            ('read by id', lambda: (lambda r: store.get_record(r['user_id'], r['record_id']))(rng.choice(records))),
+            ('history (20)', lambda: store.get_history(f'user-{rng.randrange(500)}')),
+        ):
+            latencies = []
+            for _ in range(args.samples):
+                start = time.perf_counter()
+                read()
+                latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+            print(f"{label:>14}: p50 {statistics.median(latencies):.2f} ms, "
+                  f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.2f} ms")
+        store.close()
+
+
+_EXPORT_SCRIPT = """
+import resource, sys, time
+sys.path.insert(0, {repo!r})
+import analytics, storage
+command, path, out = sys.argv[1:4]
+start = time.perf_counter()
+if command == 'json.load':
+    import json
+    with open(path, encoding='utf-8') as f:
+        count = len(json.load(f))
+elif command == 'iter_json_array':
+    count = sum(1 for _ in storage.iter_json_array(path))
+else:
+    store = storage.SqliteStore(path)
+    count = analytics.export_records(store.iter_records(), out, command)
+elapsed = time.perf_counter() - start
+print(count, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def bench_analytics(args):
+    """Export throughput and peak memory, and rollup update and read latency"""
+    import random
+
+    from analytics import Rollups
+
+    rng = random.Random(0)
+    records = []
+    for i in range(args.records):
+        record = _sample_record(i)
+        record.update(
+            record_id=f'{i:09d}',
+            age=rng.randrange(1, 95),
+            gender=rng.choice(('Male', 'Female', 'Other')),
+            timestamp=f'2025-{1 + i * 12 // args.records:02d}-{1 + i % 28:02d}T00:00:{i % 60:02d}.{i:06d}'
+        )
+        records.append(record)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    script = _EXPORT_SCRIPT.format(repo=repo)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'records.db')
+        store = storage.SqliteStore(db_path)
+        for i in range(0, len(records), 10000):
+            store.append_many(records[i:i + 10000])
+        json_path = os.path.join(tmp, 'records.json')
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(records, f, indent=4)
+        del records
+
+        baseline = int(subprocess.run(
+            [sys.executable, '-c', 'import resource, sys; sys.path.insert(0, sys.argv[1]); import analytics, storage; '
+             'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)', repo],
+            capture_output=True, text=True, check=True
+        ).stdout)
+        print(f"{args.records} records · store {os.path.getsize(db_path) / 1e6:.0f} MB · "
+              f"legacy JSON {os.path.getsize(json_path) / 1e6:.0f} MB · interpreter baseline {baseline / 1024:.0f} MB")
+        for command, source in (('json.load', json_path), ('iter_json_array', json_path),
+                                ('jsonl', db_path), ('csv', db_path), ('parquet', db_path)):
+            out = os.path.join(tmp, f'export.{command}')
+            count, elapsed, peak = subprocess.run(
+                [sys.executable, '-c', script, command, source, out], capture_output=True, text=True, check=True
+            ).stdout.split()
+            size = f" -> {os.path.getsize(out) / 1e6:5.0f} MB" if os.path.exists(out) else ''
+            print(f"  {command:>15}: {int(count) / float(elapsed):9,.0f} records/s, "
+                  f"peak RSS +{(int(peak) - baseline) / 1024:6.0f} MB{size}")
+
+        rollups = Rollups(os.path.join(tmp, 'analytics.db'))
+        start = time.perf_counter()
+        rollups.sync(store)
+        print(f"  rollup rebuild: {time.perf_counter() - start:.1f} s")
+        for label, operation in (
+            ('save update', lambda n: rollups.add(dict(_sample_record(n), record_id=f'new-{n}', age=40,
+                                                      gender='Female', timestamp='2025-12-31T00:00:00'))),
+            ('chat update', lambda n: rollups.add_chat('report')),
+            ('dashboard read', lambda n: (rollups.totals(), rollups.analyses_per_day('2025-12-01'),
+                                          rollups.demographics(), rollups.chat_per_day('2025-12-01'))),
+        ):
+            latencies = []
+            for n in range(args.samples):
+                start = time.perf_counter()
+                operation(n)
+                latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+            print(f"  {label:>15}: p50 {statistics.median(latencies):.2f} ms, "
+                  f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.2f} ms")
+        rollups.close()
+        store.close()
+
+
+def _sample_pdf(pages):
+    """A PDF of A4 pages at 150 dpi, each with its own lines of lab results"""
+    import io
+
+    from PIL import Image, ImageDraw
+
+    images = []
+    for i in range(pages):
+        image = Image.new('RGB', (1240, 1754), 'white')
+        draw = ImageDraw.Draw(image)
+        for row in range(56):
+            draw.text((80, 100 + row * 28), f"Page {i + 1} · Test {row}: {(i * 31 + row * 7) % 997} mg/dL "
+                                            f"(ref 70-110)", fill='black')
+        images.append(image)
+    data = io.BytesIO()
+    images[0].save(data, 'PDF', save_all=True, append_images=images[1:], resolution=150)
+    return data.getvalue()
+
+
+def bench_documents(args):
+    """Multi-page report preparation inline vs. the page pool, and the
+    page-notes map step against a fake model"""
+    from cache import ResponseCache
+    from documents import create_page_pool, prepare_document, read_pages
+    from executor import LLMExecutor
+
+    data = _sample_pdf(args.pages)
+    print(f"{args.pages}-page PDF, {len(data) / 1024:,.0f} KB · {os.cpu_count()} CPUs")
+    document = None
+    for label, workers in (('inline', 1), (f'{args.workers} workers', args.workers)):
+        pool = create_page_pool(workers)
+        if pool is None and workers > 1:
+            continue
+        walls = []
+        for _ in range(args.samples):
+            document = prepare_document([('report.pdf', data)], pool, workers=workers)
+            walls.append(document.wall_ms)
+        if pool is not None:
+            pool.shutdown()
+        work = sum(t['total_ms'] for t in document.timings)
+        print(f"  {label:>10}: p50 {statistics.median(walls):,.0f} ms wall, {work:,.0f} ms of page work")
+    for stage in ('render_ms', 'decode_ms', 'quality_ms', 'encode_ms', 'total_ms'):
+        values = sorted(t[stage] for t in document.timings)
+        print(f"  per page {stage[:-3]:>8}: p50 {statistics.median(values):.1f} ms, max {values[-1]:.1f} ms")
+
+    model = _FakeStreamingModel(latency=args.latency, error_rate=0)
+    # The app's executor settings (MEDASSIST_MAX_WORKERS, MEDASSIST_MAX_PENDING), with the rate limit lifted
+    executor = LLMExecutor(requests_per_minute=6000)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ResponseCache(os.path.join(tmp, 'cache.db'))
+        start = time.perf_counter()
+        read_pages(model, cache, executor, document.pages)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        read_pages(model, cache, executor, document.pages)
+        warm = time.perf_counter() - start
+    executor.shutdown()
+    print(f"  page notes: {cold:.2f} s for {len(document.pages)} pages ({len(document.pages) * args.latency:.1f} s "
+          f"one after another) · {warm * 1000:.1f} ms from cache")
+
+
+_STARTUP_SCRIPT = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+start = time.perf_counter()
+at.run()
+first = time.perf_counter() - start
+reruns = []
+for _ in range(int(sys.argv[2])):
+    start = time.perf_counter()
+    at.run()
+    reruns.append(time.perf_counter() - start)
+heavy = [m for m in ('google.generativeai', 'PIL.Image', 'pandas') if m in sys.modules]
+print(json.dumps({'first': first, 'reruns': reruns, 'errors': len(at.exception), 'loaded': heavy}))
+"""
+
+
+def bench_startup(args):
+    """First-run (cold process) and rerun time of app.py under AppTest"""
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=app_dir, PYTHONWARNINGS='ignore')
+    firsts, reruns = [], []
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(args.processes):
+            # A fresh interpreter per sample so module imports are cold
+            out = subprocess.run(
+                [sys.executable, '-c', _STARTUP_SCRIPT, os.path.join(app_dir, 'app.py'), str(args.reruns)],
+                cwd=tmp, env=env, capture_output=True, text=True, check=True
+            ).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            firsts.append(result['first'] * 1000)
+            reruns += [r * 1000 for r in result['reruns']]
+    print(f"first run: p50 {statistics.median(firsts):.0f} ms over {args.processes} processes "
+          f"({result['errors']} exceptions)")
+    print(f"rerun:     p50 {statistics.median(reruns):.1f} ms over {len(reruns)} reruns")
+    print(f"heavy modules loaded before first use: {', '.join(result['loaded']) or 'none'}")
+
+
+# flow -> (uploader, analyze button, chat input, chat send button)
+_FLOW_KEYS = {
+    'report': ('report_uploader', 'analyze_report', 'report_chat_input', 'report_send'),
+    'skin': ('skin_upload', 'detect', 'skin_chat_input', 'skin_send'),
+}
+
+
+def _sample_upload(seed):
+    """A small PNG that differs per seed, so uploads never hit the response cache"""
+    import io
+
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGB', (640, 480), 'white')
+    draw = ImageDraw.Draw(image)
+    for row in range(12):
+        draw.text((20, 20 + row * 36), f"Test {row}: {(seed * 31 + row * 7) % 997} mg/dL", fill='black')
+    data = io.BytesIO()
+    image.save(data, 'PNG')
+    return data.getvalue()
+
+
+def _wait_for_analysis(at, poll=0.05):
+    """Rerun until the analysis job shows its result (or an error); the app
+    only polls the job in a fragment, which AppTest doesn't run on a timer"""
+    while not any(m.value.endswith('Analysis Complete') for m in at.success) and not at.error and not at.exception:
+        time.sleep(poll)
+        at.run()
+
+
+def _run_flow(at, flow, i):
+    """Drive one flow through the UI; returns the number of failures shown"""
+    if flow == 'query':
+        at.text_area[0].input(f"What are the symptoms of diabetes? ({i})")
+        at.button(key='summarize').click().run()
+    else:
+        uploader, analyze, chat_input, send = _FLOW_KEYS[flow]
+        at.file_uploader(key=uploader).clear().upload(f'{flow}-{i}.png', _sample_upload(i), 'image/png')
+        at.run()
+        at.button(key=analyze).click().run()
+        _wait_for_analysis(at)
+        at.text_input(key=chat_input).input(f"What does this mean for me? ({i})")
+        at.button(key=send).click().run()
+    return len(at.exception) + sum(e.value.startswith('❌') for e in at.error)
+
+
+def _flow_user(user_id, app_path, flows, iterations, timeout):
+    """One simulated user (run in its own process); returns {flow: [(ms, errors)]}"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(app_path, default_timeout=timeout)
+    at.run()
+    at.sidebar.text_input[0].input(f"Bench user {user_id}")
+    at.sidebar.checkbox(key='use_response_cache').uncheck()
+    at.run()
+    results = {flow: [] for flow in flows}
+    for i in range(iterations):
+        for flow in flows:
+            start = time.perf_counter()
+            errors = _run_flow(at, flow, user_id * 1000 + i)
+            results[flow].append(((time.perf_counter() - start) * 1000, errors))
+    return results
+
+
+def bench_flows(args):
+    """Query, report and skin flows (with a chat turn) through AppTest against
+    the replay backend, one process per simulated user"""
+    from concurrent.futures import ProcessPoolExecutor
+
+    os.environ.update(
+        MEDASSIST_MODEL_BACKEND='replay',
+        MEDASSIST_RECORDING_FILE=os.path.abspath(args.recordings),
+        MEDASSIST_REPLAY_LATENCY=args.latency,
+        MEDASSIST_REQUESTS_PER_MINUTE=str(args.rpm),
+    )
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    flows = args.flows.split(',')
+    timings = {flow: [] for flow in flows}
+    errors = {flow: 0 for flow in flows}
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Stores, caches and traces of the run go to the temporary directory
+        os.chdir(tmp)
+        try:
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=args.users) as pool:
+                runs = [pool.submit(_flow_user, u, app_path, flows, args.iterations, args.timeout)
+                        for u in range(args.users)]
+                for run in runs:
+                    for flow, samples in run.result().items():
+                        timings[flow] += [ms for ms, _ in samples]
+                        errors[flow] += sum(e for _, e in samples)
+            wall = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+    results = {}
+    print(f"{'flow':>8} {'runs':>5} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+    for flow in flows:
+        latencies = sorted(timings[flow])
+        results[flow] = {
+            'p50_ms': round(statistics.median(latencies), 1),
+            'p95_ms': round(latencies[max(0, int(len(latencies) * 0.95) - 1)], 1),
+            'errors': errors[flow],
+        }
+        print(f"{flow:>8} {len(latencies):>5} {results[flow]['p50_ms']:>8.0f} {results[flow]['p95_ms']:>8.0f} "
+              f"{errors[flow]:>7}")
+    total = sum(len(t) for t in timings.values())
+    print(f"{total} flows by {args.users} users in {wall:.1f} s ({total / wall:.2f} flows/s)")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    failed = any(r['errors'] for r in results.values())
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        for flow, result in results.items():
+            limit = baseline.get(flow, {}).get('p50_ms', float('inf')) * (1 + args.tolerance)
+            if result['p50_ms'] > limit:
+                print(f"REGRESSION: {flow} p50 {result['p50_ms']:.0f} ms > {limit:.0f} ms")
+                failed = True
+    if failed:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('storage', help='save latency vs. store size')
+    p.add_argument('--backend', choices=sorted(storage.STORAGE_PATHS), default='sqlite')
+    p.add_argument('--sizes', default='1000,10000,100000,1000000')
+    p.add_argument('--samples', type=int, default=500)
+    p.set_defaults(func=bench_storage)
+
+    p = sub.add_parser('history', help='history lookup latency vs. store size')
+    p.add_argument('--backend', choices=sorted(storage.STORAGE_PATHS), default='sqlite')
+    p.add_argument('--sizes', default='1000,100000,1000000')
+    p.add_argument('--samples', type=int, default=500)
+    p.set_defaults(func=bench_history)
+
+    p = sub.add_parser('images', help='image preprocessing size and time')
+    p.add_argument('files', nargs='*')
+    p.set_defaults(func=bench_images)
+
+    p = sub.add_parser('executor', help='executor throughput against a fake model')
+    p.add_argument('--requests', type=int, default=40)
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--rpm', type=float, default=600)
+    p.add_argument('--latency', type=float, default=0.2)
+    p.add_argument('--error-rate', type=float, default=0.2)
+    p.set_defaults(func=bench_executor)
+
+    p = sub.add_parser('labs', help='lab trend query latency')
+    p.add_argument('--rows', type=int, default=1000000)
+    p.add_argument('--samples', type=int, default=200)
+    p.set_defaults(func=bench_labs)
+
+    p = sub.add_parser('dedup', help='near-duplicate image lookup latency')
+    p.add_argument('--images', type=int, default=100000)
+    p.add_argument('--samples', type=int, default=200)
+    p.set_defaults(func=bench_dedup)
+
+    p = sub.add_parser('vectors', help='history search latency vs. index size')
+    p.add_argument('--rows', type=int, default=1000000)
+    p.add_argument('--users', type=int, default=5000)
+    p.add_argument('--large-group', type=int, default=20000)
+    p.add_argument('--samples', type=int, default=100)
+    p.set_defaults(func=bench_vectors)
+
+    p = sub.add_parser('archive', help='archive tier size and read latency')
+    p.add_argument('--source', default=storage.LEGACY_DATA_FILE)
+    p.add_argument('--scale', type=int, default=1000)
+    p.add_argument('--samples', type=int, default=1000)
+    p.set_defaults(func=bench_archive)
+
+    p = sub.add_parser('quality', help='image quality check time')
+    p.add_argument('photos', nargs='*')
+    p.add_argument('--samples', type=int, default=20)
+    p.set_defaults(func=bench_quality)
+
+    p = sub.add_parser('analytics', help='export throughput/memory and rollup latency')
+    p.add_argument('--records', type=int, default=200000)
+    p.add_argument('--samples', type=int, default=500)
+    p.set_defaults(func=bench_analytics)
+
+    p = sub.add_parser('documents', help='multi-page report preparation and page-notes time')
+    p.add_argument('--pages', type=int, default=20)
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--samples', type=int, default=3)
+    p.add_argument('--latency', type=float, default=0.5)
+    p.set_defaults(func=bench_documents)
+
+    p = sub.add_parser('startup', help='app first-run and rerun time')
+    p.add_argument('--processes', type=int, default=5)
+    p.add_argument('--reruns', type=int, default=20)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser('flows', help='end-to-end UI flows against recorded model responses')
+    p.add_argument('--recordings', default='recordings.jsonl')
+    p.add_argument('--latency', default='lognormal:800,0.5',
+                   help='recorded, none, fixed:MS or lognormal:MEDIAN_MS,SIGMA')
+    p.add_argument('--users', type=int, default=4)
+    p.add_argument('--iterations', type=int, default=3)
+    p.add_argument('--flows', default='query,report,skin')
+    p.add_argument('--rpm', type=float, default=6000)
+    p.add_argument('--timeout', type=float, default=120)
+    p.add_argument('--save', help='write p50/p95 per flow to this JSON file')
+    p.add_argument('--baseline', help='fail if a p50 exceeds this saved result by more than --tolerance')
+    p.add_argument('--tolerance', type=float, default=0.2)
+    p.set_defaults(func=bench_flows)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
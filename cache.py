@@ -0,0 +1,143 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_FILE = 'response_cache.db'
+
+
+def normalize_query(text):
+    """Case- and whitespace-insensitive form of a user query"""
+    return ' '.join((text or '').lower().split()).rstrip('?.!। ')
+
+
+def sha256_bytes(data):
+    """Hex SHA-256 of raw bytes (e.g. an uploaded image)"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResponseCache:
+    """Content-addressed cache of model responses.
+
+    A bounded in-memory LRU sits in front of an SQLite tier on disk. Entries
+    expire after `ttl` seconds; the disk tier is also trimmed, least recently
+    used first, to stay under `max_disk_bytes`. Safe to share between
+    threads, i.e. between Streamlit sessions of one server process.
+    """
+
+    def __init__(self, path=CACHE_FILE, max_memory_items=256,
+                 max_disk_bytes=256 * 1024 * 1024, ttl=7 * 24 * 3600):
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'bypassed': 0}
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+        """)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed)')
+        self._conn.commit()
+        self._disk_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(template_id, language, query='', image_sha=None, context=''):
+        """Key for one model call.
+
+        `image_sha` is the SHA-256 of the image bytes sent with the prompt and
+        `context` any other text the answer depends on (e.g. the analysis a
+        chat question refers to).
+        """
+        h = hashlib.sha256()
+        for part in (template_id, language, normalize_query(query), image_sha or '', context or ''):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def get(self, key):
+        """Cached response text for `key`, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created = entry
+                if now - created < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return value
+                del self._memory[key]
+
+            row = self._conn.execute(
+                'SELECT value, created FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or now - row[1] >= self.ttl:
+                self.stats['misses'] += 1
+                return None
+            with self._conn:
+                self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self._remember(key, row[0], row[1])
+            self.stats['disk_hits'] += 1
+            return row[0]
+
+    def set(self, key, value):
+        """Store a response; empty ones (e.g. a blocked or cut-off stream) are
+        not cached, so the next request asks the model again"""
+        if not value or not value.strip():
+            return
+        now = time.time()
+        size = len(value.encode('utf-8'))
+        with self._lock:
+            self._remember(key, value, now)
+            with self._conn:
+                old = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO responses (key, value, created, accessed, size) VALUES (?, ?, ?, ?, ?)',
+                    (key, value, now, now, size)
+                )
+                self._disk_bytes += size - (old[0] if old else 0)
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._evict(now)
+
+    def record_bypass(self):
+        with self._lock:
+            self.stats['bypassed'] += 1
+
+    def hit_rate(self):
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now):
+        """Drop expired entries, then least recently used ones, until 10%
+        under the disk budget. Called with the lock held inside a transaction."""
+        self._conn.execute('DELETE FROM responses WHERE created <= ?', (now - self.ttl,))
+        self._disk_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        target = int(self.max_disk_bytes * 0.9)
+        rows = self._conn.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall()
+        doomed = []
+        for key, size in rows:
+            if self._disk_bytes <= target:
+                break
+            doomed.append((key,))
+            self._disk_bytes -= size
+            self._memory.pop(key, None)
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', doomed)
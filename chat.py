@@ -0,0 +1,181 @@
+import hashlib
+import io
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import prompts
+from documents import label_pages, notes_part
+
+# Approximate token budget for the replayed question/answer turns of a chat
+CHAT_TOKEN_BUDGET = int(os.getenv('MEDASSIST_CHAT_TOKEN_BUDGET', '6000'))
+# Most recent turns that are always replayed verbatim
+KEEP_RECENT_TURNS = 2
+# Characters of an old answer kept in the running summary
+SUMMARY_ANSWER_CHARS = 240
+SUMMARY_MAX_CHARS = 2000
+# Pages of a document uploaded to the File API at the same time
+MAX_PARALLEL_UPLOADS = 8
+
+# Follow-up chat template -> (session template, legacy single-shot template)
+CHAT_TEMPLATES = {
+    'report': (prompts.REPORT_CHAT_SESSION, prompts.REPORT_CHAT),
+    'skin': (prompts.SKIN_CHAT_SESSION, prompts.SKIN_CHAT),
+}
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token)"""
+    return max(1, len(text) // 4) if text else 0
+
+
+def estimate_image_tokens(width, height):
+    """Gemini bills small images as 258 tokens and larger ones per 768px tile"""
+    if width <= 384 and height <= 384:
+        return 258
+    return math.ceil(width / 768) * math.ceil(height / 768) * 258
+
+
+class Conversation:
+    """Multi-turn follow-up chat about one analyzed image or multi-page report.
+
+    Each page is uploaded once through the File API and referenced by URI on
+    every later turn (inline bytes are used only if an upload fails). A
+    report analyzed from page notes (too many pages for one request) is
+    discussed from those notes instead of its images. The model's analysis
+    is replayed as its own first turn, prior questions and answers are kept
+    as chat history, and turns beyond CHAT_TOKEN_BUDGET are folded into a
+    short running summary.
+    """
+
+    def __init__(self, kind, analysis, image, page_notes=None):
+        self.kind = kind
+        self.session_template, self.legacy_template = CHAT_TEMPLATES[kind]
+        self.analysis = analysis
+        self.image = image
+        # A PreparedDocument (documents.py) or a single PreparedImage
+        self.pages = list(getattr(image, 'pages', [image]))
+        self.page_notes = page_notes
+        self.page_uris = []
+        self.upload_failed = False
+        self.turns = []
+        self.summary = ''
+        self.accounting = []
+
+    def matches(self, analysis, image):
+        return self.analysis == analysis and self.image.sha256 == image.sha256
+
+    def pending_image_bytes(self):
+        """Image bytes the next turn sends (only before the pages are referenced by URI)"""
+        if self.page_notes or self.page_uris:
+            return 0
+        return sum(len(page.data) for page in self.pages)
+
+    def context_key(self):
+        """Digest of everything a new answer depends on besides the question"""
+        h = hashlib.sha256()
+        for part in [self.analysis, self.summary] + [text for turn in self.turns for text in turn]:
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def history(self, language):
+        """Chat history for model.start_chat"""
+        history = [
+            {'role': 'user', 'parts': self._document_parts() + [self._session_prompt(language)]},
+            {'role': 'model', 'parts': [self.analysis]},
+        ]
+        if self.summary:
+            history += [
+                {'role': 'user', 'parts': [f"Summary of our earlier conversation:\n{self.summary}"]},
+                {'role': 'model', 'parts': ["Understood."]},
+            ]
+        for question, answer in self.turns:
+            history += [
+                {'role': 'user', 'parts': [question]},
+                {'role': 'model', 'parts': [answer]},
+            ]
+        return history
+
+    def send(self, model, question, language):
+        """Start a streamed reply to `question`; returns the chunk iterator"""
+        self._attach_pages(model)
+        chat = model.start_chat(history=self.history(language))
+        message = prompts.build_prompt(prompts.CHAT_TURN, question=question, language=language)
+        return chat.send_message(message, stream=True)
+
+    def record_turn(self, question, answer, language, prompt_tokens=None):
+        """Add a finished turn to the history and account for its input tokens
+        against the previous approach (analysis + every page re-sent every turn)"""
+        legacy_prompt = prompts.build_prompt(
+            self.legacy_template, language=language, analysis=self.analysis, question=question
+        )
+        legacy_tokens = estimate_tokens(legacy_prompt) + self._image_tokens()
+        if prompt_tokens is None:
+            prompt_tokens = self._estimate_input_tokens(question, language)
+        entry = {
+            'input_tokens': prompt_tokens,
+            'legacy_input_tokens': legacy_tokens,
+            'tokens_saved': legacy_tokens - prompt_tokens,
+            # The first turn uploads the pages; later turns only reference them.
+            # Pages read into notes are never sent again.
+            'upload_bytes_saved': (sum(len(page.data) for page in self.pages)
+                                   if self.page_notes or (self.page_uris and self.turns) else 0),
+        }
+        self.accounting.append(entry)
+
+        self.turns.append((question, answer))
+        self._enforce_budget()
+        return entry
+
+    def _attach_pages(self, model):
+        if self.page_notes or self.page_uris or self.upload_failed:
+            return
+        upload = lambda page: model.upload_file(io.BytesIO(page.data), mime_type=page.mime_type).uri
+        try:
+            with ThreadPoolExecutor(min(MAX_PARALLEL_UPLOADS, len(self.pages))) as uploads:
+                self.page_uris = list(uploads.map(upload, self.pages))
+        except Exception:
+            # Fall back to sending the pages inline
+            self.upload_failed = True
+
+    def _page_part(self, i):
+        if self.page_uris:
+            return {'file_data': {'mime_type': self.pages[i].mime_type, 'file_uri': self.page_uris[i]}}
+        return self.pages[i].as_part()
+
+    def _document_parts(self):
+        if self.page_notes:
+            return [notes_part(self.page_notes)]
+        return label_pages([self._page_part(i) for i in range(len(self.pages))])
+
+    def _session_prompt(self, language):
+        if len(self.pages) == 1 and not self.page_notes:
+            return prompts.build_prompt(self.session_template, language=language)
+        source = "the notes transcribed from each of its pages above" if self.page_notes else "its pages above"
+        return prompts.build_prompt(prompts.REPORT_DOCUMENT_CHAT_SESSION, pages=len(self.pages),
+                                    source=source, language=language)
+
+    def _image_tokens(self):
+        return sum(estimate_image_tokens(page.width, page.height) for page in self.pages)
+
+    def _estimate_input_tokens(self, question, language):
+        text = self._session_prompt(language) + self.analysis + self.summary
+        text += ''.join(q + a for q, a in self.turns) + question
+        if self.page_notes:
+            return estimate_tokens(text + self._document_parts()[0])
+        return estimate_tokens(text) + self._image_tokens()
+
+    def _enforce_budget(self):
+        """Fold the oldest turns into the summary until the replayed turns fit"""
+        def turn_tokens():
+            return sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.turns)
+
+        while len(self.turns) > KEEP_RECENT_TURNS and turn_tokens() > CHAT_TOKEN_BUDGET:
+            question, answer = self.turns.pop(0)
+            gist = ' '.join(answer.split())[:SUMMARY_ANSWER_CHARS]
+            self.summary += f"- Q: {question}\n  A: {gist}…\n"
+        if len(self.summary) > SUMMARY_MAX_CHARS:
+            # Drop the oldest summary lines, keeping whole lines
+            cut = self.summary.find('\n- Q:', len(self.summary) - SUMMARY_MAX_CHARS)
+            self.summary = self.summary[cut + 1:] if cut != -1 else self.summary[-SUMMARY_MAX_CHARS:]
@@ -0,0 +1,163 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+IMAGE_INDEX_FILE = os.getenv('MEDASSIST_IMAGE_INDEX', 'image_hashes.db')
+# Max Hamming distance (of 64 bits) for two uploads to count as the same image.
+# Kept low: different reports printed on the same lab template look alike.
+DUPLICATE_DISTANCE = int(os.getenv('MEDASSIST_DUPLICATE_DISTANCE', '6'))
+
+HASH_SIZE = 8
+_DCT_SIZE = 32
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT = _dct_matrix(_DCT_SIZE)
+
+
+def phash(image):
+    """64-bit perceptual hash of a decoded PIL image.
+
+    The image is reduced to 32×32 grayscale, transformed with a 2-D DCT and
+    the 8×8 lowest frequencies are thresholded at their median. Re-taken,
+    re-compressed or slightly cropped photos of the same page land within a
+    few bits of each other.
+    """
+    from PIL import Image
+
+    gray = image.convert('L').resize((_DCT_SIZE, _DCT_SIZE), Image.Resampling.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    bits = (low > np.median(low)).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash:
+    """Multi-index hashing of 64-bit hashes for Hamming radius search.
+
+    Each hash is split into max_distance + 1 disjoint chunks, each with its
+    own exact-match table. Two hashes within max_distance bits must agree
+    exactly on at least one chunk (pigeonhole), so the union of the chunk
+    buckets is a small candidate set that is then verified bit by bit.
+    """
+
+    def __init__(self, max_distance=DUPLICATE_DISTANCE):
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        bounds = [64 * i // chunks for i in range(chunks + 1)]
+        self._chunks = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+        self._tables = [{} for _ in self._chunks]
+        self._values = []
+        self._items = []
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, value, item):
+        position = len(self._values)
+        self._values.append(value)
+        self._items.append(item)
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            table.setdefault((value >> shift) & mask, []).append(position)
+
+    def search(self, value):
+        """[(distance, item)] within max_distance of `value`, closest first"""
+        candidates = set()
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            candidates.update(table.get((value >> shift) & mask, ()))
+        found = []
+        for position in candidates:
+            distance = hamming(value, self._values[position])
+            if distance <= self.max_distance:
+                found.append((distance, self._items[position]))
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+def _to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class ImageIndex:
+    """Perceptual hashes of analyzed uploads, for near-duplicate lookup.
+
+    Hashes are persisted in SQLite next to the record store. Lookups only
+    consider the same user's uploads of the same kind, through one
+    MultiIndexHash per (user, kind) that is loaded on first use and caught
+    up with rows added by other processes.
+    """
+
+    def __init__(self, path=IMAGE_INDEX_FILE, max_distance=DUPLICATE_DISTANCE):
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS image_hashes (
+                id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                phash INTEGER NOT NULL,
+                record_id TEXT NOT NULL,
+                timestamp TEXT
+            )
+        """)
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_image_hashes_user_kind ON image_hashes (user_id, kind)'
+        )
+        self._conn.commit()
+        # (user_id, kind) -> [MultiIndexHash, last loaded id]
+        self._tables = {}
+
+    def add(self, user_id, kind, value, record_id, timestamp=None):
+        """Remember the hash of an upload whose analysis was saved as `record_id`"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    'INSERT INTO image_hashes (user_id, kind, phash, record_id, timestamp) VALUES (?, ?, ?, ?, ?)',
+                    (user_id, kind, _to_signed(value), record_id, timestamp)
+                )
+
+    def find(self, user_id, kind, value):
+        """Closest earlier upload within `max_distance` bits as
+        {record_id, timestamp, distance}, or None"""
+        with self._lock:
+            matches = self._catch_up(user_id, kind).search(value)
+        if not matches:
+            return None
+        distance, (record_id, timestamp) = matches[0]
+        return {'record_id': record_id, 'timestamp': timestamp, 'distance': distance}
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM image_hashes').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _catch_up(self, user_id, kind):
+        entry = self._tables.setdefault((user_id, kind), [MultiIndexHash(self.max_distance), 0])
+        rows = self._conn.execute(
+            'SELECT id, phash, record_id, timestamp FROM image_hashes '
+            'WHERE user_id = ? AND kind = ? AND id > ? ORDER BY id',
+            (user_id, kind, entry[1])
+        ).fetchall()
+        for row_id, value, record_id, timestamp in rows:
+            entry[0].add(value & ((1 << 64) - 1), (record_id, timestamp))
+            entry[1] = row_id
+        return entry[0]
@@ -0,0 +1,311 @@
+"""Multi-page report uploads: image files and PDFs prepared as one document.
+
+PDF pages are rasterized and every page is preprocessed (imaging.py) in a
+process pool, so a long report takes about as long as its slowest pages
+rather than the sum of them. Identical files and identical pages are kept
+once. Documents with more than PAGES_PER_REQUEST pages are analyzed
+map-reduce style: read_pages() transcribes each page on its own and the
+notes are then analyzed together.
+"""
+import hashlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+
+import prompts
+from cache import ResponseCache, sha256_bytes
+from imaging import MAX_IMAGE_EDGE, PreparedImage, _to_rgb, prepare_image, preprocess_image
+
+# Resolution PDF pages are rendered at (before the MAX_IMAGE_EDGE cap)
+PDF_DPI = int(os.getenv('MEDASSIST_PDF_DPI', '150'))
+# Pages kept per upload; later pages are skipped
+MAX_PAGES = int(os.getenv('MEDASSIST_MAX_PAGES', '50'))
+# Pages sent to the model in one request. Longer documents are read page by
+# page and the notes combined (map-reduce), which keeps each request small.
+PAGES_PER_REQUEST = int(os.getenv('MEDASSIST_PAGES_PER_REQUEST', '10'))
+_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+PAGE_WORKERS = int(os.getenv('MEDASSIST_PAGE_WORKERS', str(min(4, _CPUS))))
+
+
+@dataclass
+class PreparedDocument:
+    """The unique pages of an upload (PreparedImage each), in upload order"""
+    pages: list
+    # "report.pdf p. 2" or the file name, per page
+    labels: list
+    # Preprocessing times per page (ms): render, decode, quality, encode, total
+    timings: list
+    # (label, label of the identical page kept)
+    duplicates: list = field(default_factory=list)
+    # Pages beyond MAX_PAGES that were not prepared
+    skipped: int = 0
+    original_bytes: int = 0
+    wall_ms: float = 0.0
+
+    @property
+    def sha256(self):
+        # A one-page document keeps its image's digest, so it shares cache entries with a single upload
+        if len(self.pages) == 1:
+            return self.pages[0].sha256
+        return hashlib.sha256('\0'.join(page.sha256 for page in self.pages).encode('utf-8')).hexdigest()
+
+    @property
+    def phash(self):
+        """Perceptual hash for near-duplicate lookup (one-page documents only)"""
+        return self.pages[0].phash if len(self.pages) == 1 else None
+
+    @property
+    def payload_bytes(self):
+        return sum(len(page.data) for page in self.pages)
+
+    def summary(self):
+        if len(self.pages) == 1 and not self.duplicates and not self.skipped and self.pages[0].original_bytes:
+            return self.pages[0].summary()
+        line = (f"{len(self.pages)} page{'s' if len(self.pages) > 1 else ''} · "
+                f"{self.original_bytes / 1024:,.0f} KB → {self.payload_bytes / 1024:,.0f} KB · "
+                f"prepared in {self.wall_ms:.0f} ms ({sum(t['total_ms'] for t in self.timings):.0f} ms of work)")
+        if self.duplicates:
+            line += f" · {len(self.duplicates)} duplicate{'s' if len(self.duplicates) > 1 else ''} skipped"
+        if self.skipped:
+            line += f" · {self.skipped} pages over the {MAX_PAGES}-page limit skipped"
+        return line
+
+
+def label_pages(parts):
+    """Prompt parts for the pages of a document, one part per page. More
+    than one page gets a "Page i of n:" text part before each."""
+    if len(parts) == 1:
+        return list(parts)
+    labelled = []
+    for i, part in enumerate(parts, 1):
+        labelled += [f"Page {i} of {len(parts)}:", part]
+    return labelled
+
+
+def format_page_notes(notes):
+    """Per-page notes of a document as one text, in page order"""
+    return '\n\n'.join(f"### Page {i}\n{text.strip()}" for i, text in enumerate(notes, 1))
+
+
+def notes_part(notes):
+    """Prompt part standing in for the pages of a document read into notes"""
+    return f"Notes transcribed from each page of the report:\n\n{format_page_notes(notes)}"
+
+
+def pack_pages(image):
+    """(JSON-serializable metadata, payload bytes) of the pages of an upload
+    (PreparedImage or PreparedDocument): the encoded pages back to back"""
+    pages = getattr(image, 'pages', [image])
+    meta = [{'mime_type': page.mime_type, 'width': page.width, 'height': page.height, 'sha256': page.sha256,
+             'bytes': len(page.data)} for page in pages]
+    return meta, b''.join(page.data for page in pages)
+
+
+def unpack_pages(meta, payload):
+    """PreparedDocument of the pages packed by pack_pages(); its sha256 is the
+    original upload's"""
+    pages = []
+    offset = 0
+    for page in meta:
+        data = payload[offset:offset + page['bytes']]
+        offset += page['bytes']
+        pages.append(PreparedImage(data=data, mime_type=page['mime_type'], thumbnail=b'', width=page['width'],
+                                   height=page['height'], sha256=page['sha256'], original_bytes=len(data),
+                                   decode_ms=0.0, encode_ms=0.0))
+    if offset != len(payload):
+        raise ValueError("The payload doesn't match its page list")
+    return PreparedDocument(pages, [''] * len(pages), [])
+
+
+def page_notes_key(page):
+    """Response cache key of the notes of one page (shared by all languages)"""
+    return ResponseCache.make_key(prompts.REPORT_PAGE_NOTES, '', image_sha=page.sha256)
+
+
+def request_page_notes(model, page):
+    """Transcribe one page; returns (notes, input tokens, seconds)"""
+    start = time.perf_counter()
+    response = model.generate_content([prompts.build_prompt(prompts.REPORT_PAGE_NOTES), page.as_part()])
+    usage = getattr(response, 'usage_metadata', None)
+    return response.text, getattr(usage, 'prompt_token_count', None), time.perf_counter() - start
+
+
+def read_pages(model, cache, executor, pages, on_page=None, use_cache=True):
+    """Map step: transcribe every page concurrently on the executor.
+
+    At most executor.max_workers pages are in flight at a time, the next one
+    submitted as each finishes, so a long document never fills the
+    executor's queue. Notes are cached per page as soon as they arrive, so a
+    failed run resumes where it stopped. `on_page(done, total)` reports
+    progress. Returns (notes, calls): per page the notes and a dict with
+    cached, seconds and input_tokens.
+    """
+    notes = [None] * len(pages)
+    calls = [None] * len(pages)
+    todo = []
+    for i, page in enumerate(pages):
+        key = page_notes_key(page)
+        cached = cache.get(key) if use_cache else None
+        if not use_cache:
+            cache.record_bypass()
+        if cached is not None:
+            notes[i] = cached
+            calls[i] = {'cached': True, 'seconds': 0.0, 'input_tokens': 0}
+        else:
+            todo.append((i, key))
+    done = len(pages) - len(todo)
+    if on_page:
+        on_page(done, len(pages))
+    window = max(1, getattr(executor, 'max_workers', 1))
+    todo.reverse()
+    in_flight = {}
+    while todo or in_flight:
+        while todo and len(in_flight) < window:
+            i, key = todo.pop()
+            in_flight[executor.submit(request_page_notes, model, pages[i])] = (i, key)
+        finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in finished:
+            i, key = in_flight.pop(future)
+            text, input_tokens, seconds = future.result()
+            cache.set(key, text)
+            notes[i] = text
+            calls[i] = {'cached': False, 'seconds': seconds, 'input_tokens': input_tokens}
+            done += 1
+            if on_page:
+                on_page(done, len(pages))
+    return notes, calls
+
+
+def is_pdf(name, data):
+    return data[:5] == b'%PDF-' or name.lower().endswith('.pdf')
+
+
+def create_page_pool(workers=PAGE_WORKERS):
+    """Process pool for page preparation, or None for a single worker (pages
+    are then prepared in this process). Workers are spawned, not forked
+    (forking a process that runs threads is unsafe), and started right away
+    so the first upload doesn't wait for them."""
+    if workers <= 1:
+        return None
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    for _ in range(workers):
+        pool.submit(_warm_up)
+    return pool
+
+
+def prepare_document(files, pool=None, max_pages=MAX_PAGES, workers=PAGE_WORKERS):
+    """Prepare uploaded files [(name, bytes)] as one PreparedDocument.
+
+    Image files and chunks of PDF pages are prepared in `pool` when there is
+    more than one page; a single page is prepared in this process. Raises
+    ValueError for a file that can't be read.
+    """
+    start = time.perf_counter()
+    tasks = []
+    duplicates = []
+    seen_files = {}
+    budget = max_pages
+    skipped = 0
+    original_bytes = 0
+    for name, data in files:
+        digest = sha256_bytes(data)
+        if digest in seen_files:
+            duplicates.append((name, seen_files[digest]))
+            continue
+        seen_files[digest] = name
+        original_bytes += len(data)
+        if is_pdf(name, data):
+            count = _pdf_page_count(name, data)
+            numbers = list(range(min(count, budget)))
+            skipped += count - len(numbers)
+            # Each task opens the PDF once and renders a run of its pages
+            chunk = max(1, -(-len(numbers) // workers))
+            for i in range(0, len(numbers), chunk):
+                tasks.append((_prepare_pdf_pages, name, data, numbers[i:i + chunk]))
+        elif budget:
+            numbers = [0]
+            tasks.append((_prepare_image_file, name, data))
+        else:
+            numbers = []
+            skipped += 1
+        budget -= len(numbers)
+
+    page_count = max_pages - budget
+    if pool is None or page_count <= 1:
+        results = [task[0](*task[1:]) for task in tasks]
+    else:
+        futures = [pool.submit(*task) for task in tasks]
+        results = [future.result() for future in futures]
+
+    pages, labels, timings = [], [], []
+    seen_pages = {}
+    for label, page, timing in (item for result in results for item in result):
+        if page.sha256 in seen_pages:
+            duplicates.append((label, seen_pages[page.sha256]))
+            continue
+        seen_pages[page.sha256] = label
+        pages.append(page)
+        labels.append(label)
+        timings.append(dict(timing, page=label))
+    if not pages:
+        raise ValueError("The upload has no pages")
+    return PreparedDocument(pages, labels, timings, duplicates, skipped, original_bytes,
+                            (time.perf_counter() - start) * 1000)
+
+
+def _pdf_page_count(name, data):
+    try:
+        import pypdfium2
+    except ImportError:
+        raise ValueError("PDF uploads need the pypdfium2 package") from None
+    try:
+        pdf = pypdfium2.PdfDocument(data)
+    except pypdfium2.PdfiumError as e:
+        raise ValueError(f"Could not read {name}: {e}") from None
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def _page_timing(page, render_ms, total_ms):
+    return {'render_ms': render_ms, 'decode_ms': page.decode_ms, 'quality_ms': page.quality_ms,
+            'encode_ms': page.encode_ms, 'total_ms': total_ms}
+
+
+def _prepare_image_file(name, data):
+    start = time.perf_counter()
+    try:
+        page = preprocess_image(data)
+    except Exception as e:
+        raise ValueError(f"Could not read {name}: {e}") from None
+    return [(name, page, _page_timing(page, 0.0, (time.perf_counter() - start) * 1000))]
+
+
+def _prepare_pdf_pages(name, data, numbers, dpi=PDF_DPI, max_edge=MAX_IMAGE_EDGE):
+    import pypdfium2
+
+    results = []
+    pdf = pypdfium2.PdfDocument(data)
+    try:
+        for number in numbers:
+            start = time.perf_counter()
+            page = pdf[number]
+            # Render straight at the size sent to the model rather than rendering large and downscaling
+            scale = min(dpi / 72, max_edge / max(page.get_size()))
+            image = _to_rgb(page.render(scale=scale).to_pil())
+            page.close()
+            render_ms = (time.perf_counter() - start) * 1000
+            prepared = prepare_image(image, original_bytes=0)
+            results.append((f"{name} p. {number + 1}", prepared,
+                            _page_timing(prepared, render_ms, (time.perf_counter() - start) * 1000)))
+    finally:
+        pdf.close()
+    return results
+
+
+def _warm_up():
+    # imaging imports Pillow on first use
+    import PIL.Image
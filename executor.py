@@ -0,0 +1,235 @@
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Sized to the Gemini API quota of the configured key
+REQUESTS_PER_MINUTE = float(os.getenv('MEDASSIST_REQUESTS_PER_MINUTE', '10'))
+MAX_WORKERS = int(os.getenv('MEDASSIST_MAX_WORKERS', '4'))
+MAX_PENDING = int(os.getenv('MEDASSIST_MAX_PENDING', '32'))
+# Embedding calls have a quota of their own and get a separate, smaller pool
+EMBED_REQUESTS_PER_MINUTE = float(os.getenv('MEDASSIST_EMBED_REQUESTS_PER_MINUTE', '100'))
+EMBED_MAX_WORKERS = int(os.getenv('MEDASSIST_EMBED_MAX_WORKERS', '2'))
+
+# HTTP status codes worth retrying (rate limited / transient server errors)
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+
+
+class QueueFull(Exception):
+    """Raised when the executor's queue is full"""
+
+
+def is_retryable(exc):
+    """True for 429/5xx errors from the API (google.api_core exceptions carry `code`)"""
+    return getattr(exc, 'code', None) in RETRYABLE_CODES
+
+
+def is_quota_error(exc):
+    return getattr(exc, 'code', None) == 429
+
+
+def describe_error(exc):
+    """User-facing description of a failed model call"""
+    if isinstance(exc, QueueFull):
+        return "The assistant is busy right now. Please try again in a moment."
+    if is_quota_error(exc):
+        return "The API quota for this key is exhausted. Please wait a minute and try again."
+    return str(exc)
+
+
+_EMPTY = object()
+
+
+def _open_stream(request):
+    """Start a streamed request and wait for its first chunk, so that errors
+    raised when opening the stream can still be retried"""
+    iterator = iter(request())
+    return next(iterator, _EMPTY), iterator
+
+
+class TokenBucket:
+    """Token-bucket rate limiter: `rate` tokens per second, bursts up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available; returns seconds waited"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class StreamJob:
+    """Handle for a streamed request running on the executor.
+
+    Iterating yields the chunks produced by the request in the worker thread.
+    While the job is still queued, `position()` is its place in line (0 means
+    it will run next).
+    """
+
+    _DONE = object()
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._chunks = queue.Queue()
+        self.started = threading.Event()
+
+    def position(self):
+        return self._executor.queue_position(self)
+
+    def iter_chunks(self, on_wait=None, poll_interval=0.5):
+        """Yield chunks; `on_wait(position)` is called while the job is queued"""
+        while True:
+            try:
+                item = self._chunks.get(timeout=poll_interval)
+            except queue.Empty:
+                if on_wait and not self.started.is_set():
+                    on_wait(self.position())
+                continue
+            if item is self._DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+
+class LLMExecutor:
+    """Bounded worker pool shared by all sessions for model requests.
+
+    Requests wait for a token-bucket rate limiter before they reach the API,
+    so the API key never sees more than its quota. The pool accepts at most
+    `max_pending` queued requests beyond those running; further submissions
+    fail fast with QueueFull. 429 and 5xx errors are retried with jittered
+    exponential backoff, up to `max_retries` times. For streamed requests
+    this only applies before the first chunk arrives.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, requests_per_minute=REQUESTS_PER_MINUTE,
+                 max_pending=MAX_PENDING, max_retries=4, base_delay=1.0, max_delay=30.0):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        rate = requests_per_minute / 60.0
+        self.bucket = TokenBucket(rate, capacity=max(1.0, min(max_workers, requests_per_minute)))
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm')
+        self._lock = threading.Lock()
+        self._waiting = deque()
+        self._running = 0
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'retries': 0, 'rejected': 0}
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on the pool with rate limiting and retries.
+        Returns a Future."""
+        future = Future()
+        ticket = object()
+        self._enqueue(ticket)
+
+        def run():
+            self._start(ticket)
+            try:
+                result = self._call_with_retries(lambda: fn(*args, **kwargs))
+            except BaseException as e:
+                self._finish(failed=True)
+                future.set_exception(e)
+            else:
+                self._finish()
+                future.set_result(result)
+
+        self._pool.submit(run)
+        return future
+
+    def stream(self, request):
+        """Run request() (which returns an iterable of chunks) on the pool and
+        hand the chunks back through a StreamJob"""
+        job = StreamJob(self)
+        self._enqueue(job)
+
+        def run():
+            self._start(job)
+            job.started.set()
+            try:
+                first, iterator = self._call_with_retries(lambda: _open_stream(request))
+                if first is not _EMPTY:
+                    job._chunks.put(first)
+                    for chunk in iterator:
+                        job._chunks.put(chunk)
+            except BaseException as e:
+                self._finish(failed=True)
+                job._chunks.put(e)
+            else:
+                self._finish()
+            job._chunks.put(StreamJob._DONE)
+
+        self._pool.submit(run)
+        return job
+
+    def queue_position(self, ticket):
+        with self._lock:
+            try:
+                return self._waiting.index(ticket)
+            except ValueError:
+                return 0
+
+    def load(self):
+        """(running, waiting) request counts"""
+        with self._lock:
+            return self._running, len(self._waiting)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _enqueue(self, ticket):
+        with self._lock:
+            if len(self._waiting) >= self.max_pending:
+                self.stats['rejected'] += 1
+                raise QueueFull(f"{len(self._waiting)} requests already waiting")
+            self._waiting.append(ticket)
+            self.stats['submitted'] += 1
+
+    def _start(self, ticket):
+        with self._lock:
+            self._waiting.remove(ticket)
+            self._running += 1
+
+    def _finish(self, failed=False):
+        with self._lock:
+            self._running -= 1
+            self.stats['failed' if failed else 'completed'] += 1
+
+    def _call_with_retries(self, call):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                return call()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                # Full jitter: sleep a random time up to the exponential cap
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                attempt += 1
+                with self._lock:
+                    self.stats['retries'] += 1
+                time.sleep(delay)
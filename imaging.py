@@ -0,0 +1,112 @@
+import io
+import os
+import time
+from dataclasses import dataclass, field
+
+from cache import sha256_bytes
+from dedup import phash
+from quality import measure
+
+# Long edge (pixels) of the image sent to the model
+MAX_IMAGE_EDGE = int(os.getenv('MEDASSIST_MAX_IMAGE_EDGE', '1600'))
+# Payload encoding: "JPEG" or "WEBP"
+IMAGE_FORMAT = os.getenv('MEDASSIST_IMAGE_FORMAT', 'JPEG').upper()
+IMAGE_QUALITY = 85
+THUMBNAIL_SIZE = (400, 400)
+
+MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+
+
+@dataclass
+class PreparedImage:
+    """An uploaded image decoded once and re-encoded for the model"""
+    data: bytes
+    mime_type: str
+    thumbnail: bytes
+    width: int
+    height: int
+    sha256: str
+    original_bytes: int
+    decode_ms: float
+    encode_ms: float
+    # Perceptual hash for near-duplicate lookup (dedup.py)
+    phash: int = 0
+    # Quality scores of the image sent to the model (quality.py)
+    quality: dict = field(default_factory=dict)
+    quality_ms: float = 0.0
+
+    def as_part(self):
+        """Inline blob accepted by GenerativeModel.generate_content"""
+        return {'mime_type': self.mime_type, 'data': self.data}
+
+    def summary(self):
+        return (f"{self.original_bytes / 1024:,.0f} KB → {len(self.data) / 1024:,.0f} KB "
+                f"({self.width}×{self.height}) · decoded in {self.decode_ms:.0f} ms")
+
+
+def _to_rgb(image):
+    from PIL import Image
+
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+
+def preprocess_image(data, max_edge=MAX_IMAGE_EDGE, image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    """Decode raw upload bytes once, auto-orient, cap the long edge and
+    re-encode to a compact payload plus a display thumbnail"""
+    # Pillow is imported on the first upload rather than on the first page load
+    from PIL import Image, ImageOps
+
+    start = time.perf_counter()
+    image = Image.open(io.BytesIO(data))
+    if image.format == 'JPEG' and max(image.size) > max_edge:
+        # Let libjpeg downscale by 1/2, 1/4 or 1/8 while decoding, never below the target size
+        scale = max_edge / max(image.size)
+        image.draft('RGB', (int(image.width * scale), int(image.height * scale)))
+    image = ImageOps.exif_transpose(image)
+    image = _to_rgb(image)
+    image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    decode_ms = (time.perf_counter() - start) * 1000
+    return prepare_image(image, sha256_bytes(data), len(data), decode_ms, image_format, quality)
+
+
+def prepare_image(image, sha256=None, original_bytes=0, decode_ms=0.0, image_format=IMAGE_FORMAT,
+                  quality=IMAGE_QUALITY):
+    """Score and encode a decoded RGB image already capped to the model's
+    size. `sha256` defaults to the digest of the encoded payload."""
+    from PIL import Image
+
+    start = time.perf_counter()
+    quality_scores = measure(image)
+    quality_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    payload = io.BytesIO()
+    image.save(payload, image_format, quality=quality, optimize=True)
+    thumbnail = image.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+    thumbnail_bytes = io.BytesIO()
+    thumbnail.save(thumbnail_bytes, 'JPEG', quality=80)
+    perceptual_hash = phash(thumbnail)
+    encode_ms = (time.perf_counter() - start) * 1000
+
+    return PreparedImage(
+        data=payload.getvalue(),
+        mime_type=MIME_TYPES[image_format],
+        thumbnail=thumbnail_bytes.getvalue(),
+        width=image.width,
+        height=image.height,
+        sha256=sha256 or sha256_bytes(payload.getvalue()),
+        original_bytes=original_bytes,
+        decode_ms=decode_ms,
+        encode_ms=encode_ms,
+        phash=perceptual_hash,
+        quality=quality_scores,
+        quality_ms=quality_ms
+    )
@@ -0,0 +1,276 @@
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from executor import describe_error
+
+logger = logging.getLogger(__name__)
+
+JOBS_FILE = os.getenv('MEDASSIST_JOBS_FILE', 'jobs.db')
+JOB_WORKERS = int(os.getenv('MEDASSIST_JOB_WORKERS', '4'))
+# A running job whose worker stops renewing its lease (e.g. the server
+# process died) is picked up again by any worker once the lease runs out
+JOB_LEASE_SECONDS = 60
+MAX_ATTEMPTS = 3
+# How often a page showing a pending job checks on it
+JOB_POLL_SECONDS = 0.25
+# Finished jobs are kept this long so a session that comes back to it still gets its result
+JOB_RETENTION_SECONDS = float(os.getenv('MEDASSIST_JOB_RETENTION_HOURS', '24')) * 3600
+
+
+class JobQueue:
+    """Persistent job queue in SQLite, processed by worker threads.
+
+    A job is a registered handler kind plus JSON params and an optional
+    binary payload. Handlers run as handler(params, payload, progress) and
+    return a JSON-serializable result; progress(text) publishes partial
+    output that get() returns while the job runs in this process. A job
+    submitted with an owner is only visible to get() and payload() calls
+    passing the same owner; token() signs a job for its owner so a new
+    session (e.g. after a page reload) can take it over with resume().
+    Submitting a job with the same key as a queued
+    or running one returns that job instead of adding another. Jobs survive
+    reruns and disconnects, and a job left running by a dead process is
+    retried up to MAX_ATTEMPTS times.
+    """
+
+    def __init__(self, path=JOBS_FILE, workers=JOB_WORKERS, lease_seconds=JOB_LEASE_SECONDS):
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                job_key TEXT,
+                owner TEXT,
+                params TEXT NOT NULL,
+                payload BLOB,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                lease_until REAL
+            )
+        """)
+        if 'owner' not in [row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')]:
+            self._conn.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_time ON jobs (status, created_at)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_key ON jobs (job_key, status)')
+        # Signing key of job tokens, shared by every process using this queue
+        self._conn.execute('CREATE TABLE IF NOT EXISTS secrets (name TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        self._conn.execute("INSERT OR IGNORE INTO secrets (name, value) VALUES ('job_token', ?)", (os.urandom(32),))
+        self._secret = self._conn.execute("SELECT value FROM secrets WHERE name = 'job_token'").fetchone()[0]
+        self._handlers = {}
+        # job_id -> partial output of jobs running in this process
+        self._progress = {}
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def start(self):
+        """Start the worker threads and the lease heartbeat"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            self._threads.append(threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True))
+        self._threads.append(threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, kind, key, params, payload=None, owner=None):
+        """Queue a job; returns (job_id, True if it joined an identical pending
+        job). Only jobs of the same owner are joined."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    "SELECT job_id FROM jobs WHERE job_key = ? AND owner IS ? AND status IN ('queued', 'running') "
+                    'ORDER BY created_at LIMIT 1', (key, owner)
+                ).fetchone()
+                if row is None:
+                    job_id = uuid.uuid4().hex
+                    self._conn.execute(
+                        'INSERT INTO jobs (job_id, kind, job_key, owner, params, payload, status, created_at) '
+                        "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                        (job_id, kind, key, owner, json.dumps(params), payload, now)
+                    )
+                    self._conn.execute(
+                        "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                        (now - JOB_RETENTION_SECONDS,)
+                    )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        if row is not None:
+            return row[0], True
+        self._wakeup.set()
+        return job_id, False
+
+    def get(self, job_id, owner=None):
+        """Job status as a dict (job_id, kind, status, result, error, position,
+        progress, timestamps), or None for an unknown or expired job or one
+        of another owner"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT kind, status, result, error, attempts, created_at, started_at, finished_at '
+                'FROM jobs WHERE job_id = ? AND owner IS ?', (job_id, owner)
+            ).fetchone()
+            if row is None:
+                return None
+            job = dict(zip(('kind', 'status', 'result', 'error', 'attempts', 'created_at', 'started_at',
+                            'finished_at'), row), job_id=job_id)
+            if job['status'] == 'queued':
+                job['position'] = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (job['created_at'],)
+                ).fetchone()[0]
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        job['progress'] = self._progress.get(job_id)
+        return job
+
+    def token(self, job_id, owner):
+        """Token proving `owner` owns the job, safe to put in a page URL"""
+        return f'{job_id}.{self._sign(job_id, owner)}'
+
+    def resume(self, token, owner):
+        """Hand the job of a token() over to `owner` (e.g. the new session of
+        a reloaded page); returns its job_id, or None for a token that is
+        invalid or no longer matches the job's owner"""
+        job_id, _, signature = token.partition('.')
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT owner FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+                valid = row is not None and hmac.compare_digest(signature, self._sign(job_id, row[0]))
+                if valid:
+                    self._conn.execute('UPDATE jobs SET owner = ? WHERE job_id = ?', (owner, job_id))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return job_id if valid else None
+
+    def payload(self, job_id, owner=None):
+        with self._lock:
+            row = self._conn.execute('SELECT payload FROM jobs WHERE job_id = ? AND owner IS ?',
+                                     (job_id, owner)).fetchone()
+        return row[0] if row else None
+
+    def wait(self, job_id, timeout=None, poll=0.2, owner=None):
+        """Block until the job finishes; returns get(job_id, owner)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.get(job_id, owner)
+            if job is None or job['status'] in ('done', 'failed'):
+                return job
+            if deadline is not None and time.monotonic() > deadline:
+                return job
+            time.sleep(poll)
+
+    def counts(self):
+        """Number of jobs per status"""
+        with self._lock:
+            return dict(self._conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def close(self):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        with self._lock:
+            self._conn.close()
+
+    def _sign(self, job_id, owner):
+        return hmac.new(self._secret, f'{job_id}\0{owner}'.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def _claim(self):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Jobs of dead workers (expired lease) that used up their attempts fail for good
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = 'The worker processing this job stopped.', "
+                    "finished_at = ? WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                    (now, now, MAX_ATTEMPTS)
+                )
+                kinds = list(self._handlers)
+                row = self._conn.execute(
+                    'SELECT job_id, kind, params, payload FROM jobs '
+                    f"WHERE kind IN ({','.join('?' * len(kinds))}) "
+                    "AND (status = 'queued' OR (status = 'running' AND lease_until < ?)) "
+                    'ORDER BY created_at LIMIT 1', kinds + [now]
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', started_at = ?, lease_until = ?, "
+                        'attempts = attempts + 1 WHERE job_id = ?',
+                        (now, now + self.lease_seconds, row[0])
+                    )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return row
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_until = NULL, '
+                    'payload = NULL WHERE job_id = ?',
+                    (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+                )
+        self._progress.pop(job_id, None)
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                job = self._claim()
+            except sqlite3.OperationalError:
+                # Another process holds the write lock for longer than the timeout
+                job = None
+            if job is None:
+                # Also polls for jobs submitted by other processes
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+                continue
+            job_id, kind, params, payload = job
+            self._progress[job_id] = None
+            progress = lambda text, job_id=job_id: self._progress.__setitem__(job_id, text)
+            try:
+                result = self._handlers[kind](json.loads(params), payload, progress)
+            except Exception as e:
+                logger.exception('Job %s (%s) failed', job_id, kind)
+                self._finish(job_id, 'failed', error=describe_error(e))
+            else:
+                self._finish(job_id, 'done', result=result)
+
+    def _heartbeat(self):
+        while not self._stopping.wait(self.lease_seconds / 3):
+            running = list(self._progress)
+            if not running:
+                continue
+            with self._lock:
+                with self._conn:
+                    self._conn.executemany(
+                        "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND status = 'running'",
+                        [(time.time() + self.lease_seconds, job_id) for job_id in running]
+                    )
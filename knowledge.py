@@ -0,0 +1,126 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from vectors import VectorIndex
+
+KNOWLEDGE_FILE = os.getenv('MEDASSIST_KNOWLEDGE_FILE', 'knowledge.db')
+KNOWLEDGE_VECTORS_PREFIX = os.getenv('MEDASSIST_KNOWLEDGE_VECTORS', 'knowledge_vectors')
+# Cosine similarity of the query embeddings at which an earlier answer is
+# returned as is. High on purpose: "symptoms of type 1 diabetes" and
+# "symptoms of type 2 diabetes" embed very close to each other.
+ANSWER_SIMILARITY = float(os.getenv('MEDASSIST_KNOWLEDGE_ANSWER_SIMILARITY', '0.95'))
+# Minimum similarity of an earlier answer given to the model as context
+CONTEXT_SIMILARITY = float(os.getenv('MEDASSIST_KNOWLEDGE_CONTEXT_SIMILARITY', '0.75'))
+CONTEXT_ANSWERS = 3
+# Characters of each earlier answer included as context
+CONTEXT_CHARS = 2000
+# Questions about the asker themselves ("my", "I have", an age) are answered
+# but not added, so one user's details never reach another user's answer
+_PERSONAL = re.compile(r"\b(i|i'm|im|i've|i'd|me|my|mine|myself|we|our|us)\b|\b\d{1,3}\s*(years?|yrs?|y/?o)\b",
+                       re.IGNORECASE)
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+def entry_id(query, language):
+    return hashlib.sha256(f"{language}\0{normalize_query(query)}".encode('utf-8')).hexdigest()
+
+
+def is_personal(query):
+    return _PERSONAL.search(query) is not None
+
+
+def format_context(entries):
+    """Earlier answers rendered for the query_grounded prompt"""
+    return '\n\n---\n\n'.join(
+        f"Earlier question: {e['query']}\nAnswer:\n{e['answer'][:CONTEXT_CHARS]}" for e in entries
+    )
+
+
+class KnowledgeCache:
+    """Answered medical queries, matched by meaning.
+
+    Each answer is stored with the embedding of its query in a VectorIndex
+    group per language ("query:<language>"). retrieve() returns an earlier
+    answer whose query is at least ANSWER_SIMILARITY close, or else the
+    related earlier answers to ground a new model call. Answers are shared by
+    all users, like the response cache, so add() skips personal questions.
+    """
+
+    def __init__(self, embedding_model, path=KNOWLEDGE_FILE, vectors_prefix=KNOWLEDGE_VECTORS_PREFIX):
+        # One index per embedding model: vectors of different models don't compare
+        self.index = VectorIndex(f'{vectors_prefix}.{embedding_model}')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(answers)')]
+        if 'user_id' in columns:
+            # Entries scoped to a (per-session) user never match again and may hold personal questions
+            self._conn.execute('DROP TABLE answers')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                entry_id TEXT PRIMARY KEY,
+                language TEXT NOT NULL,
+                query TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self._conn.commit()
+        self.stats = {'answered': 0, 'grounded': 0, 'missed': 0}
+
+    def retrieve(self, vector, language, k=CONTEXT_ANSWERS):
+        """(answer, context) for a query embedding.
+
+        `answer` is an earlier entry close enough to return as is, or None;
+        `context` the related earlier entries (best first) otherwise. Entries
+        are dicts with entry_id, query, answer and similarity.
+        """
+        matches = [(s, i) for s, i in self.index.search(vector, f'query:{language}', k) if s >= CONTEXT_SIMILARITY]
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT entry_id, query, answer FROM answers WHERE entry_id IN ({','.join('?' * len(matches))})",
+                [i for _, i in matches]
+            ).fetchall() if matches else []
+        found = {row[0]: {'entry_id': row[0], 'query': row[1], 'answer': row[2]} for row in rows}
+        entries = [dict(found[i], similarity=s) for s, i in matches if i in found]
+        with self._lock:
+            if entries and entries[0]['similarity'] >= ANSWER_SIMILARITY:
+                with self._conn:
+                    self._conn.execute('UPDATE answers SET hits = hits + 1 WHERE entry_id = ?', (entries[0]['entry_id'],))
+                self.stats['answered'] += 1
+                return entries[0], []
+            self.stats['grounded' if entries else 'missed'] += 1
+        return None, entries
+
+    def add(self, query, language, answer, vector):
+        """Store the answer to `query` with the query's embedding; returns
+        False (nothing stored) for a personal question"""
+        if is_personal(query):
+            return False
+        key = entry_id(query, language)
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO answers (entry_id, language, query, answer, created_at) VALUES (?, ?, ?, ?, ?)',
+                    (key, language, query, answer, time.time())
+                )
+        self.index.add_many([(key, vector, [f'query:{language}'])])
+        return True
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        self.index.close()
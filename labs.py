@@ -0,0 +1,190 @@
+import json
+import re
+import sqlite3
+import threading
+from datetime import datetime
+
+import numpy as np
+
+import prompts
+
+LAB_DB_FILE = 'lab_values.db'
+
+# JSON schema for the structured-output extraction call
+LAB_VALUES_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'report_date': {'type': 'string', 'nullable': True},
+        'lab_values': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'test': {'type': 'string'},
+                    'value': {'type': 'number'},
+                    'unit': {'type': 'string', 'nullable': True},
+                    'ref_low': {'type': 'number', 'nullable': True},
+                    'ref_high': {'type': 'number', 'nullable': True},
+                    'flag': {'type': 'string', 'enum': ['low', 'normal', 'high', 'critical'], 'nullable': True},
+                },
+                'required': ['test', 'value'],
+            },
+        },
+    },
+    'required': ['lab_values'],
+}
+
+EXTRACTION_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': LAB_VALUES_SCHEMA,
+    'temperature': 0,
+}
+
+# Common spellings of the same test, mapped onto one key
+TEST_ALIASES = {
+    'glycatedhemoglobin': 'hba1c',
+    'glycatedhaemoglobin': 'hba1c',
+    'glycosylatedhemoglobin': 'hba1c',
+    'hemoglobina1c': 'hba1c',
+    'haemoglobin': 'hemoglobin',
+    'hb': 'hemoglobin',
+    'hgb': 'hemoglobin',
+    'fbs': 'fastingbloodsugar',
+    'fastingglucose': 'fastingbloodsugar',
+    'fastingplasmaglucose': 'fastingbloodsugar',
+    'ldl': 'ldlcholesterol',
+    'hdl': 'hdlcholesterol',
+    'totalcholesterol': 'cholesterol',
+    'tsh': 'thyroidstimulatinghormone',
+}
+
+
+def test_key(name):
+    """Normalized test name used to index and group results"""
+    key = re.sub(r'[^0-9a-z]', '', (name or '').lower())
+    return TEST_ALIASES.get(key, key)
+
+
+def request_lab_values(model, report):
+    """Ask the model for the report's lab values; returns the JSON text
+    (see LAB_VALUES_SCHEMA). `report` is an image or a list of prompt parts
+    (the pages of a document, or notes transcribed from them)."""
+    prompt = prompts.build_prompt(prompts.LAB_EXTRACTION)
+    parts = [report.as_part()] if hasattr(report, 'as_part') else list(report)
+    response = model.generate_content([prompt] + parts, generation_config=EXTRACTION_CONFIG)
+    return response.text
+
+
+def parse_extraction(text):
+    """Parse the model's JSON answer into (rows, report_date). Rows are dicts
+    with test, value, unit, ref_low, ref_high and flag; malformed rows are
+    dropped."""
+    data = json.loads(text)
+    rows = []
+    for item in data.get('lab_values') or []:
+        try:
+            value = float(item['value'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        rows.append({
+            'test': str(item.get('test', '')).strip(),
+            'value': value,
+            'unit': item.get('unit'),
+            'ref_low': item.get('ref_low'),
+            'ref_high': item.get('ref_high'),
+            'flag': item.get('flag'),
+        })
+    return [r for r in rows if r['test']], data.get('report_date')
+
+
+class LabStore:
+    """Lab results of all users, clustered for per-user, per-test trend queries.
+
+    The table is WITHOUT ROWID with primary key (user_id, test_key, timestamp,
+    ...), so all results of one test for one user are stored contiguously in
+    time order. A trend query is a single range scan, returned as NumPy column
+    arrays.
+    """
+
+    def __init__(self, path=LAB_DB_FILE):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS lab_values (
+                user_id TEXT NOT NULL,
+                test_key TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                record_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                test TEXT NOT NULL,
+                value REAL NOT NULL,
+                unit TEXT,
+                ref_low REAL,
+                ref_high REAL,
+                flag TEXT,
+                PRIMARY KEY (user_id, test_key, timestamp, record_id, position)
+            ) WITHOUT ROWID
+        """)
+        self._conn.commit()
+
+    def add(self, user_id, record_id, timestamp, rows):
+        """Store the extracted rows of one report"""
+        values = [
+            (user_id, test_key(r['test']), timestamp, record_id, i, r['test'], r['value'],
+             r.get('unit'), r.get('ref_low'), r.get('ref_high'), r.get('flag'))
+            for i, r in enumerate(rows)
+        ]
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO lab_values VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', values
+                )
+
+    def tests_for_user(self, user_id):
+        """{test_key: display name} of the tests recorded for a user"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT test_key, MAX(test), COUNT(*) FROM lab_values WHERE user_id = ? GROUP BY test_key',
+                (user_id,)
+            ).fetchall()
+        return {key: f"{name} ({count})" for key, name, count in rows}
+
+    def trend(self, user_id, test):
+        """Time series of one test for one user as NumPy columns:
+        timestamp (datetime64), value, ref_low, ref_high (float64, NaN when
+        unknown), out_of_range (bool) and the most common unit"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT timestamp, value, ref_low, ref_high, unit FROM lab_values '
+                'WHERE user_id = ? AND test_key = ? ORDER BY timestamp',
+                (user_id, test_key(test))
+            ).fetchall()
+        if not rows:
+            empty = np.array([], dtype=float)
+            return {'timestamp': np.array([], dtype='datetime64[s]'), 'value': empty,
+                    'ref_low': empty, 'ref_high': empty, 'out_of_range': np.array([], dtype=bool),
+                    'unit': None}
+        timestamps, values, lows, highs, units = zip(*rows)
+        value = np.array(values, dtype=float)
+        ref_low = np.array(lows, dtype=float)
+        ref_high = np.array(highs, dtype=float)
+        return {
+            'timestamp': np.array([t[:19] for t in timestamps], dtype='datetime64[s]'),
+            'value': value,
+            'ref_low': ref_low,
+            'ref_high': ref_high,
+            'out_of_range': (value < ref_low) | (value > ref_high),
+            'unit': max(set(units) - {None}, key=units.count, default=None),
+        }
+
+
+def result_timestamp(report_date, fallback):
+    """Use the date printed on the report when the model found one"""
+    if report_date:
+        try:
+            return datetime.strptime(report_date, '%Y-%m-%d').isoformat()
+        except ValueError:
+            pass
+    return fallback
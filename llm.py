@@ -0,0 +1,330 @@
+"""Model backends.
+
+Every backend offers the subset of google.generativeai the app uses:
+generate_content(contents, stream=False, generation_config=None),
+start_chat(history).send_message(message, stream=False) and
+upload_file(file, mime_type), plus embed(texts, task_type) for text
+embeddings. MEDASSIST_MODEL_BACKEND selects one:
+
+- gemini (default): the Gemini API
+- record: the Gemini API, appending every request/response pair to
+  MEDASSIST_RECORDING_FILE
+- replay: answers from MEDASSIST_RECORDING_FILE without network access,
+  with MEDASSIST_REPLAY_LATENCY ("recorded", "none", "fixed:MS" or
+  "lognormal:MEDIAN_MS,SIGMA")
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+MODEL_NAME = 'gemini-2.0-flash-exp'
+EMBEDDING_MODEL = 'models/text-embedding-004'
+# Texts per embed_content request (the API accepts up to 100)
+EMBED_BATCH = 100
+
+MODEL_BACKEND = os.getenv('MEDASSIST_MODEL_BACKEND', 'gemini')
+RECORDING_FILE = os.getenv('MEDASSIST_RECORDING_FILE', 'recordings.jsonl')
+REPLAY_LATENCY = os.getenv('MEDASSIST_REPLAY_LATENCY', 'recorded')
+# Characters of the prompt text kept in a recording (the key covers all of it)
+RECORDED_PROMPT_CHARS = 2000
+# Requests without a recording fall back to one with the same prompt opening
+PREFIX_CHARS = 80
+
+
+def _content_parts(contents):
+    """Flatten generate_content / chat contents into a list of parts"""
+    if not isinstance(contents, list):
+        contents = [contents]
+    parts = []
+    for item in contents:
+        if isinstance(item, dict) and 'parts' in item:
+            parts.append(f"[{item.get('role', 'user')}]")
+            parts.extend(item['parts'])
+        else:
+            parts.append(item)
+    return parts
+
+
+def describe_request(contents, uploads=None):
+    """(key, prompt text, image hashes) of a request.
+
+    Images count by the SHA-256 of their bytes, whether sent inline or by a
+    File API URI (mapped through `uploads`), so a recording made against the
+    API matches a replayed request.
+    """
+    uploads = uploads or {}
+    texts, images = [], []
+    for part in _content_parts(contents):
+        if isinstance(part, str):
+            texts.append(part)
+        elif isinstance(part, dict) and 'data' in part:
+            images.append(hashlib.sha256(part['data']).hexdigest())
+        elif isinstance(part, dict) and 'file_data' in part:
+            uri = part['file_data']['file_uri']
+            images.append(uploads.get(uri, uri))
+    h = hashlib.sha256()
+    for piece in texts + images:
+        h.update(piece.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest(), '\n'.join(texts), images
+
+
+def _prompt_prefix(prompt):
+    return ' '.join(prompt.split())[:PREFIX_CHARS]
+
+
+def parse_latency(spec):
+    """Latency model for replay: returns f(recording) -> seconds"""
+    kind, _, params = spec.partition(':')
+    if kind == 'none':
+        return lambda recording: 0.0
+    if kind == 'recorded':
+        return lambda recording: recording.get('latency') or 0.0
+    if kind == 'fixed':
+        seconds = float(params) / 1000
+        return lambda recording: seconds
+    if kind == 'lognormal':
+        median_ms, sigma = (float(p) for p in params.split(','))
+        return lambda recording: random.lognormvariate(0, sigma) * median_ms / 1000
+    raise ValueError(f"Unknown replay latency: {spec}")
+
+
+def _usage(prompt_tokens, response_tokens):
+    return SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=response_tokens)
+
+
+def _chunk(text, usage=None):
+    return SimpleNamespace(text=text, parts=[text] if text else [], usage_metadata=usage)
+
+
+class _Chat:
+    """ChatSession stand-in: replays history + message through generate_content"""
+
+    def __init__(self, backend, history):
+        self._backend = backend
+        self.history = list(history or [])
+
+    def send_message(self, message, stream=False):
+        return self._backend.generate_content(self.history + [message], stream=stream)
+
+
+class _RecordedChat:
+    """A backend chat session whose turns are recorded as history + message"""
+
+    def __init__(self, recorder, history, chat):
+        self._recorder = recorder
+        self._chat = chat
+        self.history = list(history or [])
+
+    def send_message(self, message, stream=False):
+        start = time.perf_counter()
+        response = self._chat.send_message(message, stream=stream)
+        return self._recorder._capture(self.history + [message], response, stream, start)
+
+
+class GeminiBackend:
+    """The Gemini API through google.generativeai"""
+
+    def __init__(self, model_name=MODEL_NAME):
+        # Imported here: google.generativeai takes about half a second to import
+        import google.generativeai as genai
+        from dotenv import load_dotenv
+
+        # Load environment variables
+        load_dotenv()
+
+        # Configure Gemini API
+        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+
+        self._genai = genai
+        self.model = genai.GenerativeModel(model_name)
+        self.embedding_model = EMBEDDING_MODEL.rsplit('/', 1)[-1]
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        return self.model.generate_content(contents, stream=stream, **kwargs)
+
+    def start_chat(self, history=None):
+        return self.model.start_chat(history=history or [])
+
+    def upload_file(self, file, mime_type):
+        return self._genai.upload_file(file, mime_type=mime_type)
+
+    def embed(self, texts, task_type='retrieval_document'):
+        """One EMBEDDING_DIM vector per text"""
+        from vectors import EMBEDDING_DIM
+
+        vectors = []
+        for i in range(0, len(texts), EMBED_BATCH):
+            result = self._genai.embed_content(
+                model=EMBEDDING_MODEL,
+                content=texts[i:i + EMBED_BATCH],
+                task_type=task_type,
+                output_dimensionality=EMBEDDING_DIM
+            )
+            vectors.extend(result['embedding'])
+        return vectors
+
+
+class RecordingBackend:
+    """Wraps another backend and appends each request/response pair as a JSON line"""
+
+    def __init__(self, backend, path=RECORDING_FILE):
+        self._backend = backend
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+        self._uploads = {}
+        self.embedding_model = backend.embedding_model
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        start = time.perf_counter()
+        response = self._backend.generate_content(contents, stream=stream, **kwargs)
+        return self._capture(contents, response, stream, start)
+
+    def start_chat(self, history=None):
+        return _RecordedChat(self, history, self._backend.start_chat(history))
+
+    def upload_file(self, file, mime_type):
+        data = file.read()
+        file.seek(0)
+        uploaded = self._backend.upload_file(file, mime_type=mime_type)
+        self._uploads[uploaded.uri] = hashlib.sha256(data).hexdigest()
+        return uploaded
+
+    def embed(self, texts, task_type='retrieval_document'):
+        return self._backend.embed(texts, task_type)
+
+    def _capture(self, contents, response, stream, start):
+        if stream:
+            return self._record_stream(contents, response, start)
+        self._record(contents, response.text, response.usage_metadata, time.perf_counter() - start, None, False)
+        return response
+
+    def _record_stream(self, contents, response, start):
+        texts, usage, ttft = [], None, None
+        for chunk in response:
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            if chunk.usage_metadata and chunk.usage_metadata.prompt_token_count:
+                usage = chunk.usage_metadata
+            if chunk.parts:
+                texts.append(chunk.text)
+            yield chunk
+        self._record(contents, ''.join(texts), usage, time.perf_counter() - start, ttft, True)
+
+    def _record(self, contents, text, usage, latency, ttft, stream):
+        key, prompt, images = describe_request(contents, self._uploads)
+        entry = {
+            'key': key,
+            'prefix': _prompt_prefix(prompt),
+            'prompt': prompt[:RECORDED_PROMPT_CHARS],
+            'images': images,
+            'text': text,
+            'usage': {
+                'prompt_token_count': getattr(usage, 'prompt_token_count', None),
+                'candidates_token_count': getattr(usage, 'candidates_token_count', None),
+            },
+            'latency': round(latency, 4),
+            'ttft': round(ttft, 4) if ttft is not None else None,
+            'stream': stream,
+        }
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+
+class ReplayBackend:
+    """Answers requests from a recording file, without network access.
+
+    A request is matched on its key (prompt text and image hashes), then on
+    the opening of its prompt, which identifies the template. Requests with
+    no match at all get a placeholder answer (an empty extraction for JSON
+    requests), so load tests also run without any recordings.
+    """
+
+    STREAM_CHUNKS = 4
+    # Embeddings are computed locally (see vectors.hashed_embedding)
+    embedding_model = 'hashed'
+
+    def __init__(self, path=RECORDING_FILE, latency=REPLAY_LATENCY):
+        self.latency = parse_latency(latency) if isinstance(latency, str) else latency
+        self._by_key, self._by_prefix = {}, {}
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._by_key[entry['key']] = entry
+                    self._by_prefix.setdefault(entry['prefix'], []).append(entry)
+        self.stats = {'exact': 0, 'prefix': 0, 'placeholder': 0}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_key)
+
+    def generate_content(self, contents, stream=False, generation_config=None, **kwargs):
+        entry = self._lookup(contents, generation_config)
+        latency = self.latency(entry)
+        usage = _usage(entry['usage'].get('prompt_token_count'), entry['usage'].get('candidates_token_count'))
+        if not stream:
+            time.sleep(latency)
+            return _chunk(entry['text'], usage)
+        return self._stream(entry, latency, usage)
+
+    def start_chat(self, history=None):
+        return _Chat(self, history)
+
+    def upload_file(self, file, mime_type):
+        return SimpleNamespace(uri=hashlib.sha256(file.read()).hexdigest(), mime_type=mime_type)
+
+    def embed(self, texts, task_type='retrieval_document'):
+        from vectors import hashed_embedding
+
+        return [hashed_embedding(text) for text in texts]
+
+    def _stream(self, entry, latency, usage):
+        text = entry['text']
+        ttft = entry.get('ttft')
+        ttft = min(latency, ttft) if ttft is not None else latency * 0.3
+        time.sleep(ttft)
+        size = max(1, -(-len(text) // self.STREAM_CHUNKS))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)] or ['']
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep((latency - ttft) / len(pieces))
+            yield _chunk(piece, usage if i == len(pieces) - 1 else None)
+
+    def _lookup(self, contents, generation_config):
+        # File API URIs handed out by upload_file are the image hashes themselves
+        key, prompt, _ = describe_request(contents)
+        entry = self._by_key.get(key)
+        kind = 'exact'
+        if entry is None:
+            candidates = self._by_prefix.get(_prompt_prefix(prompt))
+            entry = random.choice(candidates) if candidates else None
+            kind = 'prefix'
+        if entry is None:
+            json_output = (generation_config or {}).get('response_mime_type') == 'application/json'
+            text = '{"report_date": null, "lab_values": []}' if json_output else f"Replayed answer.\n\n{prompt[:200]}"
+            entry = {'text': text, 'usage': {}, 'latency': 0.0, 'ttft': None}
+            kind = 'placeholder'
+        with self._lock:
+            self.stats[kind] += 1
+        return entry
+
+
+def create_model(backend=None):
+    """Return the model backend selected by MEDASSIST_MODEL_BACKEND"""
+    backend = backend or MODEL_BACKEND
+    if backend == 'gemini':
+        return GeminiBackend()
+    if backend == 'record':
+        return RecordingBackend(GeminiBackend())
+    if backend == 'replay':
+        return ReplayBackend()
+    raise ValueError(f"Unknown model backend: {backend}")
@@ -0,0 +1,288 @@
+"""Prompt templates for the Gemini calls.
+
+Every template has a stable id; the id (not the rendered prompt) is what the
+response cache keys on, so editing a template's wording should come with a
+new id.
+"""
+
+# Supported Indian languages
+LANGUAGES = {
+    'English': 'en',
+    'Hindi': 'hi',
+    'Telugu': 'te',
+    'Tamil': 'ta',
+    'Bengali': 'bn',
+    'Marathi': 'mr',
+    'Gujarati': 'gu',
+    'Kannada': 'kn',
+    'Malayalam': 'ml',
+    'Punjabi': 'pa'
+}
+
+# Template ids
+QUERY_SUMMARY = 'query_summary.v1'
+REPORT_ANALYSIS = 'report_analysis.v1'
+REPORT_CHAT = 'report_chat.v1'
+SKIN_ANALYSIS = 'skin_analysis.v1'
+SKIN_CHAT = 'skin_chat.v1'
+REPORT_CHAT_SESSION = 'report_chat_session.v1'
+SKIN_CHAT_SESSION = 'skin_chat_session.v1'
+CHAT_TURN = 'chat_turn.v1'
+LAB_EXTRACTION = 'lab_extraction.v2'
+TRANSLATION = 'translation.v1'
+QUERY_GROUNDED = 'query_grounded.v1'
+REPORT_PAGES = 'report_pages.v1'
+REPORT_PAGE_NOTES = 'report_page_notes.v1'
+REPORT_NOTES = 'report_notes.v1'
+REPORT_DOCUMENT_CHAT_SESSION = 'report_document_chat_session.v1'
+
+_QUERY_SUMMARY_TEMPLATE = """You are an expert medical assistant. Analyze and summarize the following medical query
+and provide a comprehensive, accurate, and easy-to-understand response in {language} language.
+
+Structure your response as follows:
+1. **Understanding the Query**: Brief clarification of what's being asked
+2. **Key Information**: Main facts and important points (3-5 bullet points)
+3. **Detailed Explanation**: Comprehensive explanation in simple terms
+4. **Important Considerations**: Things to keep in mind
+5. **When to Seek Medical Help**: Red flags or situations requiring immediate attention
+6. **Recommendation**: Always advise consulting healthcare professionals
+
+Query: {query}
+
+Provide the complete response in {language} language with clear formatting."""
+
+_QUERY_GROUNDED_TEMPLATE = """You are an expert medical assistant. Analyze and summarize the following medical query
+and provide a comprehensive, accurate, and easy-to-understand response in {language} language.
+
+Below are answers given earlier to related questions. Use the facts in them where they apply
+to this query and keep the response consistent with them, but answer this query itself; ignore
+anything that is not relevant.
+
+{context}
+
+Structure your response as follows:
+1. **Understanding the Query**: Brief clarification of what's being asked
+2. **Key Information**: Main facts and important points (3-5 bullet points)
+3. **Detailed Explanation**: Comprehensive explanation in simple terms
+4. **Important Considerations**: Things to keep in mind
+5. **When to Seek Medical Help**: Red flags or situations requiring immediate attention
+6. **Recommendation**: Always advise consulting healthcare professionals
+
+Query: {query}
+
+Provide the complete response in {language} language with clear formatting."""
+
+# Output format shared by the single-image, multi-page and page-notes report analyses
+_REPORT_ANALYSIS_FORMAT = """Provide your analysis in the following structured format:
+
+## 📋 Report Type Identification
+- Identify what type of medical report this is (Lab test, X-ray, CT scan, MRI, Prescription, etc.)
+- Date of report (if visible)
+- Issuing hospital/lab (if visible)
+
+## 🔍 Detailed Findings
+Extract and list ALL visible information:
+- Test names with their values
+- Normal reference ranges
+- Units of measurement
+- Any flags (High/Low/Critical)
+
+## 📊 Parameter Analysis
+For each test result, provide:
+- What the test measures
+- Normal range explanation
+- Current value interpretation (Normal/Abnormal)
+- Clinical significance
+
+## 💡 Medical Interpretation
+- What do these results indicate overall?
+- Patterns or correlations between parameters
+- Possible health implications
+- Body systems affected
+
+## ⚠️ Areas of Concern
+- Any abnormal values requiring attention
+- Severity of abnormalities (Mild/Moderate/Severe)
+- Potential health risks
+
+## 🏥 Recommendations
+- Follow-up tests needed
+- Lifestyle modifications
+- Dietary suggestions
+- When to consult doctor
+
+## ⚡ Summary
+Brief overall summary with key takeaways
+
+IMPORTANT: Be thorough and extract ALL visible information. Explain medical terms in simple language.
+
+Provide the complete analysis in {language} language."""
+
+_REPORT_ANALYSIS_TEMPLATE = """You are an expert medical report analyzer. Carefully examine this medical report image
+and provide a comprehensive, detailed analysis in {language} language.
+
+""" + _REPORT_ANALYSIS_FORMAT
+
+_REPORT_PAGES_TEMPLATE = """You are an expert medical report analyzer. The {pages} images below are the pages of one
+medical report, in order. Carefully examine every page and provide one comprehensive, detailed
+analysis of the whole report in {language} language.
+
+""" + _REPORT_ANALYSIS_FORMAT
+
+# Map step for reports with more pages than fit in one request: each page is
+# transcribed on its own (in English, so the notes are shared by all languages)
+_REPORT_PAGE_NOTES_TEMPLATE = """You are an expert medical report analyzer. This image is one page of a longer medical report.
+Transcribe all medical information on the page as concise notes, without interpreting it:
+- Report type, date and issuing hospital/lab, if shown
+- Every test with its value, unit, normal reference range and any flag (High/Low/Critical)
+- Findings, impressions, diagnoses, medications and doctor's remarks
+
+Write the notes in English. If the page has no medical content, answer "No medical content"."""
+
+# Reduce step: the page notes are analyzed as one report
+_REPORT_NOTES_TEMPLATE = """You are an expert medical report analyzer. Below are notes transcribed from each of the
+{pages} pages of one medical report, in order. Provide one comprehensive, detailed analysis of the
+whole report in {language} language.
+
+""" + _REPORT_ANALYSIS_FORMAT + """
+
+Page notes:
+
+{notes}"""
+
+_REPORT_CHAT_TEMPLATE = """You are a medical assistant helping explain a medical report.
+Previous analysis: {analysis}
+
+User question: {question}
+
+Provide a clear, detailed answer in {language} language.
+Reference specific values from the report when relevant.
+Be helpful and educational, but always remind users to consult healthcare professionals."""
+
+_SKIN_ANALYSIS_TEMPLATE = """You are an expert dermatology assistant. Carefully analyze this skin condition image
+and provide a comprehensive, detailed assessment in {language} language.
+
+Provide your analysis in the following structured format:
+
+## 👁️ Visual Characteristics
+- Color (redness, darkening, discoloration)
+- Texture (smooth, rough, scaly, bumpy)
+- Pattern (circular, linear, clustered, widespread)
+- Size and shape
+- Location on body (if identifiable)
+- Any lesions, bumps, blisters, or rashes
+
+## 🔍 Possible Conditions (Differential Diagnosis)
+List 3-5 possible conditions with detailed explanations:
+1. Most likely condition - explain why
+2. Second possibility - reasoning
+3. Other potential conditions
+
+## 📊 Severity Assessment
+- Mild / Moderate / Severe (with justification)
+- Progression indicators
+- Complications to watch for
+
+## 💊 General Care Recommendations
+- Immediate care steps
+- Things to avoid
+- Over-the-counter options
+- Home remedies
+
+## 🚨 When to Seek Immediate Medical Attention
+- Red flags requiring urgent care
+- Signs of infection
+- Severe symptoms
+
+## 🏥 Medical Consultation Recommendations
+- Why professional diagnosis is essential
+- What type of specialist to see
+- What tests might be needed
+
+CRITICAL: Always emphasize this is NOT a definitive diagnosis.
+
+Provide the complete analysis in {language} language."""
+
+_SKIN_CHAT_TEMPLATE = """You are a dermatology assistant helping explain a skin condition analysis.
+Previous analysis: {analysis}
+
+User question: {question}
+
+Provide a clear, detailed answer in {language} language.
+Reference specific observations from the analysis when relevant.
+Be helpful and educational, but always remind users to consult a dermatologist."""
+
+# Multi-turn chats: the session prompt opens the conversation together with
+# the image, the model's analysis follows as its own turn, and each question
+# is then sent as a short CHAT_TURN message.
+_REPORT_CHAT_SESSION_TEMPLATE = """You are a medical assistant helping explain a medical report.
+Analyze this medical report image. The user will then ask follow-up questions about it.
+
+Answer every follow-up question in {language} language.
+Reference specific values from the report when relevant.
+Be helpful and educational, but always remind users to consult healthcare professionals."""
+
+_REPORT_DOCUMENT_CHAT_SESSION_TEMPLATE = """You are a medical assistant helping explain a medical report of {pages} pages.
+Analyze this medical report from {source}. The user will then ask follow-up questions about it.
+
+Answer every follow-up question in {language} language.
+Reference specific values and pages from the report when relevant.
+Be helpful and educational, but always remind users to consult healthcare professionals."""
+
+_SKIN_CHAT_SESSION_TEMPLATE = """You are a dermatology assistant helping explain a skin condition analysis.
+Analyze this skin condition image. The user will then ask follow-up questions about it.
+
+Answer every follow-up question in {language} language.
+Reference specific observations from the analysis when relevant.
+Be helpful and educational, but always remind users to consult a dermatologist."""
+
+_CHAT_TURN_TEMPLATE = """{question}
+
+(Answer in {language} language.)"""
+
+# Structured output: answered as JSON following labs.LAB_VALUES_SCHEMA
+_LAB_EXTRACTION_TEMPLATE = """You are an expert medical report analyzer. Extract every numeric lab test result
+in the provided report pages/notes.
+
+For each test give:
+- test: the test name exactly as printed (e.g. "HbA1c", "Hemoglobin", "LDL Cholesterol")
+- value: the numeric result
+- unit: the unit of measurement as printed
+- ref_low / ref_high: the bounds of the printed normal reference range (null if not shown)
+- flag: "low", "normal", "high" or "critical" compared with the reference range
+
+Also give report_date, the date of the report in YYYY-MM-DD format if visible, otherwise null.
+Skip results that are not numbers (e.g. "Positive", "Nil"). Return an empty list if the
+report is not a lab report."""
+
+_TRANSLATION_TEMPLATE = """Translate the following medical analysis into {language} language.
+
+Keep the markdown structure, headings, emoji, bullet points and tables exactly as they are.
+Keep numbers, units, reference ranges and test or medicine names unchanged; you may add the
+{language} term in brackets after a medical term. Do not add, remove or summarize any content.
+Output only the translation.
+
+{text}"""
+
+TEMPLATES = {
+    QUERY_SUMMARY: _QUERY_SUMMARY_TEMPLATE,
+    REPORT_ANALYSIS: _REPORT_ANALYSIS_TEMPLATE,
+    REPORT_CHAT: _REPORT_CHAT_TEMPLATE,
+    SKIN_ANALYSIS: _SKIN_ANALYSIS_TEMPLATE,
+    SKIN_CHAT: _SKIN_CHAT_TEMPLATE,
+    REPORT_CHAT_SESSION: _REPORT_CHAT_SESSION_TEMPLATE,
+    SKIN_CHAT_SESSION: _SKIN_CHAT_SESSION_TEMPLATE,
+    CHAT_TURN: _CHAT_TURN_TEMPLATE,
+    LAB_EXTRACTION: _LAB_EXTRACTION_TEMPLATE,
+    TRANSLATION: _TRANSLATION_TEMPLATE,
+    QUERY_GROUNDED: _QUERY_GROUNDED_TEMPLATE,
+    REPORT_PAGES: _REPORT_PAGES_TEMPLATE,
+    REPORT_PAGE_NOTES: _REPORT_PAGE_NOTES_TEMPLATE,
+    REPORT_NOTES: _REPORT_NOTES_TEMPLATE,
+    REPORT_DOCUMENT_CHAT_SESSION: _REPORT_DOCUMENT_CHAT_SESSION_TEMPLATE,
+}
+
+
+def build_prompt(template_id, **fields):
+    """Render a prompt template with its fields (language, query, ...)"""
+    return TEMPLATES[template_id].format(**fields)
@@ -0,0 +1,101 @@
+"""Local image quality checks, run on every upload before any model call.
+
+measure() computes the scores on the decoded image and check() turns them
+into warnings or blocking problems for a report or skin photo. Thresholds
+are for the image measured at QUALITY_EDGE pixels on its long edge.
+"""
+import os
+
+import numpy as np
+
+# Max long edge (pixels) the image is measured at
+QUALITY_EDGE = 1024
+# Below this short edge (pixels) an upload is rejected outright
+MIN_SHORT_EDGE = {'report': 400, 'skin': 224}
+# Variance of the Laplacian below which a report is too blurry to read (block)
+# or likely to be misread (warn). Skin photos have little fine texture, so
+# they only get a warning at a much lower score. A report image with little
+# text may be an X-ray, CT or MRI scan, which is smooth by nature: it is
+# never blocked, only warned about in case it is a blurred document photo.
+BLUR_BLOCK = float(os.getenv('MEDASSIST_BLUR_BLOCK', '15'))
+BLUR_WARN = {'report': float(os.getenv('MEDASSIST_BLUR_WARN', '60')), 'skin': 2.0}
+# Luminance standard deviation below which an image is flat
+MIN_CONTRAST = {'report': 12, 'skin': 5}
+# Share of 16x16 tiles with strong edges; a photographed page has text in most
+# of them. Below this a report image is taken for a scan (X-ray, CT, MRI).
+TEXT_DENSITY_WARN = 0.05
+_TILE = 16
+_EDGE_THRESHOLD = 40
+
+
+def measure(image):
+    """Quality scores of a decoded RGB PIL image (no model call):
+    width/height, blur (variance of the Laplacian), brightness and contrast,
+    dark/bright (share of clipped pixels) and text_density"""
+    width, height = image.size
+    # Integer box reduction first: far cheaper than resampling, and the
+    # grayscale conversion then only touches the reduced pixels
+    factor = -(-max(width, height) // QUALITY_EDGE)
+    if factor > 1:
+        image = image.reduce(factor)
+    pixels = np.asarray(image.convert('L'), dtype=np.int16)
+
+    # 4-neighbour Laplacian of the interior pixels
+    center = pixels[1:-1, 1:-1]
+    laplacian = (pixels[:-2, 1:-1] + pixels[2:, 1:-1] + pixels[1:-1, :-2] + pixels[1:-1, 2:]) - 4 * center
+    counts = np.bincount(pixels.ravel(), minlength=256)
+    levels = np.arange(256)
+    total = pixels.size
+    brightness = float(counts @ levels / total)
+    contrast = float(np.sqrt(counts @ (levels - brightness) ** 2 / total))
+
+    # Text density: tiles with enough strong horizontal gradients (strokes)
+    gradient = np.abs(np.diff(pixels, axis=1)) > _EDGE_THRESHOLD
+    rows, cols = gradient.shape[0] // _TILE, gradient.shape[1] // _TILE
+    if rows and cols:
+        tiles = gradient[:rows * _TILE, :cols * _TILE].reshape(rows, _TILE, cols, _TILE).sum(axis=(1, 3))
+        text_density = float(np.mean(tiles >= _TILE // 2))
+    else:
+        text_density = 0.0
+
+    return {
+        'width': width,
+        'height': height,
+        'blur': float(laplacian.var()) if laplacian.size else 0.0,
+        'brightness': brightness,
+        'contrast': contrast,
+        'dark': float(counts[:16].sum() / total),
+        'bright': float(counts[240:].sum() / total),
+        'text_density': text_density,
+    }
+
+
+def check(scores, kind):
+    """Problems found in `scores` for an upload of `kind` ('report' or 'skin'),
+    as [(severity, message)] with severity 'block' or 'warn'"""
+    problems = []
+    short_edge = min(scores['width'], scores['height'])
+    if short_edge < MIN_SHORT_EDGE[kind]:
+        problems.append(('block', f"The image is only {scores['width']}×{scores['height']} pixels; "
+                                  f"please upload one at least {MIN_SHORT_EDGE[kind]} pixels on each side"))
+    if scores['brightness'] < 25 or scores['dark'] > 0.8:
+        problems.append(('block', "The image is almost black; retake it with more light"))
+    elif scores['brightness'] < 60 or scores['dark'] > 0.4:
+        problems.append(('warn', "The image is dark; details may be missed"))
+    # White paper is bright by nature, so only call a report overexposed when it has no contrast left
+    if scores['bright'] > 0.9 and (kind == 'skin' or scores['contrast'] < 10):
+        problems.append(('warn', "The image is overexposed; retake it without flash or direct light"))
+    elif kind == 'skin' and scores['bright'] > 0.4:
+        problems.append(('warn', "Parts of the image are overexposed; retake it without flash or direct light"))
+    if scores['contrast'] < MIN_CONTRAST[kind]:
+        problems.append(('warn', "The image has very little contrast"))
+    if kind == 'report' and scores['text_density'] < TEXT_DENSITY_WARN:
+        if scores['blur'] < BLUR_WARN[kind]:
+            problems.append(('warn', "If this is a photo of a document, it is too blurry to read; "
+                                     "X-ray, CT and MRI images are fine as they are"))
+        return problems
+    if kind == 'report' and scores['blur'] < BLUR_BLOCK:
+        problems.append(('block', "The image is too blurry to read; hold the camera steady and refocus"))
+    elif scores['blur'] < BLUR_WARN[kind]:
+        problems.append(('warn', "The image looks blurry; hold the camera steady and refocus"))
+    return problems
@@ -0,0 +1,208 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+SESSION_SPILL_FILE = os.getenv('MEDASSIST_SESSION_SPILL_FILE', 'session_spill.db')
+# Heavy state of all sessions kept in memory before idle ones are spilled
+SESSION_MEMORY_BYTES = int(os.getenv('MEDASSIST_SESSION_MEMORY_MB', '256')) * 1024 * 1024
+# Spill a session after this many idle seconds even under the memory budget
+SESSION_IDLE_SECONDS = float(os.getenv('MEDASSIST_SESSION_IDLE_SECONDS', '600'))
+# Sessions touched more recently than this are never spilled; a script run
+# (including a queued model call) is expected to finish well within it
+SESSION_MIN_IDLE_SECONDS = 120
+SESSION_DISK_BYTES = int(os.getenv('MEDASSIST_SESSION_DISK_MB', '1024')) * 1024 * 1024
+
+# Per-session chat history caps (displayed messages; the model-side history
+# is bounded separately by chat.CHAT_TOKEN_BUDGET)
+MAX_CHAT_MESSAGES = int(os.getenv('MEDASSIST_MAX_CHAT_MESSAGES', '40'))
+MAX_CHAT_BYTES = int(os.getenv('MEDASSIST_MAX_CHAT_KB', '128')) * 1024
+
+
+class SessionData(dict):
+    """Heavy state of one session, with attribute access like st.session_state"""
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+
+def trim_chat_history(messages, max_messages=MAX_CHAT_MESSAGES, max_bytes=MAX_CHAT_BYTES):
+    """Drop the oldest messages (in place) beyond the count and size caps;
+    returns how many were dropped"""
+    size = sum(len(m['content'].encode('utf-8')) for m in messages)
+    dropped = 0
+    while messages and (len(messages) > max_messages or size > max_bytes):
+        size -= len(messages.pop(0)['content'].encode('utf-8'))
+        dropped += 1
+    return dropped
+
+
+class SessionMemory:
+    """Server-side store for the heavy per-session state (images, analyses,
+    chats) that would otherwise sit in st.session_state indefinitely.
+
+    Sessions are kept in LRU order. A session is measured by its pickled
+    size in release(), at the end of its own script run, so no other thread
+    pickles it while the run may still change it. Whenever a session is
+    accessed or released, the least recently used ones are spilled to an
+    SQLite file once they are idle for SESSION_IDLE_SECONDS or the total
+    exceeds `max_memory_bytes`. A spilled session is loaded back on its next
+    access. Spilled sessions are encrypted with a key that only lives in
+    this process, so the spill file is unreadable to anyone else and after
+    a restart (when the sessions are gone anyway). The spill file itself is
+    trimmed to `max_disk_bytes`, oldest sessions first.
+    """
+
+    def __init__(self, path=SESSION_SPILL_FILE, max_memory_bytes=SESSION_MEMORY_BYTES,
+                 idle_seconds=SESSION_IDLE_SECONDS, max_disk_bytes=SESSION_DISK_BYTES):
+        self.max_memory_bytes = max_memory_bytes
+        self.idle_seconds = idle_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        # session_id -> {'data': SessionData, 'bytes': int, 'dirty': bool, 'touched': float}
+        self._sessions = OrderedDict()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS spilled_sessions (
+                session_id TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                spilled_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_spilled_sessions_time ON spilled_sessions (spilled_at)'
+        )
+        self._conn.commit()
+        self._cipher = AESGCM(AESGCM.generate_key(bit_length=256))
+        self.stats = {'spilled': 0, 'restored': 0, 'expired': 0}
+
+    def session(self, session_id):
+        """State of `session_id` for this script run (restored from disk if spilled)"""
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                entry = {'data': self._restore(session_id), 'bytes': 0}
+                self._sessions[session_id] = entry
+            self._sessions.move_to_end(session_id)
+            # The caller may change the state from here on; it's measured again on release()
+            entry.update(dirty=True, touched=now)
+            self._sweep(now)
+            return entry['data']
+
+    def release(self, session_id):
+        """End of the script run of `session_id`: measure its state, now that
+        nothing changes it, and spill idle sessions if needed"""
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return
+            entry.update(bytes=self._measure(entry), dirty=False, touched=now)
+            self._sweep(now)
+
+    def gauges(self, session_id=None):
+        """Memory gauges: sessions and bytes in memory / on disk, spill counts,
+        and the current size of `session_id`"""
+        with self._lock:
+            disk_sessions, disk_bytes = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM spilled_sessions'
+            ).fetchone()
+            entry = self._sessions.get(session_id)
+            gauges = {
+                'in_memory': len(self._sessions),
+                'on_disk': disk_sessions,
+                'memory_bytes': sum(e['bytes'] for e in self._sessions.values()),
+                'disk_bytes': disk_bytes,
+            }
+            if entry is not None:
+                gauges['session_bytes'] = entry['bytes']
+            gauges.update(self.stats)
+        return gauges
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _measure(self, entry):
+        return len(pickle.dumps(entry['data'], pickle.HIGHEST_PROTOCOL))
+
+    def _sweep(self, now):
+        total = sum(e['bytes'] for e in self._sessions.values())
+        spilled = False
+        for session_id in list(self._sessions):
+            entry = self._sessions[session_id]
+            idle = now - entry['touched']
+            if idle < SESSION_MIN_IDLE_SECONDS:
+                # LRU order: everything after this was touched even more recently
+                break
+            if idle < self.idle_seconds and total <= self.max_memory_bytes:
+                break
+            if entry['dirty']:
+                # Its run ended without release() (e.g. an error); long idle, so no longer changing
+                try:
+                    entry.update(bytes=self._measure(entry), dirty=False)
+                except RuntimeError:
+                    continue
+            self._spill(session_id, entry, now)
+            total -= entry['bytes']
+            spilled = True
+        if spilled:
+            self._trim_disk()
+
+    def _spill(self, session_id, entry, now):
+        nonce = os.urandom(12)
+        data = nonce + self._cipher.encrypt(nonce, pickle.dumps(entry['data'], pickle.HIGHEST_PROTOCOL),
+                                            session_id.encode('utf-8'))
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO spilled_sessions VALUES (?, ?, ?, ?)',
+                (session_id, data, len(data), now)
+            )
+        del self._sessions[session_id]
+        self.stats['spilled'] += 1
+
+    def _restore(self, session_id):
+        row = self._conn.execute(
+            'SELECT data FROM spilled_sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        if row is None:
+            return SessionData()
+        with self._conn:
+            self._conn.execute('DELETE FROM spilled_sessions WHERE session_id = ?', (session_id,))
+        try:
+            data = self._cipher.decrypt(row[0][:12], row[0][12:], session_id.encode('utf-8'))
+        except InvalidTag:
+            # Spilled by an earlier server process, whose key is gone
+            return SessionData()
+        self.stats['restored'] += 1
+        return pickle.loads(data)
+
+    def _trim_disk(self):
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM spilled_sessions').fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        rows = self._conn.execute('SELECT session_id, size FROM spilled_sessions ORDER BY spilled_at').fetchall()
+        expired = []
+        for session_id, size in rows:
+            if total <= self.max_disk_bytes:
+                break
+            expired.append((session_id,))
+            total -= size
+        with self._conn:
+            self._conn.executemany('DELETE FROM spilled_sessions WHERE session_id = ?', expired)
+        self.stats['expired'] += len(expired)
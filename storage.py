@@ -0,0 +1,502 @@
+import bisect
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+LEGACY_DATA_FILE = 'user_medical_data.json'
+
+# Backend selection: "sqlite" (default) or "jsonl"
+STORAGE_BACKEND = os.getenv('MEDASSIST_STORAGE', 'sqlite')
+STORAGE_PATHS = {
+    'sqlite': 'user_medical_data.db',
+    'jsonl': 'user_medical_data.jsonl',
+}
+# Rows fetched per query when iterating over a whole store
+ITER_BATCH = 1000
+
+
+def new_record_id():
+    """Return a unique id for a stored record"""
+    return uuid.uuid4().hex
+
+
+class RecordStore(ABC):
+    """Append-only store of user records (dicts)"""
+
+    def append(self, record):
+        """Append one record and return its record_id"""
+        return self.append_many([record])[0]
+
+    @abstractmethod
+    def append_many(self, records):
+        """Append records and return their record_ids"""
+
+    @abstractmethod
+    def iter_records(self):
+        """Yield every stored record"""
+
+    @abstractmethod
+    def get_history(self, user_id, report_type=None, since=None, limit=20):
+        """Most recent records for `user_id`, newest first.
+
+        `report_type` filters on the record type, `since` (datetime or ISO
+        string) keeps only records with a later or equal timestamp.
+        """
+
+    def get_record(self, user_id, record_id):
+        """The record `record_id` of `user_id`, or None"""
+        for record in self.get_history(user_id, limit=None):
+            if record.get('record_id') == record_id:
+                return record
+        return None
+
+    @abstractmethod
+    def count(self):
+        """Number of stored records"""
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _prepare(self, record):
+        record = dict(record)
+        record.setdefault('record_id', new_record_id())
+        return record
+
+
+class CompactableStore(RecordStore):
+    """Record store that old records can be moved out of (the hot tier of
+    archive.TieredStore)"""
+
+    @abstractmethod
+    def records_before(self, before, limit=None):
+        """Records with a timestamp earlier than `before`, oldest first"""
+
+    @abstractmethod
+    def delete(self, record_ids):
+        """Remove the records `record_ids`"""
+
+
+def _since_key(since):
+    if since is None:
+        return ''
+    return since if isinstance(since, str) else since.isoformat()
+
+
+def _pread(fd, length, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    # Windows: callers hold the store's thread lock, so seek + read is safe
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+class _FileLock:
+    """Exclusive advisory lock on an open file, safe across processes"""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        else:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+
+
+class JsonlStore(RecordStore):
+    """One JSON object per line, appended under an exclusive file lock.
+
+    Each append is a single O_APPEND write, so its cost does not depend on
+    how many records are already stored. fsync is batched: the file is synced
+    every `fsync_every` records or `fsync_interval` seconds, whichever comes
+    first, and on flush/close.
+
+    History lookups use a sidecar index (`<path>.idx`) holding one
+    `[user_id, report_type, timestamp, offset, length]` line per record. It is
+    loaded into a per-user, timestamp-sorted in-memory index and caught up
+    incrementally with records appended by other processes.
+    """
+
+    def __init__(self, path, fsync_every=32, fsync_interval=1.0):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._idx_fd = os.open(self.index_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        # user_id -> sorted list of (timestamp, report_type, offset, length)
+        self._by_user = {}
+        self._idx_pos = 0
+        self._indexed_end = 0
+        with self._lock:
+            with _FileLock(self._fd):
+                self._catch_up()
+                self._index_missing()
+
+    def append_many(self, records):
+        records = [self._prepare(r) for r in records]
+        lines = [(json.dumps(r, ensure_ascii=False) + '\n').encode('utf-8') for r in records]
+        with self._lock:
+            with _FileLock(self._fd):
+                self._catch_up()
+                self._index_missing()
+                offset = os.fstat(self._fd).st_size
+                os.write(self._fd, b''.join(lines))
+                entries = []
+                for record, line in zip(records, lines):
+                    entries.append([record.get('user_id'), record.get('report_type'),
+                                    record.get('timestamp'), offset, len(line)])
+                    offset += len(line)
+                self._write_index(entries)
+            self._unsynced += len(records)
+            if (self._unsynced >= self.fsync_every
+                    or time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
+        return [r['record_id'] for r in records]
+
+    def iter_records(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn final line from a crashed writer
+                    continue
+
+    def get_history(self, user_id, report_type=None, since=None, limit=20):
+        with self._lock:
+            self._catch_up()
+            entries = self._by_user.get(user_id, [])
+            start = bisect.bisect_left(entries, (_since_key(since),))
+            picked = []
+            for entry in reversed(entries[start:]):
+                if report_type is None or entry[1] == report_type:
+                    picked.append(entry)
+                    if limit and len(picked) >= limit:
+                        break
+            return [json.loads(_pread(self._fd, length, offset)) for _, _, offset, length in picked]
+
+    def count(self):
+        with self._lock:
+            self._catch_up()
+            return sum(len(entries) for entries in self._by_user.values())
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        if self._fd is not None:
+            self.flush()
+            os.close(self._fd)
+            os.close(self._idx_fd)
+            self._fd = self._idx_fd = None
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._fd)
+            os.fsync(self._idx_fd)
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _add_to_index(self, entry):
+        user_id, report_type, timestamp, offset, length = entry
+        bisect.insort(self._by_user.setdefault(user_id, []),
+                      (timestamp or '', report_type or '', offset, length))
+        self._indexed_end = max(self._indexed_end, offset + length)
+
+    def _write_index(self, entries):
+        payload = ''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in entries)
+        os.write(self._idx_fd, payload.encode('utf-8'))
+        self._idx_pos = os.fstat(self._idx_fd).st_size
+        for entry in entries:
+            self._add_to_index(entry)
+
+    def _catch_up(self):
+        """Load index lines written since the last call (by any process)"""
+        idx_size = os.fstat(self._idx_fd).st_size
+        if idx_size > self._idx_pos:
+            chunk = _pread(self._idx_fd, idx_size - self._idx_pos, self._idx_pos)
+            complete = chunk[:chunk.rfind(b'\n') + 1]
+            for line in complete.splitlines():
+                if line.strip():
+                    self._add_to_index(json.loads(line))
+            self._idx_pos += len(complete)
+
+    def _index_missing(self):
+        """Index data records the sidecar does not cover yet, e.g. a file
+        written before the index existed or a writer that crashed between
+        the two writes. Must be called with the file lock held."""
+        data_size = os.fstat(self._fd).st_size
+        if data_size <= self._indexed_end:
+            return
+        chunk = _pread(self._fd, data_size - self._indexed_end, self._indexed_end)
+        offset = self._indexed_end
+        missing = []
+        for line in chunk.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                break
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    record = None
+                if record is not None:
+                    missing.append([record.get('user_id'), record.get('report_type'),
+                                    record.get('timestamp'), offset, len(line)])
+            offset += len(line)
+        if missing:
+            self._write_index(missing)
+        self._indexed_end = max(self._indexed_end, offset)
+
+
+class SqliteStore(CompactableStore):
+    """SQLite table in WAL mode.
+
+    With journal_mode=WAL and synchronous=NORMAL a commit is a sequential
+    append to the write-ahead log and fsync happens at checkpoints, which
+    batches syncs the same way JsonlStore does. SQLite's own locking makes
+    concurrent writers from several processes safe.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS records (
+                seq INTEGER PRIMARY KEY,
+                record_id TEXT NOT NULL UNIQUE,
+                user_id TEXT,
+                report_type TEXT,
+                timestamp TEXT,
+                data TEXT NOT NULL
+            )
+        """)
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_records_user_time ON records (user_id, timestamp)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_records_user_type_time ON records (user_id, report_type, timestamp)'
+        )
+        # Compaction into the archive tier (see archive.py) scans by age
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_records_time ON records (timestamp)')
+        self._conn.commit()
+
+    def append_many(self, records):
+        records = [self._prepare(r) for r in records]
+        rows = [
+            (r['record_id'], r.get('user_id'), r.get('report_type'), r.get('timestamp'),
+             json.dumps(r, ensure_ascii=False))
+            for r in records
+        ]
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    'INSERT INTO records (record_id, user_id, report_type, timestamp, data) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    rows
+                )
+        return [r['record_id'] for r in records]
+
+    def iter_records(self):
+        # Keyset pages, so memory stays bounded however large the table is
+        seq = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT seq, data FROM records WHERE seq > ? ORDER BY seq LIMIT ?', (seq, ITER_BATCH)
+                ).fetchall()
+            if not rows:
+                return
+            for seq, data in rows:
+                yield json.loads(data)
+
+    def get_history(self, user_id, report_type=None, since=None, limit=20):
+        sql = 'SELECT data FROM records WHERE user_id = ?'
+        params = [user_id]
+        if report_type is not None:
+            sql += ' AND report_type = ?'
+            params.append(report_type)
+        if since is not None:
+            sql += ' AND timestamp >= ?'
+            params.append(_since_key(since))
+        sql += ' ORDER BY timestamp DESC'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def get_record(self, user_id, record_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT data FROM records WHERE record_id = ? AND user_id = ?', (record_id, user_id)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def records_before(self, before, limit=None):
+        sql = 'SELECT data FROM records WHERE timestamp < ? ORDER BY timestamp'
+        params = [_since_key(before)]
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def delete(self, record_ids):
+        with self._lock:
+            with self._conn:
+                self._conn.executemany('DELETE FROM records WHERE record_id = ?', [(i,) for i in record_ids])
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def iter_json_array(path, chunk_size=1 << 16):
+    """Yield the objects of a JSON array file one by one.
+
+    The file is decoded incrementally in chunks, so memory holds one chunk
+    and one object rather than the whole array. Raises json.JSONDecodeError
+    for a malformed file after yielding the objects before the error.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ''
+        started = eof = False
+        while True:
+            if not eof:
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer += chunk
+            pos = 0
+            while True:
+                while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ',')):
+                    pos += 1
+                if pos == len(buffer):
+                    break
+                if not started:
+                    if buffer[pos] != '[':
+                        raise json.JSONDecodeError('Expected a JSON array', buffer, pos)
+                    started = True
+                    pos += 1
+                    continue
+                if buffer[pos] == ']':
+                    return
+                try:
+                    item, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    # The object continues in the next chunk
+                    break
+                yield item
+            buffer = buffer[pos:]
+            if eof and not buffer.strip():
+                if started:
+                    raise json.JSONDecodeError('Unterminated JSON array', buffer, 0)
+                return
+
+
+def migrate_json_array(src_path, store, batch_size=ITER_BATCH):
+    """One-shot copy of a legacy JSON-array data file into `store`.
+
+    The file is read incrementally; a malformed file is migrated up to the
+    last complete record. Returns the number of records migrated.
+    """
+    migrated = 0
+    batch = []
+    records = iter_json_array(src_path)
+    try:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                migrated += len(store.append_many(batch))
+                batch = []
+    except json.JSONDecodeError:
+        pass
+    if batch:
+        migrated += len(store.append_many(batch))
+    if migrated:
+        store.flush()
+    return migrated
+
+
+def open_store(backend=None, path=None, legacy_path=LEGACY_DATA_FILE):
+    """Open the configured record store, migrating the legacy JSON file on first use"""
+    backend = backend or STORAGE_BACKEND
+    path = path or os.getenv('MEDASSIST_DATA_PATH') or STORAGE_PATHS[backend]
+    if backend == 'sqlite':
+        store = SqliteStore(path)
+    elif backend == 'jsonl':
+        store = JsonlStore(path)
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
+
+    # Old records move to the compressed, encrypted archive tier once a key is configured
+    if backend == 'sqlite' and os.getenv('MEDASSIST_ARCHIVE_KEY'):
+        from archive import Archive, TieredStore, load_key
+
+        store = TieredStore(store, Archive(load_key()))
+
+    # Counted across both tiers: compaction can leave the hot store empty
+    if legacy_path and os.path.exists(legacy_path) and store.count() == 0:
+        migrate_json_array(legacy_path, store)
+    return store
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Migrate the legacy JSON data file into a record store')
+    parser.add_argument('src', nargs='?', default=LEGACY_DATA_FILE)
+    parser.add_argument('--backend', choices=sorted(STORAGE_PATHS), default=STORAGE_BACKEND)
+    parser.add_argument('--path', default=None)
+    args = parser.parse_args()
+
+    store = open_store(args.backend, args.path, legacy_path=None)
+    migrated = migrate_json_array(args.src, store)
+    store.close()
+    print(f"Migrated {migrated} records from {args.src}")
@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+TRACE_FILE = os.getenv('MEDASSIST_TRACE_FILE', 'telemetry.jsonl')
+# Serve /metrics on this port when set
+METRICS_PORT = os.getenv('MEDASSIST_METRICS_PORT')
+# Latency samples kept per feature for quantiles
+WINDOW = 2000
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Telemetry:
+    """Per-feature latency, token, payload and error accounting.
+
+    Every finished span updates in-memory counters and a bounded window of
+    latencies for quantiles, and is appended as one JSON line to the trace
+    file. Metrics can be rendered in the Prometheus text format.
+    """
+
+    def __init__(self, trace_file=TRACE_FILE):
+        self.trace_file = trace_file
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(lambda: deque(maxlen=WINDOW))
+        self._counters = defaultdict(lambda: defaultdict(float))
+        self._trace = open(trace_file, 'a', encoding='utf-8') if trace_file else None
+        self._gauges = []
+
+    @contextmanager
+    def track(self, feature, **fields):
+        """Time a block of work. Yields a dict the block can fill with
+        prompt_tokens, response_tokens, image_bytes, cache_hit, ..."""
+        span = dict(fields)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span['error'] = type(e).__name__
+            raise
+        finally:
+            span['wall_ms'] = (time.perf_counter() - start) * 1000
+            self.record(feature, span)
+
+    def record(self, feature, span):
+        with self._lock:
+            self._latencies[feature].append(span['wall_ms'])
+            counters = self._counters[feature]
+            counters['calls'] += 1
+            counters['latency_ms_sum'] += span['wall_ms']
+            counters['errors'] += 1 if span.get('error') else 0
+            counters['cache_hits'] += 1 if span.get('cache_hit') else 0
+            for key in ('prompt_tokens', 'response_tokens', 'image_bytes'):
+                counters[key] += span.get(key) or 0
+            if self._trace:
+                event = {'ts': time.time(), 'feature': feature}
+                event.update(span)
+                self._trace.write(json.dumps(event, ensure_ascii=False, default=str) + '\n')
+                self._trace.flush()
+
+    def register_gauges(self, prefix, source):
+        """Export the numbers returned by source() as <prefix>_<key> gauges"""
+        self._gauges.append((prefix, source))
+
+    def summary(self):
+        """{feature: {calls, errors, cache_hits, tokens, p50_ms, p95_ms, p99_ms, ...}}"""
+        with self._lock:
+            snapshot = {f: (list(self._latencies[f]), dict(c)) for f, c in self._counters.items()}
+        result = {}
+        for feature, (latencies, counters) in sorted(snapshot.items()):
+            row = {k: int(v) for k, v in counters.items() if k != 'latency_ms_sum'}
+            if latencies:
+                for q, value in zip(QUANTILES, np.percentile(latencies, [q * 100 for q in QUANTILES])):
+                    row[f'p{int(q * 100)}_ms'] = round(float(value), 1)
+            result[feature] = row
+        return result
+
+    def render_prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        with self._lock:
+            snapshot = {f: (list(self._latencies[f]), dict(c)) for f, c in self._counters.items()}
+        lines = [
+            '# HELP medassist_latency_seconds Wall time per feature call.',
+            '# TYPE medassist_latency_seconds summary',
+        ]
+        for feature, (latencies, counters) in sorted(snapshot.items()):
+            if latencies:
+                for q, value in zip(QUANTILES, np.percentile(latencies, [q * 100 for q in QUANTILES])):
+                    lines.append(f'medassist_latency_seconds{{feature="{feature}",quantile="{q}"}} {value / 1000:.6f}')
+            lines.append(f'medassist_latency_seconds_sum{{feature="{feature}"}} {counters["latency_ms_sum"] / 1000:.6f}')
+            lines.append(f'medassist_latency_seconds_count{{feature="{feature}"}} {int(counters["calls"])}')
+        for name, key, help_text in (
+            ('medassist_errors_total', 'errors', 'Failed feature calls.'),
+            ('medassist_cache_hits_total', 'cache_hits', 'Calls served from the response cache.'),
+            ('medassist_prompt_tokens_total', 'prompt_tokens', 'Prompt tokens reported by the API.'),
+            ('medassist_response_tokens_total', 'response_tokens', 'Response tokens reported by the API.'),
+            ('medassist_image_bytes_total', 'image_bytes', 'Image payload bytes processed or sent.'),
+        ):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for feature, (_, counters) in sorted(snapshot.items()):
+                lines.append(f'{name}{{feature="{feature}"}} {int(counters.get(key, 0))}')
+        for prefix, source in self._gauges:
+            for key, value in source().items():
+                name = f'medassist_{prefix}_{key}'
+                lines += [f'# TYPE {name} gauge', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        """Expose render_prometheus() at http://0.0.0.0:<port>/metrics in a daemon thread"""
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') != '/metrics':
+                    self.send_error(404)
+                    return
+                body = telemetry.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('0.0.0.0', int(port)), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
@@ -0,0 +1,62 @@
+import os
+import time
+
+import prompts
+from cache import ResponseCache, sha256_bytes
+from chat import estimate_tokens
+
+# Language the image analysis runs in when translate-once is enabled
+PIVOT_LANGUAGE = os.getenv('MEDASSIST_PIVOT_LANGUAGE', 'English')
+
+
+def analysis_sha(text):
+    return sha256_bytes(text.encode('utf-8'))
+
+
+def translation_key(text, language):
+    """Response cache key of the translation of `text` into `language`"""
+    return ResponseCache.make_key(prompts.TRANSLATION, language, context=analysis_sha(text))
+
+
+def translation_prompt(text, language):
+    return prompts.build_prompt(prompts.TRANSLATION, language=language, text=text)
+
+
+def request_translation(model, text, language):
+    """Text-only translation call; returns (translation, input tokens)"""
+    response = model.generate_content(translation_prompt(text, language))
+    usage = getattr(response, 'usage_metadata', None)
+    input_tokens = getattr(usage, 'prompt_token_count', None) or estimate_tokens(translation_prompt(text, language))
+    return response.text, input_tokens
+
+
+def _timed_translation(model, text, language):
+    start = time.perf_counter()
+    translated, input_tokens = request_translation(model, text, language)
+    return translated, input_tokens, time.perf_counter() - start
+
+
+def translate_all(model, cache, executor, text, languages, use_cache=True):
+    """Translate `text` into every language concurrently on the executor.
+
+    With `use_cache` off, cached translations are not served (new ones are
+    still stored, like any other call). Returns {language: {'text',
+    'cached', 'latency', 'input_tokens'}} and the wall time of the whole
+    fan-out in seconds.
+    """
+    start = time.perf_counter()
+    results, futures = {}, {}
+    for language in languages:
+        key = translation_key(text, language)
+        cached = cache.get(key) if use_cache else None
+        if not use_cache:
+            cache.record_bypass()
+        if cached is not None:
+            results[language] = {'text': cached, 'cached': True, 'latency': 0.0, 'input_tokens': 0}
+        else:
+            futures[language] = (key, executor.submit(_timed_translation, model, text, language))
+    for language, (key, future) in futures.items():
+        translated, input_tokens, latency = future.result()
+        cache.set(key, translated)
+        results[language] = {'text': translated, 'cached': False, 'latency': latency, 'input_tokens': input_tokens}
+    return {language: results[language] for language in languages}, time.perf_counter() - start
@@ -0,0 +1,200 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+# Dimensions of stored embeddings (text-embedding-004 is truncated to this)
+EMBEDDING_DIM = 256
+# Characters of a record embedded (the embedding model reads ~2k tokens)
+EMBED_CHARS = 8000
+# Rows scored per matrix product in a search
+SCORE_BLOCK = 65536
+HISTORY_VECTORS_PREFIX = os.getenv('MEDASSIST_HISTORY_VECTORS', 'history_vectors')
+
+_TOKEN = re.compile(r'[^\s.,;:!?()\[\]{}"\'`*#|/\\<>=+।-]+')
+
+
+def hashed_embedding(text, dim=EMBEDDING_DIM):
+    """Offline embedding: signed feature hashing of words and word pairs.
+
+    A lexical stand-in for the embedding API, used by the replay backend.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    words = _TOKEN.findall(text.lower())
+    for feature in words + [a + ' ' + b for a, b in zip(words, words[1:])]:
+        h = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+        vector[h % dim] += 1.0 if h >> 63 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def history_groups(record):
+    """Search groups of a saved record in the history index"""
+    return [f"user:{record['user_id']}"]
+
+
+def record_text(record):
+    """Text of a stored record that gets embedded"""
+    return f"{record.get('report_type') or ''}\n{record.get('analysis') or ''}"[:EMBED_CHARS]
+
+
+class VectorIndex:
+    """Unit-normalized float32 embeddings for cosine top-k search.
+
+    Vectors live in `<prefix>.f32`, a flat row-major float32 array read
+    through a memory map. `<prefix>.db` maps rows to record ids and to groups
+    (e.g. "user:<id>"). A search scans only the rows of one group, so a
+    user's history stays fast however large the whole index grows. Rows are
+    appended under an SQLite write transaction, which serializes writers
+    across processes; readers catch up on rows added elsewhere.
+    """
+
+    def __init__(self, prefix=HISTORY_VECTORS_PREFIX, dim=EMBEDDING_DIM):
+        self.dim = dim
+        self.vectors_path = prefix + '.f32'
+        self._lock = threading.Lock()
+        self._fd = os.open(self.vectors_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        self._conn = sqlite3.connect(prefix + '.db', timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS vector_rows (row INTEGER PRIMARY KEY, record_id TEXT NOT NULL UNIQUE)'
+        )
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS vector_groups (
+                grp TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                PRIMARY KEY (grp, row)
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_vector_groups_row ON vector_groups (row)')
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+        self._rows = 0
+        # group -> [row list, cached np.array or None]
+        self._groups = {}
+
+    def add_many(self, items):
+        """Store [(record_id, vector, groups)]; records already indexed are skipped"""
+        row_bytes = self.dim * 4
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT COALESCE(MAX(row) + 1, 0) FROM vector_rows').fetchone()[0]
+                for record_id, vector, groups in items:
+                    if self._conn.execute('SELECT 1 FROM vector_rows WHERE record_id = ?', (record_id,)).fetchone():
+                        continue
+                    vector = np.asarray(vector, dtype=np.float32)
+                    norm = np.linalg.norm(vector)
+                    _pwrite(self._fd, (vector / norm if norm else vector).tobytes(), row * row_bytes)
+                    self._conn.execute('INSERT INTO vector_rows VALUES (?, ?)', (row, record_id))
+                    self._conn.executemany('INSERT INTO vector_groups VALUES (?, ?)', [(g, row) for g in groups])
+                    row += 1
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def indexed_ids(self):
+        with self._lock:
+            return {record_id for (record_id,) in self._conn.execute('SELECT record_id FROM vector_rows')}
+
+    def count(self):
+        with self._lock:
+            self._catch_up()
+            return self._rows
+
+    def search(self, vector, group=None, k=5):
+        """[(cosine similarity, record_id)] of the k nearest rows, best first.
+        `group` limits the search to that group's rows."""
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        with self._lock:
+            self._catch_up()
+            rows = None if group is None else self._group_rows(group)
+            scores = self._scores(query, rows)
+            if not len(scores):
+                return []
+            k = min(k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            picked = top if rows is None else rows[top]
+            ids = dict(self._conn.execute(
+                f"SELECT row, record_id FROM vector_rows WHERE row IN ({','.join('?' * len(picked))})",
+                [int(r) for r in picked]
+            ).fetchall())
+        return [(float(scores[i]), ids[int(r)]) for i, r in zip(top, picked)]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            os.close(self._fd)
+
+    def _scores(self, query, rows):
+        # Scored in blocks so large groups never copy the whole matrix at once
+        n = self._rows if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.float32)
+        for lo in range(0, n, SCORE_BLOCK):
+            hi = min(n, lo + SCORE_BLOCK)
+            block = self._matrix[lo:hi] if rows is None else self._matrix[rows[lo:hi]]
+            scores[lo:hi] = block @ query
+        return scores
+
+    def _group_rows(self, group):
+        entry = self._groups.get(group)
+        if entry is None:
+            return np.zeros(0, dtype=np.int64)
+        if entry[1] is None:
+            entry[1] = np.array(entry[0], dtype=np.int64)
+        return entry[1]
+
+    def _catch_up(self):
+        rows = self._conn.execute('SELECT COALESCE(MAX(row) + 1, 0) FROM vector_rows').fetchone()[0]
+        if rows == self._rows:
+            return
+        for group, row in self._conn.execute(
+            'SELECT grp, row FROM vector_groups WHERE row >= ? AND row < ? ORDER BY row', (self._rows, rows)
+        ):
+            entry = self._groups.setdefault(group, [[], None])
+            entry[0].append(row)
+            entry[1] = None
+        self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+        self._rows = rows
+
+
+def _pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        os.pwrite(fd, data, offset)
+    else:
+        # Windows: writers are serialized by the SQLite write transaction
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+
+def sync_index(index, store, embed, groups_for, batch_size=64):
+    """Embed the stored records that are not in the index yet.
+
+    `embed(texts)` returns one vector per text and `groups_for(record)` the
+    groups a record belongs to. Returns the number of records added.
+    """
+    indexed = index.indexed_ids()
+    added = 0
+    batch = []
+    for record in store.iter_records():
+        if record.get('record_id') in indexed or not record.get('analysis'):
+            continue
+        batch.append(record)
+        if len(batch) >= batch_size:
+            added += _embed_batch(index, embed, groups_for, batch)
+            batch = []
+    if batch:
+        added += _embed_batch(index, embed, groups_for, batch)
+    return added
+
+
+def _embed_batch(index, embed, groups_for, records):
+    vectors = embed([record_text(r) for r in records])
+    index.add_many([(r['record_id'], v, groups_for(r)) for r, v in zip(records, vectors)])
+    return len(records)